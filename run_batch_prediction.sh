@@ -4,6 +4,7 @@
 # see ./src/data_processing/preprocessing-batch.ipynb for example on how to generate batch data for prediction
 # we assume the batch data is in ./data/batch_data
 # you should expect there are several directories named as batch_* with a test.tsv file in each of them
+# completed batches are recorded in $pred_dir/batch_manifest; add --resume to skip them after a crash
 
 export CUDA_VISIBLE_DEVICES=1
 
@@ -33,6 +34,7 @@ python ./src/batch_prediction.py \
   --log_file $log \
   --log_lvl i \
   --num_core 4 \
+  --pipeline_depth 1 \
   --non_relation_label $tag_for_non_relation \
   --classification_mode $mode \
   --type_map $binary_type_mapping_file \
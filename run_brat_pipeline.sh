@@ -0,0 +1,34 @@
+#!/bin/bash
+
+# example for end-to-end prediction: brat notes with entities in, brat notes with entities and relations out
+# no candidate tsv or prediction files are needed; add --debug_dir to keep them for inspection
+
+export CUDA_VISIBLE_DEVICES=0
+
+model_type=bert
+data_format_mode=0
+max_seq_length=512
+tag_for_non_relation=NonRel
+mode=mul
+relation_extraction_model=./model
+brat_entity_dir=./data/results_from_NER
+final_brat_output_with_NER_RE=./data/final
+log=./log.txt
+
+python ./src/brat_pipeline.py \
+  --model_type $model_type \
+  --data_format_mode $data_format_mode \
+  --new_model_dir $relation_extraction_model \
+  --max_seq_length $max_seq_length \
+  --do_lower_case \
+  --eval_batch_size 32 \
+  --non_relation_label $tag_for_non_relation \
+  --classification_mode $mode \
+  --type_pairs Strength:Drug Route:Drug Frequency:Drug Dosage:Drug Form:Drug Duration:Drug ADE:Drug Reason:Drug \
+  --max_sent_distance 1 \
+  --notes_per_chunk 1000 \
+  --num_core 8 \
+  --brat_data_dir $brat_entity_dir \
+  --brat_result_output_dir $final_brat_output_with_NER_RE \
+  --log_file $log \
+  --log_lvl i
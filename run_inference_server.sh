@@ -0,0 +1,33 @@
+#!/bin/bash
+
+# example for a long-lived relation extraction service; the model is loaded once
+# concurrent requests are micro-batched (up to max_batch_candidates candidates or max_wait_ms)
+# load test: python ./src/inference_client.py --test_data_file ./data/test.tsv --num_requests 1000 --concurrency 16
+
+export CUDA_VISIBLE_DEVICES=0
+
+model_type=bert
+data_format_mode=0
+max_seq_length=512
+tag_for_non_relation=NonRel
+mode=mul
+relation_extraction_model=./model
+log=./log.txt
+
+python ./src/inference_server.py \
+  --model_type $model_type \
+  --data_format_mode $data_format_mode \
+  --new_model_dir $relation_extraction_model \
+  --max_seq_length $max_seq_length \
+  --do_lower_case \
+  --eval_batch_size 32 \
+  --non_relation_label $tag_for_non_relation \
+  --classification_mode $mode \
+  --type_pairs Strength:Drug Route:Drug Frequency:Drug Dosage:Drug Form:Drug Duration:Drug ADE:Drug Reason:Drug \
+  --max_sent_distance 1 \
+  --host 127.0.0.1 \
+  --port 8000 \
+  --max_batch_candidates 256 \
+  --max_wait_ms 20 \
+  --log_file $log \
+  --log_lvl i
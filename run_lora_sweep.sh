@@ -0,0 +1,33 @@
+# train LoRA rank 4/8/16 adapters in one process (base model and features are loaded once)
+# results of all settings are saved in $nmd/sweep_results.tsv
+data_dir=./sample_data
+nmd=/vol/bitbucket/l22/llama2_models_lora_sweep
+log=./log_files/log_llama2_lora_sweep.txt
+
+accelerate launch ./src/lora_sweep.py \
+                --model_type llama2 \
+                --data_format_mode 0 \
+                --classification_scheme 2 \
+                --pretrained_model meta-llama/Llama-2-7b-hf  \
+                --data_dir $data_dir \
+                --num_core 3 \
+                --new_model_dir $nmd \
+                --overwrite_model_dir \
+                --seed 13 \
+                --max_seq_length 256 \
+                --cache_data \
+                --do_lower_case \
+                --lora_ranks 4 8 16 \
+                --lora_alphas 32 \
+                --train_batch_size 2 \
+                --eval_batch_size 2 \
+                --learning_rate 1e-4 \
+                --num_train_epochs 3 \
+                --gradient_accumulation_steps 4 \
+                --do_warmup \
+                --warmup_ratio 0.1 \
+                --weight_decay 0 \
+                --max_num_checkpoints 2 \
+                --log_file $log \
+                --log_step 500 \
+                --progress_bar
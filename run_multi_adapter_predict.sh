@@ -0,0 +1,26 @@
+# predict test.tsv with LoRA rank 4/8/16 adapters in one process (base model and test data are loaded once)
+# one prediction file per adapter, e.g., ./predictions_llama2_lora_0_llama2_models_lora_4_ckpt_0.txt
+data_dir=./sample_data
+nmd=/vol/bitbucket/l22/llama2_models_lora_predict
+pof=./predictions_llama2_lora.txt
+log=./log_files/log_llama2_lora_predict.txt
+
+accelerate launch ./src/relation_extraction.py \
+		--model_type llama2 \
+		--ckpt_dirs /vol/bitbucket/l22/llama2_models_lora_4/ckpt_0 \
+		            /vol/bitbucket/l22/llama2_models_lora_8/ckpt_0 \
+		            /vol/bitbucket/l22/llama2_models_lora_16/ckpt_0 \
+		--data_format_mode 0 \
+		--classification_scheme 2 \
+		--pretrained_model meta-llama/Llama-2-7b-hf \
+		--data_dir $data_dir \
+		--new_model_dir $nmd \
+		--predict_output_file $pof \
+		--seed 13 \
+		--max_seq_length 256 \
+		--cache_data \
+		--do_predict \
+		--do_lower_case \
+		--eval_batch_size 2 \
+		--log_file $log \
+        --progress_bar
@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# example for running batch prediction with several workers (e.g., one per GPU, or one per node as slurm jobs)
+# all workers must share data_dir and pred_dir (e.g., on NFS); see run_batch_prediction.sh for the batch data layout
+# each worker claims batch_* dirs via lease files in $pred_dir/batch_leases and renews them while predicting;
+# batches of a worker without heartbeat for --lease_timeout seconds are reclaimed by the others
+# the worker finishing last merges all predictions into $final_brat_output_with_NER_RE;
+# to merge again (e.g., the merging worker was killed) add --merge_only
+
+model_type=bert
+data_format_mode=0
+max_seq_length=512
+data_file_has_header=True
+tag_for_non_relation=NonRel
+mode=bin # binary tags pos/neg
+binary_type_mapping_file=./data/mappings.json
+relation_extraction_model=./model
+data_dir=./data/batch_data
+pred_dir=./data/predict_batch
+brat_entity_dir=./data/results_from_NER
+final_brat_output_with_NER_RE=./data/final
+num_workers=2
+
+for ((i=0; i<num_workers; i++))
+do
+  CUDA_VISIBLE_DEVICES=$i python ./src/batch_prediction.py \
+    --model_type $model_type \
+    --data_format_mode $data_format_mode \
+    --new_model_dir $relation_extraction_model \
+    --predict_output_dir $pred_dir \
+    --max_seq_length $max_seq_length \
+    --data_file_header $data_file_has_header \
+    --do_lower_case \
+    --eval_batch_size 32 \
+    --log_file ./log_worker_$i.txt \
+    --log_lvl i \
+    --num_core 4 \
+    --pipeline_depth 1 \
+    --work_queue \
+    --worker_id worker_$i \
+    --lease_timeout 600 \
+    --non_relation_label $tag_for_non_relation \
+    --classification_mode $mode \
+    --type_map $binary_type_mapping_file \
+    --entity_data_dir $brat_entity_dir \
+    --brat_result_output_dir $final_brat_output_with_NER_RE &
+done
+wait
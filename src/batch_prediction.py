@@ -10,22 +10,66 @@ See /data_processing/preprocessing_batch.ipynb for how to prepare input data
 
 
 import argparse
+import copy
 import distutils
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import torch
 from utils import TransformerLogger
 from task import TaskRunner
 from pathlib import Path
-from data_processing.io_utils import save_text
+from data_processing.io_utils import save_text_atomic, load_json, file_sha256, save_json_atomic
 import traceback
 import warnings
 from data_utils import (features2tensors, relation_extraction_data_loader,
                         batch_to_model_input, RelationDataFormatSepProcessor,
                         RelationDataFormatUniProcessor)
-from data_processing.post_processing import app as post_processing
+from data_processing.post_processing import combine_results, RelationCollector
+from data_processing.data_format_conf import NON_RELATION_TAG
+from data_utils import glue_convert_examples_to_features as convert_examples_to_relation_extraction_features
+
+
+# marks the end of a pipeline queue
+_PIPELINE_END = None
+# args that change the predictions; a manifest from a run with other values (or another checkpoint) is not reused
+MANIFEST_RUN_ARGS = ("model_type", "data_format_mode", "new_model_dir", "max_seq_length", "do_lower_case",
+                     "non_relation_label")
+# tokenizer and settings of a feature worker process, set once by _init_feature_worker
+_feature_worker_kwargs = {}
+
+
+def checkpoint_run_args(ckpt_dir):
+    """
+        the resolved checkpoint dir with the size and mtime of each of its files (weights, tokenizer, labels),
+        so the predictions of a checkpoint retrained or replaced in the same dir are not reused;
+        stat instead of sha256 since the weights can be several GB
+    """
+    ckpt_dir = Path(ckpt_dir).resolve()
+    files = {}
+    for f in sorted(ckpt_dir.iterdir()):
+        if f.is_file():
+            stat = f.stat()
+            files[f.name] = [stat.st_size, stat.st_mtime_ns]
+    return {"ckpt_dir": str(ckpt_dir), "files": files}
+
+
+def _init_feature_worker(tokenizer, max_length, label_list):
+    _feature_worker_kwargs.update(
+        tokenizer=tokenizer, max_length=max_length, label_list=label_list, output_mode="classification")
+
+
+def _convert_features(examples):
+    return convert_examples_to_relation_extraction_features(examples, **_feature_worker_kwargs)
 
 
 class BatchRunner(TaskRunner):
+    feature_executor = None
+
     def task_runner_batch_init(self):
         # set up data processor
         if self.args.data_format_mode == 0:
@@ -39,11 +83,399 @@ class BatchRunner(TaskRunner):
                                       .format(self.args.data_format_mode))
 
         self._init_trained_model()
+        self.data_processor.set_data_dir(self.args.data_dir)
+        self.data_processor.set_header(self.args.data_file_header)
         self.data_processor.set_tokenizer(self.tokenizer)
         self.data_processor.set_tokenizer_type(self.args.model_type)
 
+    def _get_feature_executor(self):
+        """
+            tokenization is python code holding the GIL, so with num_core > 1 it runs in worker processes
+            (each gets the tokenizer once) instead of competing with inference in the producer thread
+        """
+        if self.feature_executor is None and self.args.num_core > 1:
+            self.feature_executor = ProcessPoolExecutor(
+                max_workers=self.args.num_core, initializer=_init_feature_worker,
+                initargs=(self.tokenizer, self.args.max_seq_length, self.label2idx))
+        return self.feature_executor
+
+    def close(self):
+        if self.feature_executor is not None:
+            self.feature_executor.shutdown(cancel_futures=True)
+            self.feature_executor = None
+
+    def create_test_data_loader(self, batch_dir):
+        """
+            read and tokenize batch_dir/test.tsv into a data loader
+            it does not change the runner state so it can run in a producer thread during inference
+        """
+        # read the file as given; get_test_examples would look for it under data_dir
+        test_examples = self.data_processor.get_examples_from_lines(
+            self.data_processor._read_tsv(Path(batch_dir) / "test.tsv"), "test")
+        feature_executor = self._get_feature_executor()
+        if feature_executor is None or len(test_examples) < 2:
+            test_features = convert_examples_to_relation_extraction_features(
+                test_examples,
+                tokenizer=self.tokenizer,
+                max_length=self.args.max_seq_length,
+                label_list=self.label2idx,
+                output_mode="classification")
+        else:
+            # one chunk per process; map keeps the example order
+            chunk_size = -(-len(test_examples) // self.args.num_core)
+            test_features = []
+            for features in feature_executor.map(
+                    _convert_features,
+                    [test_examples[i:i + chunk_size] for i in range(0, len(test_examples), chunk_size)]):
+                test_features.extend(features)
+
+        return relation_extraction_data_loader(
+            test_features,
+            batch_size=self.args.eval_batch_size,
+            task="test", logger=self.args.logger,
+            binary_mode=self.args.use_binary_classification_mode,
+            max_tokens=self.args.eval_max_tokens)
+
+
+class BatchManifest:
+    """
+        record completed batches (test.tsv and prediction file sha256) in predict_output_dir/batch_manifest,
+        so a restarted run only predicts the batches that are unfinished or changed
+        each batch has its own record file so workers sharing predict_output_dir never overwrite each other
+    """
+    def __init__(self, manifest_dir, run_args, resume=False, logger=None):
+        self.manifest_dir = Path(manifest_dir)
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        self.run_args = run_args
+        self.resume = resume
+
+        if resume and logger:
+            records = [load_json(f) for f in self.manifest_dir.glob("*.json")]
+            num_reused = sum(1 for record in records if record.get("run_args") == run_args)
+            logger.info("resume from {} with {} completed batches".format(self.manifest_dir, num_reused))
+            if num_reused < len(records):
+                logger.warning("{} batches in {} are from a run with different arguments; predict them again"
+                               .format(len(records) - num_reused, self.manifest_dir))
+
+    def _record_file(self, batch_dir):
+        return self.manifest_dir / "{}.json".format(Path(batch_dir).name)
+
+    def is_completed(self, batch_dir, pred_file):
+        record_file = self._record_file(batch_dir)
+        if not self.resume or not record_file.is_file() or not Path(pred_file).is_file():
+            return False
+        record = load_json(record_file)
+        return record.get("run_args") == self.run_args \
+            and record["test_sha256"] == file_sha256(Path(batch_dir) / "test.tsv") \
+            and record["prediction_sha256"] == file_sha256(pred_file)
+
+    def complete(self, batch_dir, pred_file, test_sha256):
+        save_json_atomic({"run_args": self.run_args,
+                          "test_sha256": test_sha256,
+                          "prediction_file": Path(pred_file).name,
+                          "prediction_sha256": file_sha256(pred_file)},
+                         self._record_file(batch_dir))
+
+
+class BatchWorkQueue:
+    """
+        share the batch dirs between workers (processes on one or several nodes with a shared predict_output_dir)
+        a worker claims a batch by creating predict_output_dir/batch_leases/<batch>.lease (O_EXCL, atomic also on NFS)
+        and renews the lease mtime in a heartbeat thread while the batch is processed;
+        a lease not renewed for lease_timeout sec is from a dead worker and can be reclaimed by any other worker
+        a batch may be predicted twice if a slow worker loses its lease, which is harmless
+        as prediction and manifest files are written atomically
+    """
+    MERGE_LEASE = "merge"
+
+    def __init__(self, lease_dir, worker_id, lease_timeout=600, logger=None):
+        self.lease_dir = Path(lease_dir)
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self.logger = logger
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+        self._heartbeat.start()
+
+    def _lease_file(self, name):
+        return self.lease_dir / "{}.lease".format(name)
+
+    def _try_create(self, lease_file):
+        try:
+            fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write("{}\t{}".format(self.worker_id, time.time()))
+        return True
+
+    def _lease_age(self, lease_file):
+        """seconds since the last heartbeat, None if there is no such lease"""
+        try:
+            return time.time() - lease_file.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def claim(self, name):
+        lease_file = self._lease_file(name)
+        if not self._try_create(lease_file):
+            lease_age = self._lease_age(lease_file)
+            if lease_age is None:
+                # released in the meantime
+                return self.claim(name)
+            if lease_age <= self.lease_timeout:
+                return False
+            # only one worker at a time reclaims a lease (O_EXCL on the reclaim lock), and it checks the lease again
+            # under the lock, so a new lease created by an earlier reclaimer is never removed by a later one
+            reclaim_file = lease_file.with_suffix(".reclaim")
+            if not self._try_create(reclaim_file):
+                reclaim_age = self._lease_age(reclaim_file)
+                if reclaim_age is not None and reclaim_age > self.lease_timeout:
+                    # the reclaiming worker died, the next claim can reclaim
+                    self._remove(reclaim_file)
+                return False
+            try:
+                lease_age = self._lease_age(lease_file)
+                if lease_age is not None:
+                    if lease_age <= self.lease_timeout:
+                        return False
+                    self._remove(lease_file)
+                    if self.logger:
+                        self.logger.warning("reclaim {} (lease expired {:.0f} sec ago)".format(
+                            name, lease_age - self.lease_timeout))
+                if not self._try_create(lease_file):
+                    return False
+            finally:
+                self._remove(reclaim_file)
+        with self._lock:
+            self._held.add(name)
+        return True
+
+    @staticmethod
+    def _remove(lease_file):
+        try:
+            os.remove(lease_file)
+        except FileNotFoundError:
+            pass
+
+    def release(self, name):
+        with self._lock:
+            self._held.discard(name)
+        self._remove(self._lease_file(name))
+
+    def _renew_leases(self):
+        while not self._stop.wait(self.lease_timeout / 3):
+            with self._lock:
+                held = list(self._held)
+            for name in held:
+                try:
+                    os.utime(self._lease_file(name))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            held = list(self._held)
+        for name in held:
+            self.release(name)
+
+
+def _batch_order(batch_dir):
+    batch_id = batch_dir.stem.split("_")[1]
+    return (0, int(batch_id), "") if batch_id.isdigit() else (1, 0, batch_id)
+
+
+def iter_batch_dirs(data_dir):
+    # sorted by batch id so relation ids in the outputs are the same between (resumed) runs
+    batch_dirs = [d for d in Path(data_dir).iterdir() if d.is_dir() and d.name.startswith("batch")]
+    for each_batch_dir in sorted(batch_dirs, key=_batch_order):
+        yield each_batch_dir
+
+
+def batch_prediction_file(predict_output_dir, batch_dir):
+    batch_id = batch_dir.stem.split("_")[1]
+    return Path(predict_output_dir) / f"batch_{batch_id}_prediction.txt"
+
+
+def _produce_data_loaders(task_runner, batch_dirs, data_queue, manifest):
+    """
+        producer: prepare the data loader of the next batches while the current one is in inference
+        batches completed in a previous run are passed on without data loader
+    """
+    try:
+        for each_batch_dir in batch_dirs:
+            pred_file = batch_prediction_file(task_runner.args.predict_output_dir, each_batch_dir)
+            if manifest.is_completed(each_batch_dir, pred_file):
+                data_queue.put((each_batch_dir, None, None))
+                continue
+            test_sha256 = file_sha256(each_batch_dir / "test.tsv")
+            data_queue.put((each_batch_dir, test_sha256, task_runner.create_test_data_loader(each_batch_dir)))
+    except Exception as ex:
+        data_queue.put(ex)
+    data_queue.put(_PIPELINE_END)
+
+
+def _produce_claimed_data_loaders(task_runner, batch_dirs, data_queue, manifest, work_queue, poll_interval):
+    """
+        producer for work queue mode: only prepare the batches this worker claims
+        keep polling until every batch is completed by some worker, so batches of dead workers are reclaimed
+    """
+    completed = set()
+    try:
+        while True:
+            pending = []
+            for each_batch_dir in batch_dirs:
+                if each_batch_dir in completed:
+                    continue
+                pred_file = batch_prediction_file(task_runner.args.predict_output_dir, each_batch_dir)
+                if manifest.is_completed(each_batch_dir, pred_file):
+                    completed.add(each_batch_dir)
+                else:
+                    pending.append(each_batch_dir)
+            if not pending:
+                break
+
+            num_claimed = 0
+            for each_batch_dir in pending:
+                if not work_queue.claim(each_batch_dir.name):
+                    continue
+                pred_file = batch_prediction_file(task_runner.args.predict_output_dir, each_batch_dir)
+                if manifest.is_completed(each_batch_dir, pred_file):
+                    # another worker finished it between the check and the claim
+                    work_queue.release(each_batch_dir.name)
+                    continue
+                num_claimed += 1
+                test_sha256 = file_sha256(each_batch_dir / "test.tsv")
+                data_queue.put((each_batch_dir, test_sha256, task_runner.create_test_data_loader(each_batch_dir)))
+            if num_claimed == 0:
+                # the rest is claimed by other workers; wait for them to finish or for their leases to expire
+                time.sleep(poll_interval)
+    except Exception as ex:
+        data_queue.put(ex)
+    data_queue.put(_PIPELINE_END)
+
+
+def _write_outputs(gargs, output_queue, errors):
+    """
+        writer: align the predictions of previous batches to entity pairs and file ids,
+        then write each brat file once after the last batch
+    """
+    relation_collector = RelationCollector(max_records=gargs.max_records_in_memory, tmp_dir=gargs.tmp_dir)
+    while True:
+        item = output_queue.get()
+        if item is _PIPELINE_END:
+            break
+        if errors:
+            # keep draining the queue so the inference loop is never blocked
+            continue
+        each_batch_dir, pred_file = item
+        try:
+            pargs = copy.copy(gargs)
+            pargs.mode = gargs.classification_mode
+            pargs.neg_type = gargs.non_relation_label if gargs.non_relation_label else NON_RELATION_TAG
+            pargs.predict_result_file = [pred_file]
+            pargs.test_data_file = [each_batch_dir / "test.tsv"]
+            relation_collector.add(combine_results(pargs))
+        except Exception as ex:
+            errors.append(traceback.format_exc())
+
+    if errors:
+        return
+    try:
+        # output to files
+        gargs.logger.info("write {} relations in {} files to {}".format(
+            len(relation_collector), len(relation_collector.file_ids), gargs.brat_result_output_dir))
+        relation_collector.output(gargs.entity_data_dir, gargs.brat_result_output_dir)
+    except Exception as ex:
+        errors.append(traceback.format_exc())
+
+
+def merge_batch_predictions(gargs, batch_dirs):
+    """combine the prediction files of all batches (in batch id order) and write each brat file once"""
+    p_pred = Path(gargs.predict_output_dir)
+    output_queue = queue.Queue()
+    writer_errors = []
+    for each_batch_dir in batch_dirs:
+        pred_file = batch_prediction_file(p_pred, each_batch_dir)
+        if not pred_file.is_file():
+            raise RuntimeError("{} is not predicted yet (expect {})".format(each_batch_dir, pred_file))
+        output_queue.put((each_batch_dir, pred_file))
+    output_queue.put(_PIPELINE_END)
+    _write_outputs(gargs, output_queue, writer_errors)
+    if writer_errors:
+        gargs.logger.error("Post-processing error:\n{}".format(writer_errors[0]))
+        raise RuntimeError(writer_errors[0])
+
+
+def _run_work_queue_worker(gargs, task_runner, batch_dirs, manifest):
+    """
+        work queue mode: predict the claimed batches, then the worker finishing the last batch merges all outputs
+    """
+    work_queue = BatchWorkQueue(Path(gargs.predict_output_dir) / "batch_leases", gargs.worker_id,
+                                lease_timeout=gargs.lease_timeout, logger=gargs.logger)
+    data_queue = queue.Queue(maxsize=gargs.pipeline_depth)
+    producer = threading.Thread(
+        target=_produce_claimed_data_loaders,
+        args=(task_runner, batch_dirs, data_queue, manifest, work_queue, gargs.poll_interval),
+        daemon=True)
+    producer.start()
+
+    num_predicted = 0
+    try:
+        while True:
+            item = data_queue.get()
+            if item is _PIPELINE_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            each_batch_dir, test_sha256, test_data_loader = item
+            pred_file = batch_prediction_file(gargs.predict_output_dir, each_batch_dir)
+            task_runner.test_data_loader = test_data_loader
+            preds = task_runner.predict()
+            task_runner.test_data_loader = None
+
+            save_text_atomic("\n".join([str(pred) for pred in preds]), pred_file)
+            manifest.complete(each_batch_dir, pred_file, test_sha256)
+            work_queue.release(each_batch_dir.name)
+            num_predicted += 1
+            gargs.logger.info("worker {} predicted {}".format(gargs.worker_id, each_batch_dir))
+    except Exception as ex:
+        work_queue.close()
+        gargs.logger.error("Prediction error:\n{}".format(traceback.format_exc()))
+        raise RuntimeError(traceback.format_exc())
+
+    gargs.logger.info("worker {} predicted {} batches; all {} batches are completed".format(
+        gargs.worker_id, num_predicted, len(batch_dirs)))
+    # one worker at a time merges; the merged prediction checksums are recorded, so workers finishing later
+    # (or a rerun with the same predictions) do not merge again
+    if work_queue.claim(BatchWorkQueue.MERGE_LEASE):
+        try:
+            merge_record = Path(gargs.predict_output_dir) / "batch_merge.json"
+            pred_sha256 = {each_batch_dir.name: file_sha256(batch_prediction_file(gargs.predict_output_dir,
+                                                                                  each_batch_dir))
+                           for each_batch_dir in batch_dirs}
+            if merge_record.is_file() and load_json(merge_record) == pred_sha256:
+                gargs.logger.info("brat outputs are merged by another worker")
+            else:
+                gargs.logger.info("worker {} merges all batch predictions".format(gargs.worker_id))
+                merge_batch_predictions(gargs, batch_dirs)
+                save_json_atomic(pred_sha256, merge_record)
+        finally:
+            work_queue.release(BatchWorkQueue.MERGE_LEASE)
+            work_queue.close()
+    else:
+        work_queue.close()
+        gargs.logger.info("brat outputs are merged by another worker")
+
 
 def app(gargs):
+    if gargs.pipeline_depth < 1:
+        raise RuntimeError("pipeline_depth should be at least 1 but get {}".format(gargs.pipeline_depth))
     # make model type case in-sensitive
     gargs.model_type = gargs.model_type.lower()
     gargs.progress_bar = False
@@ -53,39 +485,85 @@ def app(gargs):
     gargs.do_predict = True
     gargs.use_binary_classification_mode = False
 
+    # predict_output_file must be a file, we will create parent dir automatically
+    p_pred = Path(gargs.predict_output_dir)
+    p_pred.mkdir(parents=True, exist_ok=True)
+    batch_dirs = list(iter_batch_dirs(gargs.data_dir))
+
+    if gargs.merge_only:
+        # e.g., the worker merging the outputs died; all batches must be predicted already
+        merge_batch_predictions(gargs, batch_dirs)
+        return
+
     task_runner = BatchRunner(gargs)
-    # no data loader init, we init data loader in reset function during the loop
+    # no data loader init, we init data loader for each batch in the producer thread
     task_runner.task_runner_batch_init()
+    gargs.logger.info("data loader info: {}".format(task_runner.data_processor))
 
-    for each_batch_dir in Path(gargs.data_dir).iterdir():
-        if not each_batch_dir.is_dir() or not each_batch_dir.name.startswith("batch"):
-            continue
-
-        batch_id = each_batch_dir.stem.split("_")[1]
+    run_args = {k: getattr(gargs, k) for k in MANIFEST_RUN_ARGS}
+    run_args["checkpoint"] = checkpoint_run_args(task_runner.trained_model_dir)
+    # workers must see the batches completed by the others, so work queue mode always resumes
+    manifest = BatchManifest(p_pred / "batch_manifest", run_args=run_args,
+                             resume=gargs.resume or gargs.work_queue, logger=gargs.logger)
 
+    if gargs.work_queue:
+        if not gargs.worker_id:
+            gargs.worker_id = "{}_{}".format(socket.gethostname(), os.getpid())
         try:
-            task_runner.reset_dataloader(each_batch_dir,
-                                         has_file_header=gargs.data_file_header,
-                                         max_len=gargs.max_seq_length)
-            gargs.logger.info("data loader info: {}".format(task_runner.data_processor))
-            preds = task_runner.predict()
-        except Exception as ex:
-            gargs.logger.error("Prediction error:\n{}".format(traceback.format_exc()))
-            raise RuntimeError(traceback.format_exc())
+            _run_work_queue_worker(gargs, task_runner, batch_dirs, manifest)
+        finally:
+            task_runner.close()
+        return
 
-        pred_res = "\n".join([str(pred) for pred in preds])
+    # pipeline: producer (batch k+1 features) -> inference (batch k) -> writer (batch k-1 relations)
+    # the queues are bounded so at most pipeline_depth batches wait at each stage
+    data_queue = queue.Queue(maxsize=gargs.pipeline_depth)
+    output_queue = queue.Queue(maxsize=gargs.pipeline_depth)
+    writer_errors = []
+    producer = threading.Thread(
+        target=_produce_data_loaders, args=(task_runner, batch_dirs, data_queue, manifest),
+        daemon=True)
+    writer = threading.Thread(target=_write_outputs, args=(gargs, output_queue, writer_errors), daemon=True)
+    producer.start()
+    writer.start()
 
-        # predict_output_file must be a file, we will create parent dir automatically
-        p_pred = Path(gargs.predict_output_dir)
-        p_pred.mkdir(parents=True, exist_ok=True)
-        save_text(pred_res, p_pred / f"batch_{batch_id}_prediction.txt")
+    try:
+        while True:
+            item = data_queue.get()
+            if item is _PIPELINE_END:
+                break
+            if isinstance(item, Exception):
+                raise item
 
-        # output to files
-        gargs.mode = gargs.classification_mode
-        gargs.neg_type = gargs.non_relation_label
-        gargs.predict_result_file = [p_pred / f"batch_{batch_id}_prediction.txt"]
-        gargs.test_data_file = [each_batch_dir / "test.tsv"]
-        post_processing(gargs)
+            each_batch_dir, test_sha256, test_data_loader = item
+            pred_file = batch_prediction_file(p_pred, each_batch_dir)
+            if test_data_loader is None:
+                gargs.logger.info("skip {} completed in a previous run".format(each_batch_dir))
+                output_queue.put((each_batch_dir, pred_file))
+                continue
+
+            task_runner.test_data_loader = test_data_loader
+            preds = task_runner.predict()
+            task_runner.test_data_loader = None
+
+            pred_res = "\n".join([str(pred) for pred in preds])
+            # atomic as in work queue mode, so an interrupted run never leaves a truncated prediction file
+            save_text_atomic(pred_res, pred_file)
+            manifest.complete(each_batch_dir, pred_file, test_sha256)
+            output_queue.put((each_batch_dir, pred_file))
+    except Exception as ex:
+        # the writer skips the brat outputs after an error, so a failed run never leaves incomplete .ann files
+        writer_errors.append(traceback.format_exc())
+        gargs.logger.error("Prediction error:\n{}".format(traceback.format_exc()))
+        raise RuntimeError(traceback.format_exc())
+    finally:
+        output_queue.put(_PIPELINE_END)
+        writer.join()
+        task_runner.close()
+
+    if writer_errors:
+        gargs.logger.error("Post-processing error:\n{}".format(writer_errors[0]))
+        raise RuntimeError(writer_errors[0])
 
 
 if __name__ == '__main__':
@@ -110,6 +588,32 @@ if __name__ == '__main__':
                         help="Set this flag if you are using an uncased model.")
     parser.add_argument("--eval_batch_size", default=32, type=int,
                         help="The batch size for eval.")
+    parser.add_argument("--eval_max_tokens", default=-1, type=int,
+                        help="if > 0, bound each batch by total tokens instead of eval_batch_size")
+    parser.add_argument("--resume", action='store_true',
+                        help="skip batches recorded as completed in predict_output_dir/batch_manifest "
+                             "(same test.tsv and prediction file checksums); only unfinished or changed batches "
+                             "are predicted")
+    parser.add_argument("--pipeline_depth", default=1, type=int,
+                        help="number of batch dirs prepared ahead of inference (and waiting for post-processing); "
+                             "tokenization, inference and post-processing of different batches overlap")
+    parser.add_argument("--max_records_in_memory", default=1000000, type=int,
+                        help="number of predicted relations kept in memory for the brat outputs; "
+                             "beyond that sorted runs are spilled to --tmp_dir and merged")
+    parser.add_argument("--tmp_dir", default=None, type=str,
+                        help="where to spill sorted runs of predicted relations; default is the system temp dir")
+    parser.add_argument("--work_queue", action='store_true',
+                        help="run as one of several workers (processes or nodes) sharing data_dir and "
+                             "predict_output_dir; each worker claims batches via lease files, batches of dead "
+                             "workers are reclaimed, and the last worker merges the brat outputs. Implies --resume")
+    parser.add_argument("--worker_id", default=None, type=str,
+                        help="worker name in lease files; default is hostname_pid")
+    parser.add_argument("--lease_timeout", default=600, type=float,
+                        help="seconds without heartbeat after which a claimed batch is reclaimed from its worker")
+    parser.add_argument("--poll_interval", default=10, type=float,
+                        help="seconds to wait before checking again for batches to reclaim in work queue mode")
+    parser.add_argument("--merge_only", action='store_true',
+                        help="only merge the batch prediction files in predict_output_dir into brat outputs")
     parser.add_argument("--log_file", default=None,
                         help="where to save the log information")
     parser.add_argument("--log_lvl", default="i", type=str,
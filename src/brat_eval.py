@@ -11,8 +11,17 @@ author: BugFace
 
 import argparse
 import glob
+import hashlib
 import os
+from bisect import bisect_left
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import accumulate, chain
+
+import numpy as np
+from utils import prf
+from data_processing.io_utils import pkl_load, pkl_save_atomic, file_sha256
 
 
 class ClinicalConcept(object):
@@ -75,6 +84,115 @@ class Relation(object):
                                     self.arg2.ttype)
 
 
+def parse_annotations(lines, path=''):
+    """Return a dictionary with all the annotations in the lines of a .ann file (path is only used in messages)."""
+    annotations = defaultdict(dict)
+    for line_num, line in enumerate(lines):
+        if line.strip().startswith('T'):
+            try:
+                tag_id, tag_m, tag_text = line.strip().split('\t')
+            except ValueError:
+                print(path, line)
+            if len(tag_m.split(' ')) == 3:
+                tag_type, tag_start, tag_end = tag_m.split(' ')
+            elif len(tag_m.split(' ')) == 4:
+                tag_type, tag_start, _, tag_end = tag_m.split(' ')
+            elif len(tag_m.split(' ')) == 5:
+                tag_type, tag_start, _, _, tag_end = tag_m.split(' ')
+            else:
+                print(path)
+                print(line)
+            tag_start, tag_end = int(tag_start), int(tag_end)
+            annotations['tags'][tag_id] = ClinicalConcept(tag_id, tag_start, tag_end, tag_type, tag_text)
+    for line_num, line in enumerate(lines):
+        if line.strip().startswith('R'):
+            rel_id, rel_m = line.strip().split('\t')
+            rel_type, rel_arg1, rel_arg2 = rel_m.split(' ')
+            rel_arg1 = rel_arg1.split(':')[1]
+            rel_arg2 = rel_arg2.split(':')[1]
+            arg1 = annotations['tags'][rel_arg1]
+            arg2 = annotations['tags'][rel_arg2]
+            annotations['relations'][rel_id] = Relation(rel_id, arg1, arg2, rel_type)
+    return annotations
+
+
+def compact_annotations(annotations):
+    """Return the tags and relations of parsed annotations as tuples (small to pickle and send between processes)."""
+    tags = [(t.tid, t.start, t.end, t.ttype, t.text) for t in annotations['tags'].values()]
+    relations = [(r.rid, r.arg1.tid, r.arg2.tid, r.rtype) for r in annotations['relations'].values()]
+    return tags, relations
+
+
+def _restore(cls, **attrs):
+    """Create an instance from attributes that were already normalized by its __init__."""
+    obj = cls.__new__(cls)
+    obj.__dict__.update(attrs)
+    return obj
+
+
+def expand_annotations(compact):
+    """Return the annotations (as parse_annotations) of compact_annotations."""
+    tags, relations = compact
+    annotations = defaultdict(dict)
+    annotations['tags'] = {tid: _restore(ClinicalConcept, tid=tid, start=start, end=end, text=text, ttype=ttype)
+                           for tid, start, end, ttype, text in tags}
+    annotations['relations'] = {rid: _restore(Relation, rid=rid, arg1=annotations['tags'][arg1],
+                                              arg2=annotations['tags'][arg2], rtype=rtype)
+                                for rid, arg1, arg2, rtype in relations}
+    return annotations
+
+
+def _parse_ann_file(path, with_sha256=False):
+    """Return the compact annotations of a .ann file, and its sha256 if with_sha256."""
+    with open(path) as annotation_file:
+        lines = annotation_file.readlines()
+    compact = compact_annotations(parse_annotations(lines, path))
+    return compact, file_sha256(path) if with_sha256 else None
+
+
+def load_annotations(folder, file_names, num_core=1, cache_file=None):
+    """
+    Return {file name: annotations} of the .ann files in a folder, parsed in num_core processes.
+
+    With cache_file, the compact annotations are stored with each file's mtime, size and sha256; a file is only
+    parsed again if its mtime or size changed and its sha256 differs.
+    """
+    cache = pkl_load(cache_file) if cache_file and os.path.isfile(cache_file) else dict()
+    compact, to_parse = dict(), []
+    for name in file_names:
+        path = os.path.join(folder, name)
+        stat = os.stat(path)
+        entry = cache.get(name)
+        if entry is not None and (entry[0], entry[1]) != (stat.st_mtime_ns, stat.st_size) \
+                and entry[2] == file_sha256(path):
+            entry = cache[name] = (stat.st_mtime_ns, stat.st_size) + entry[2:]
+        if entry is not None and (entry[0], entry[1]) == (stat.st_mtime_ns, stat.st_size):
+            compact[name] = entry[3]
+        else:
+            to_parse.append(name)
+
+    paths = [os.path.join(folder, name) for name in to_parse]
+    parse = partial(_parse_ann_file, with_sha256=cache_file is not None)
+    if num_core > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=num_core) as exe:
+            parsed = list(exe.map(parse, paths, chunksize=max(1, len(paths) // (num_core * 4))))
+    else:
+        parsed = [parse(path) for path in paths]
+
+    for name, path, (each_compact, sha256) in zip(to_parse, paths, parsed):
+        compact[name] = each_compact
+        if cache_file:
+            stat = os.stat(path)
+            cache[name] = (stat.st_mtime_ns, stat.st_size, sha256, each_compact)
+    if cache_file:
+        # drop the files removed from the folder
+        cache = {name: entry for name, entry in cache.items()
+                 if name in compact or os.path.isfile(os.path.join(folder, name))}
+        pkl_save_atomic(cache, cache_file)
+
+    return {name: expand_annotations(each_compact) for name, each_compact in compact.items()}
+
+
 class RecordTrack2(object):
     """Record for Track 2 class."""
 
@@ -84,6 +202,15 @@ class RecordTrack2(object):
         self.basename = os.path.basename(self.path)
         self.annotations = self._get_annotations()
 
+    @classmethod
+    def from_annotations(cls, file_path, annotations):
+        """Initialize with parsed annotations instead of reading the .ann file."""
+        record = cls.__new__(cls)
+        record.path = os.path.abspath(file_path)
+        record.basename = os.path.basename(record.path)
+        record.annotations = annotations
+        return record
+
     @property
     def tags(self):
         return self.annotations['tags']
@@ -94,36 +221,9 @@ class RecordTrack2(object):
 
     def _get_annotations(self):
         """Return a dictionary with all the annotations in the .ann file."""
-        annotations = defaultdict(dict)
         with open(self.path) as annotation_file:
             lines = annotation_file.readlines()
-            for line_num, line in enumerate(lines):
-                if line.strip().startswith('T'):
-                    try:
-                        tag_id, tag_m, tag_text = line.strip().split('\t')
-                    except ValueError:
-                        print(self.path, line)
-                    if len(tag_m.split(' ')) == 3:
-                        tag_type, tag_start, tag_end = tag_m.split(' ')
-                    elif len(tag_m.split(' ')) == 4:
-                        tag_type, tag_start, _, tag_end = tag_m.split(' ')
-                    elif len(tag_m.split(' ')) == 5:
-                        tag_type, tag_start, _, _, tag_end = tag_m.split(' ')
-                    else:
-                        print(self.path)
-                        print(line)
-                    tag_start, tag_end = int(tag_start), int(tag_end)
-                    annotations['tags'][tag_id] = ClinicalConcept(tag_id, tag_start, tag_end, tag_type, tag_text)
-            for line_num, line in enumerate(lines):
-                if line.strip().startswith('R'):
-                    rel_id, rel_m = line.strip().split('\t')
-                    rel_type, rel_arg1, rel_arg2 = rel_m.split(' ')
-                    rel_arg1 = rel_arg1.split(':')[1]
-                    rel_arg2 = rel_arg2.split(':')[1]
-                    arg1 = annotations['tags'][rel_arg1]
-                    arg2 = annotations['tags'][rel_arg2]
-                    annotations['relations'][rel_id] = Relation(rel_id, arg1, arg2, rel_type)
-        return annotations
+        return parse_annotations(lines, self.path)
 
     def _get_text(self):
         """Return the text in the corresponding txt file."""
@@ -201,6 +301,90 @@ class Measures(object):
         return (self.sensitivity() + self.specificity()) / 2
 
 
+class SpanIndex(object):
+    """Index of gold tags or relations to find the ones that may equal a system tag or relation."""
+
+    def __init__(self, items, key, span, mode='strict'):
+        """
+        key(item) must be equal for equal items (e.g., the tag type); span(item) is (start, end).
+
+        strict: hash of (key, start, end); lenient: items of each key sorted by start with the running max end.
+        """
+        assert mode in ('strict', 'lenient')
+        self.key = key
+        self.span = span
+        self.mode = mode
+        self.index = defaultdict(list)
+        for item in items:
+            if mode == 'strict':
+                self.index[(key(item),) + tuple(span(item))].append(item)
+            else:
+                self.index[key(item)].append(item)
+        if mode == 'lenient':
+            for k, group in self.index.items():
+                group.sort(key=lambda x: span(x)[0])
+                starts = [span(x)[0] for x in group]
+                max_ends = list(accumulate([span(x)[1] for x in group], max))
+                self.index[k] = (starts, max_ends, group)
+
+    def candidates(self, item):
+        """Return the indexed items with the same key whose span equals (strict) or overlaps (lenient) the item's."""
+        start, end = self.span(item)
+        if self.mode == 'strict':
+            return self.index.get((self.key(item), start, end), [])
+        if self.key(item) not in self.index:
+            return []
+        starts, max_ends, group = self.index[self.key(item)]
+        # items starting before the end; stop once none of the earlier ones ends after the start
+        found = []
+        idx = bisect_left(starts, end) - 1
+        while idx >= 0 and max_ends[idx] > start:
+            if self.span(group[idx])[1] > start:
+                found.append(group[idx])
+            idx -= 1
+        return found
+
+
+def tag_index(tags, mode='strict'):
+    return SpanIndex(tags, lambda t: t.ttype, lambda t: (t.start, t.end), mode)
+
+
+def relation_index(relations, mode='strict'):
+    return SpanIndex(relations, lambda r: (r.rtype, r.arg1.ttype, r.arg2.ttype),
+                     lambda r: (r.arg1.start, r.arg1.end), mode)
+
+
+def match_annotations(gol, sys, index, mode='strict'):
+    """
+    Return the system annotations kept after the pare down, whether each of them equals a gold one,
+    and the gold annotations equal to a kept system one.
+
+    pare down matches -- if multiple system tags overlap with only one gold standard tag, only keep one sys tag:
+    a system annotation is dropped if a gold annotation it equals was already matched by an earlier one.
+    index is the SpanIndex of gol.
+    """
+    gol_matched = set()
+    kept, is_tp, kept_gol_matched = [], [], set()
+    for s in sys:
+        matches = [g for g in index.candidates(s) if g.equals(s, mode)]
+        if not any(g in gol_matched for g in matches):
+            kept.append(s)
+            is_tp.append(bool(matches))
+            kept_gol_matched.update(matches)
+        gol_matched.update(matches)
+    return kept, is_tp, kept_gol_matched
+
+
+def print_errors(gol, kept, is_tp, gol_matched):
+    """Print the false positives and false negatives of match_annotations."""
+    for s, tp in zip(kept, is_tp):
+        if not tp:
+            print('FP: ' + str(s))
+    for g in gol:
+        if g not in gol_matched:
+            print('FN:' + str(g))
+
+
 class SingleEvaluator(object):
     """Evaluate two single files."""
 
@@ -217,79 +401,29 @@ class SingleEvaluator(object):
         if key:
             gol = [t for t in doc1.tags.values() if key == t.ttype]
             sys = [t for t in doc2.tags.values() if key == t.ttype]
-            sys_check = [t for t in doc2.tags.values() if key == t.ttype]
         else:
             gol = [t for t in doc1.tags.values()]
             sys = [t for t in doc2.tags.values()]
-            sys_check = [t for t in doc2.tags.values()]
-        #pare down matches -- if multiple system tags overlap with only one
-        #gold standard tag, only keep one sys tag
-        gol_matched = []
-        for s in sys:
-            for g in gol:
-                if g.equals(s, mode):
-                    if g not in gol_matched:
-                        gol_matched.append(g)
-                    else:
-                        if s in sys_check:
-                            sys_check.remove(s)
-
-        sys = sys_check
-        #now evaluate
-        self.scores['tags']['tp'] = len({s.tid for s in sys for g in gol if g.equals(s, mode)})
-        self.scores['tags']['fp'] = len({s.tid for s in sys}) - self.scores['tags']['tp']
-        self.scores['tags']['fn'] = len({g for g in gol}) - self.scores['tags']['tp']
-        self.scores['tags']['tn'] = 0
-
-        if verbose and track == 2:
-            tps = {s for s in sys for g in gol if g.equals(s, mode)}
-            fps = set(sys) - tps
-            fns = set()
-            for g in gol:
-                if not len([s for s in sys if s.equals(g, mode)]):
-                    fns.add(g)
-            for e in fps:
-                print('FP: ' + str(e))
-            for e in fns:
-                print('FN:' + str(e))
+        self._score('tags', gol, sys, tag_index(gol, mode), mode, verbose and track == 2)
+
         if track == 2:
             if key:
                 gol = [r for r in doc1.relations.values() if r.rtype == key]
                 sys = [r for r in doc2.relations.values() if r.rtype == key]
-                sys_check = [r for r in doc2.relations.values() if r.rtype == key]
             else:
                 gol = [r for r in doc1.relations.values()]
                 sys = [r for r in doc2.relations.values()]
-                sys_check = [r for r in doc2.relations.values()]
-
-            #pare down matches -- if multiple system tags overlap with only one
-            #gold standard tag, only keep one sys tag
-            gol_matched = []
-            for s in sys:
-                for g in gol:
-                    if g.equals(s,mode):
-                        if g not in gol_matched:
-                            gol_matched.append(g)
-                        else:
-                            if s in sys_check:
-                                sys_check.remove(s)
-            sys = sys_check
-            #now evaluate
-            self.scores['relations']['tp'] = len({s for s in sys for g in gol if g.equals(s, mode)})
-            self.scores['relations']['fp'] = len({s for s in sys}) - self.scores['relations']['tp']
-            self.scores['relations']['fn'] = len({g for g in gol}) - self.scores['relations']['tp']
-            self.scores['relations']['tn'] = 0
-            if verbose:
-                tps = {s for s in sys for g in gol if g.equals(s, mode)}
-                fps = set(sys) - tps
-                fns = set()
-                for g in gol:
-                    if not len([s for s in sys if s.equals(g, mode)]):
-                        fns.add(g)
-                for e in fps:
-                    print('FP: ' + str(e))
-                for e in fns:
-                    print('FN:' + str(e))
+            self._score('relations', gol, sys, relation_index(gol, mode), mode, verbose)
+
+    def _score(self, target, gol, sys, index, mode, verbose):
+        sys, is_tp, gol_matched = match_annotations(gol, sys, index, mode)
+        #now evaluate
+        self.scores[target]['tp'] = sum(is_tp)
+        self.scores[target]['fp'] = len(sys) - self.scores[target]['tp']
+        self.scores[target]['fn'] = len(gol) - self.scores[target]['tp']
+        self.scores[target]['tn'] = 0
+        if verbose:
+            print_errors(gol, sys, is_tp, gol_matched)
 
     def __str__(self):
         return str(self.__dict__)
@@ -360,13 +494,150 @@ class MultipleEvaluator(object):
         return str(self.__dict__)
 
 
-def evaluate(corpora, annotations, mode='strict', verbose=False):
+class CorpusEvaluator(object):
+    """
+    Evaluate two sets of files for all tag and relation types in one pass.
+
+    A system annotation can only equal a gold one of the same type, so matching all types at once and counting per
+    type gives the same numbers as a MultipleEvaluator per type. The counts are kept per document:
+    counts[(mode, target)] is an array of (document, type, tp/fp/fn).
+
+    With cache_file, the counts of each document are stored with the sha256 of its gold and system files and reused
+    while both are unchanged, so a re-evaluation only matches the changed documents (not with verbose, which prints
+    the errors of all documents).
+    """
+
+    TP, FP, FN = 0, 1, 2
+
+    def __init__(self, corpora, modes=('strict', 'lenient'), verbose=False, cache_file=None,
+                 targets=('tags', 'relations')):
+        """Initialize."""
+        assert isinstance(corpora, Corpora)
+        self.num_docs = len(corpora.docs)
+        self.doc_names = [g.basename for g, _ in corpora.docs]
+        self.types = {'tags': sorted({t.ttype for doc in chain(*corpora.docs) for t in doc.tags.values()}),
+                      'relations': sorted({r.rtype for doc in chain(*corpora.docs) for r in doc.relations.values()})}
+        self.type2idx = {target: {t: idx for idx, t in enumerate(types)} for target, types in self.types.items()}
+        self.counts = {(mode, target): np.zeros((self.num_docs, len(self.types[target]), 3), dtype=np.int64)
+                       for mode in modes for target in targets}
+        self.num_cached_docs = 0
+
+        cache = pkl_load(cache_file) if cache_file and os.path.isfile(cache_file) else dict()
+        new_cache = dict()
+        for doc_idx, (g, s) in enumerate(corpora.docs):
+            if cache_file:
+                file_key = (file_sha256(g.path), file_sha256(s.path))
+                entry = cache.get(g.basename)
+                if not verbose and entry is not None and entry[0] == file_key \
+                        and all(key in entry[1] for key in self.counts):
+                    self._set_doc_counts(doc_idx, entry[1])
+                    new_cache[g.basename] = entry
+                    self.num_cached_docs += 1
+                    continue
+
+            for mode in modes:
+                if 'tags' in targets:
+                    gol, sys = list(g.tags.values()), list(s.tags.values())
+                    self._count(doc_idx, mode, 'tags', gol, sys, tag_index(gol, mode), lambda t: t.ttype, verbose)
+                if 'relations' in targets:
+                    gol, sys = list(g.relations.values()), list(s.relations.values())
+                    self._count(doc_idx, mode, 'relations', gol, sys, relation_index(gol, mode),
+                                lambda r: r.rtype, verbose)
+            if cache_file:
+                new_cache[g.basename] = (file_key, self._get_doc_counts(doc_idx))
+
+        if cache_file:
+            pkl_save_atomic(new_cache, cache_file)
+
+    def _get_doc_counts(self, doc_idx):
+        """{(mode, target): {type: (tp, fp, fn)}} of a document; types without annotations are left out"""
+        doc_counts = dict()
+        for key, counts in self.counts.items():
+            types = self.types[key[1]]
+            doc_counts[key] = {types[idx]: tuple(counts[doc_idx, idx].tolist())
+                               for idx in np.nonzero(counts[doc_idx].any(axis=1))[0].tolist()}
+        return doc_counts
+
+    def _set_doc_counts(self, doc_idx, doc_counts):
+        for key, counts in self.counts.items():
+            type2idx = self.type2idx[key[1]]
+            for type_name, type_counts in doc_counts[key].items():
+                counts[doc_idx, type2idx[type_name]] = type_counts
+
+    def _count(self, doc_idx, mode, target, gol, sys, index, get_type, verbose):
+        kept, is_tp, gol_matched = match_annotations(gol, sys, index, mode)
+        type2idx = self.type2idx[target]
+        num_types = len(type2idx)
+        kept_types = np.array([type2idx[get_type(x)] for x in kept], dtype=np.int64)
+        tp = np.bincount(kept_types[np.array(is_tp, dtype=bool)], minlength=num_types)
+        counts = self.counts[(mode, target)][doc_idx]
+        counts[:, self.TP] = tp
+        counts[:, self.FP] = np.bincount(kept_types, minlength=num_types) - tp
+        counts[:, self.FN] = np.bincount(np.array([type2idx[get_type(x)] for x in gol], dtype=np.int64),
+                                         minlength=num_types) - tp
+        if verbose:
+            print_errors(gol, kept, is_tp, gol_matched)
+
+    def type_counts(self, target, mode, types, doc_names=None):
+        """Return the counts array of (document, type, tp/fp/fn) of the given types and documents (default all)."""
+        counts = self.counts[(mode, target)]
+        if doc_names is not None:
+            doc2idx = {name: idx for idx, name in enumerate(self.doc_names)}
+            counts = counts[[doc2idx[name] for name in doc_names]]
+        type2idx = self.type2idx[target]
+        aligned = np.zeros((counts.shape[0], len(types), 3), dtype=np.int64)
+        for idx, type_name in enumerate(types):
+            if type_name in type2idx:
+                aligned[:, idx] = counts[:, type2idx[type_name]]
+        return aligned
+
+    def scores(self, target, mode='strict', type_name=None):
+        """Return tp, fp, fn and the micro and macro scores (as MultipleEvaluator.scores[target]) of one or all types."""
+        counts = self.counts[(mode, target)]
+        if type_name is None:
+            doc_counts = counts.sum(axis=1)
+        elif type_name in self.type2idx[target]:
+            doc_counts = counts[:, self.type2idx[target][type_name]]
+        else:
+            doc_counts = np.zeros((self.num_docs, 3), dtype=np.int64)
+
+        tp, fp, fn = [int(c) for c in doc_counts.sum(axis=0)]
+        scores = {'tp': tp, 'fp': fp, 'fn': fn, 'tn': 0,
+                  'micro': dict(zip(('precision', 'recall', 'f1'), prf(tp, fp, fn))),
+                  'macro': dict()}
+        doc_scores = prf(doc_counts[:, self.TP], doc_counts[:, self.FP], doc_counts[:, self.FN])
+        for key, values in zip(('precision', 'recall', 'f1'), doc_scores):
+            # summed in document order as MultipleEvaluator
+            scores['macro'][key] = sum(values.tolist()) / self.num_docs
+        return scores
+
+
+def evaluate(corpora, annotations, mode='strict', verbose=False, cache_file=None):
     """Run the evaluation by considering only files in the two folders."""
     assert mode in ('strict', 'lenient')
     # tags and relations annotated in gold standard
     gs_tags, gs_rels = annotations
-    evaluator_s = MultipleEvaluator(corpora, gs_tags, gs_rels, verbose=verbose)
-    evaluator_l = MultipleEvaluator(corpora, gs_tags, gs_rels, mode='lenient', verbose=verbose)
+    evaluator = CorpusEvaluator(corpora, verbose=verbose, cache_file=cache_file)
+    if cache_file:
+        print('{} of {} documents re-evaluated; the others are unchanged'.format(
+            evaluator.num_docs - evaluator.num_cached_docs, evaluator.num_docs))
+    row = '{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'
+
+    def _print_rows(target, types, type_format):
+        for t in types:
+            scores_s = evaluator.scores(target, 'strict', t)['micro']
+            scores_l = evaluator.scores(target, 'lenient', t)['micro']
+            print(row.format(type_format(t), scores_s['precision'], scores_s['recall'], scores_s['f1'],
+                             scores_l['precision'], scores_l['recall'], scores_l['f1']))
+        print('{:>20}  {:-^48}'.format('', ''))
+        scores_s = evaluator.scores(target, 'strict')
+        scores_l = evaluator.scores(target, 'lenient')
+        for average in ('micro', 'macro'):
+            print(row.format('Overall ({})'.format(average),
+                             scores_s[average]['precision'], scores_s[average]['recall'], scores_s[average]['f1'],
+                             scores_l[average]['precision'], scores_l[average]['recall'], scores_l[average]['f1']))
+        print()
+
     print('{:*^70}'.format(' Information Extraction Results '))
     print('{:20}  {:-^22}    {:-^22}'.format('', ' strict ', ' lenient '))
     print('{:20}  {:6}  {:6}  {:6}    {:6}  {:6}  {:6}'.format('', 'Prec.',
@@ -375,71 +646,108 @@ def evaluate(corpora, annotations, mode='strict', verbose=False):
                                                                'Prec.',
                                                                'Rec.',
                                                                'F(b=1)'))
-    for tag in evaluator_s.tags:
-        evaluator_tag_s = MultipleEvaluator(corpora, gs_tags, gs_rels, tag, verbose=verbose)
-        evaluator_tag_l = MultipleEvaluator(corpora, gs_tags, gs_rels, tag, mode='lenient', verbose=verbose)
-        print('{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'.format(
-            tag.capitalize(),
-            evaluator_tag_s.scores['tags']['micro']['precision'],
-            evaluator_tag_s.scores['tags']['micro']['recall'],
-            evaluator_tag_s.scores['tags']['micro']['f1'],
-            evaluator_tag_l.scores['tags']['micro']['precision'],
-            evaluator_tag_l.scores['tags']['micro']['recall'],
-            evaluator_tag_l.scores['tags']['micro']['f1']))
-    print('{:>20}  {:-^48}'.format('', ''))
-    print('{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'.format(
-        'Overall (micro)',
-        evaluator_s.scores['tags']['micro']['precision'],
-        evaluator_s.scores['tags']['micro']['recall'],
-        evaluator_s.scores['tags']['micro']['f1'],
-        evaluator_l.scores['tags']['micro']['precision'],
-        evaluator_l.scores['tags']['micro']['recall'],
-        evaluator_l.scores['tags']['micro']['f1']))
-    print('{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'.format(
-        'Overall (macro)',
-        evaluator_s.scores['tags']['macro']['precision'],
-        evaluator_s.scores['tags']['macro']['recall'],
-        evaluator_s.scores['tags']['macro']['f1'],
-        evaluator_l.scores['tags']['macro']['precision'],
-        evaluator_l.scores['tags']['macro']['recall'],
-        evaluator_l.scores['tags']['macro']['f1']))
-    print()
+    _print_rows('tags', gs_tags, lambda t: t.capitalize())
 
     print('{:*^70}'.format(' RELATIONS '))
-    for rel in evaluator_s.relations:
-        evaluator_tag_s = MultipleEvaluator(corpora, gs_tags, gs_rels, rel, mode='strict', verbose=verbose)
-        evaluator_tag_l = MultipleEvaluator(corpora, gs_tags, gs_rels, rel, mode='lenient', verbose=verbose)
-        print('{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'.format(
-            rel,
-            evaluator_tag_s.scores['relations']['micro']['precision'],
-            evaluator_tag_s.scores['relations']['micro']['recall'],
-            evaluator_tag_s.scores['relations']['micro']['f1'],
-            evaluator_tag_l.scores['relations']['micro']['precision'],
-            evaluator_tag_l.scores['relations']['micro']['recall'],
-            evaluator_tag_l.scores['relations']['micro']['f1']))
-    print('{:>20}  {:-^48}'.format('', ''))
-    print('{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'.format(
-        'Overall (micro)',
-        evaluator_s.scores['relations']['micro']['precision'],
-        evaluator_s.scores['relations']['micro']['recall'],
-        evaluator_s.scores['relations']['micro']['f1'],
-        evaluator_l.scores['relations']['micro']['precision'],
-        evaluator_l.scores['relations']['micro']['recall'],
-        evaluator_l.scores['relations']['micro']['f1']))
-    print('{:>20}  {:<5.4f}  {:<5.4f}  {:<5.4f}    {:<5.4f}  {:<5.4f}  {:<5.4f}'.format(
-        'Overall (macro)',
-        evaluator_s.scores['relations']['macro']['precision'],
-        evaluator_s.scores['relations']['macro']['recall'],
-        evaluator_s.scores['relations']['macro']['f1'],
-        evaluator_l.scores['relations']['macro']['precision'],
-        evaluator_l.scores['relations']['macro']['recall'],
-        evaluator_l.scores['relations']['macro']['f1']))
-    print()
+    _print_rows('relations', gs_rels, lambda t: t)
     print('{:20}{:^48}'.format('', '  {} files found  '.format(len(corpora.docs))))
+    return evaluator
+
+
+def bootstrap_weights(num_docs, num_samples, rng):
+    """Return how many times each document is drawn in each of num_samples resamples (sample x document)."""
+    draws = rng.integers(0, num_docs, size=(num_samples, num_docs))
+    draws += np.arange(num_samples)[:, None] * num_docs
+    return np.bincount(draws.reshape(-1), minlength=num_samples * num_docs).reshape(num_samples, num_docs)
+
+
+def bootstrap_f1(doc_counts, num_samples=1000, seed=None, chunk_size=500):
+    """
+    Return the micro f1 of documents resampled with replacement, as an array of (system, sample, type).
+
+    doc_counts are (document, type, tp/fp/fn) arrays of one or more systems over the same documents and types.
+    All systems use the same resamples, so their differences are paired. A resample is a weighted sum of the
+    document counts (one matrix product per chunk of samples); the documents are never re-evaluated.
+    """
+    rng = np.random.default_rng(seed)
+    num_docs, num_types, _ = doc_counts[0].shape
+    doc_counts = [counts.reshape(num_docs, -1).astype(np.float64) for counts in doc_counts]
+    f1 = np.zeros((len(doc_counts), num_samples, num_types))
+    for start in range(0, num_samples, chunk_size):
+        end = min(start + chunk_size, num_samples)
+        weights = bootstrap_weights(num_docs, end - start, rng).astype(np.float64)
+        for idx, counts in enumerate(doc_counts):
+            sample_counts = (weights @ counts).reshape(end - start, num_types, 3)
+            f1[idx, start:end] = prf(sample_counts[..., 0], sample_counts[..., 1], sample_counts[..., 2])[2]
+    return f1
+
+
+def evaluate_bootstrap(evaluator, types, baseline=None, target='relations', num_samples=1000, confidence=0.95,
+                       seed=None):
+    """
+    Print the bootstrap confidence intervals of the micro f1 of each type and of all types.
+
+    With a baseline (CorpusEvaluator of another system on the same gold files), also print the paired differences
+    (evaluator - baseline) with their intervals and the share of resamples in which the difference is <= 0.
+    Only the documents of both evaluators are resampled. As in the main report, the overall row counts all types of
+    each evaluator (also the ones not in types, e.g., predicted but not annotated).
+    """
+    evaluators = [evaluator] if baseline is None else [evaluator, baseline]
+    other_doc_names = [set(e.doc_names) for e in evaluators[1:]]
+    doc_names = [name for name in evaluator.doc_names if all(name in names for names in other_doc_names)]
+    lower, upper = 50 * (1 - confidence), 100 - 50 * (1 - confidence)
+    row_names = list(types) + ['Overall (micro)']
+
+    results = dict()
+    for mode in ('strict', 'lenient'):
+        doc_counts = []
+        for e in evaluators:
+            all_types = e.type_counts(target, mode, list(e.type2idx[target]), doc_names).sum(axis=1, keepdims=True)
+            doc_counts.append(np.concatenate([e.type_counts(target, mode, types, doc_names), all_types], axis=1))
+        totals = [counts.sum(axis=0) for counts in doc_counts]
+        f1 = [prf(t[:, 0], t[:, 1], t[:, 2])[2] for t in totals]
+        samples = bootstrap_f1(doc_counts, num_samples=num_samples, seed=seed)
+        results[mode] = (f1, samples)
+
+    print('{:*^70}'.format(' Bootstrap: {} resamples of {} files, {:.0%} CI of micro F1 '.format(
+        num_samples, len(doc_names), confidence)))
+    print('{:20}  {:-^22}    {:-^22}'.format('', ' strict ', ' lenient '))
+    row = '{:>20}  {:<6.4f} [{:<6.4f}, {:<6.4f}]    {:<6.4f} [{:<6.4f}, {:<6.4f}]'
+    for idx, name in enumerate(row_names):
+        values = []
+        for mode in ('strict', 'lenient'):
+            f1, samples = results[mode]
+            values += [f1[0][idx]] + np.percentile(samples[0, :, idx], [lower, upper]).tolist()
+        print(row.format(name, *values))
+    print()
+
+    if baseline is None:
+        return
+    print('{:*^70}'.format(' Paired bootstrap: F1 difference to the baseline '))
+    print('{:20}  {:-^30}  {:-^30}'.format('', ' strict ', ' lenient '))
+    print('{:20}  {:7}  {:13}  {:6}  {:7}  {:13}  {:6}'.format('', 'Diff.', 'CI', 'P(<=0)', 'Diff.', 'CI', 'P(<=0)'))
+    row = '{:>20}  {:<+7.4f}  [{:+.3f},{:+.3f}]  {:<6.4f}  {:<+7.4f}  [{:+.3f},{:+.3f}]  {:<6.4f}'
+    for idx, name in enumerate(row_names):
+        values = []
+        for mode in ('strict', 'lenient'):
+            f1, samples = results[mode]
+            diff = samples[0, :, idx] - samples[1, :, idx]
+            values += [f1[0][idx] - f1[1][idx]] + np.percentile(diff, [lower, upper]).tolist() + \
+                [float(np.mean(diff <= 0))]
+        print(row.format(name, *values))
+    print()
+
+
+def cache_file_path(cache_dir, prefix, *folders):
+    """Return the cache file of the folders in cache_dir."""
+    os.makedirs(cache_dir, exist_ok=True)
+    folder_key = hashlib.sha1('\0'.join([os.path.abspath(f) for f in folders]).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}_{}.pkl'.format(prefix, folder_key))
 
 
 class Corpora(object):
-    def __init__(self, folder1, folder2):
+    def __init__(self, folder1, folder2, num_core=1, cache_dir=None):
+        """the gold annotations (folder1) are cached in cache_dir if given; see load_annotations"""
         file_ext = '*.ann'
         self.folder1 = folder1
         self.folder2 = folder2
@@ -455,12 +763,25 @@ class Corpora(object):
             if files2 - common_files:
                 print('Files skipped in {}:'.format(self.folder2))
                 print(', '.join(sorted(list(files2 - common_files))))
+        common_files = sorted(common_files)
+        cache_file = cache_file_path(cache_dir, 'gold', folder1) if cache_dir else None
+        gold = load_annotations(folder1, common_files, num_core, cache_file)
+        system = load_annotations(folder2, common_files, num_core)
         self.docs = []
         for file in common_files:
-            g = RecordTrack2(os.path.join(self.folder1, file))
-            s = RecordTrack2(os.path.join(self.folder2, file))
+            g = RecordTrack2.from_annotations(os.path.join(self.folder1, file), gold[file])
+            s = RecordTrack2.from_annotations(os.path.join(self.folder2, file), system[file])
             self.docs.append((g, s))
 
+    @classmethod
+    def from_docs(cls, docs, folder1=None, folder2=None):
+        """Initialize with (gold, system) RecordTrack2 pairs instead of reading two folders."""
+        corpora = cls.__new__(cls)
+        corpora.folder1 = folder1
+        corpora.folder2 = folder2
+        corpora.docs = list(docs)
+        return corpora
+
     def get_annotations(self):
         gs_tags = set()
         gs_rels = set()
@@ -473,12 +794,80 @@ class Corpora(object):
         return sorted(gs_tags, key=lambda x: len(x)), sorted(gs_rels, key=lambda x: len(x))
 
 
-def eval_files(f1, f2, verbose=False):
+class BratScorer(object):
+    """
+    Score relation predictions against gold brat annotations in memory.
+
+    Same relation scores as writing the .ann files with post_processing.py and running this script on them: the
+    positive predictions of each note are added, in prediction order, to the entities of the note (entity_dir, the
+    gold dir by default; relations in the entity files are not used) and all notes in both dirs are evaluated.
+    """
+
+    def __init__(self, gold_dir, entity_dir=None, num_core=1, cache_dir=None):
+        """Initialize."""
+        self.gold_dir = gold_dir
+        self.entity_dir = entity_dir if entity_dir else gold_dir
+        file_names = set([os.path.basename(f) for f in glob.glob(os.path.join(gold_dir, '*.ann'))])
+        file_names &= set([os.path.basename(f) for f in glob.glob(os.path.join(self.entity_dir, '*.ann'))])
+        self.file_names = sorted(file_names)
+        cache_file = cache_file_path(cache_dir, 'gold', gold_dir) if cache_dir else None
+        gold = load_annotations(gold_dir, self.file_names, num_core, cache_file)
+        entities = gold if entity_dir is None else load_annotations(self.entity_dir, self.file_names, num_core)
+        self.gold_docs = {name[:-len('.ann')]: RecordTrack2.from_annotations(os.path.join(gold_dir, name), gold[name])
+                          for name in self.file_names}
+        self.entity_tags = {name[:-len('.ann')]: entities[name]['tags'] for name in self.file_names}
+
+    def corpora(self, preds, mappings, non_rel_label, type_map=None):
+        """
+        Return the Corpora of the gold notes and the predicted relations.
+
+        preds are the predicted labels (e.g., TaskRunner.predict) and mappings the last five tsv columns of each
+        candidate (entity1 type, entity2 type, entity1 id, entity2 id, file id). In bin mode (type_map), the relation
+        type of a positive prediction is the type_map value of its entity type pair.
+        """
+        assert len(preds) == len(mappings), \
+            "prediction results and mappings should have same amount data, but got preds: {} and maps: {}".format(
+                len(preds), len(mappings))
+        relations = defaultdict(dict)
+        for pred, (en_type_1, en_type_2, arg1, arg2, fid) in zip(preds, mappings):
+            if pred == non_rel_label or fid not in self.entity_tags:
+                continue
+            rel_type = type_map[(en_type_1, en_type_2)] if type_map is not None else pred
+            tags = self.entity_tags[fid]
+            rid = 'R{}'.format(len(relations[fid]) + 1)
+            relations[fid][rid] = Relation(rid, tags[arg1], tags[arg2], rel_type)
+
+        docs = []
+        for fid, g in self.gold_docs.items():
+            annotations = defaultdict(dict)
+            annotations['tags'] = self.entity_tags[fid]
+            annotations['relations'] = relations[fid]
+            docs.append((g, RecordTrack2.from_annotations(g.path, annotations)))
+        return Corpora.from_docs(docs, self.gold_dir)
+
+    def score(self, preds, mappings, non_rel_label, type_map=None, modes=('strict', 'lenient')):
+        """Return {mode: relation scores (tp, fp, fn, micro and macro as MultipleEvaluator.scores['relations'])}."""
+        evaluator = CorpusEvaluator(self.corpora(preds, mappings, non_rel_label, type_map), modes,
+                                    targets=('relations',))
+        return {mode: evaluator.scores('relations', mode) for mode in modes}
+
+
+def eval_files(f1, f2, verbose=False, num_core=1, cache_dir=None, bootstrap=0, baseline=None, confidence=0.95,
+               seed=None):
     """Where the magic begins."""
-    corpora = Corpora(f1, f2)
+    corpora = Corpora(f1, f2, num_core, cache_dir)
     annotations = corpora.get_annotations()
     if corpora.docs:
-        evaluate(corpora, annotations, verbose=verbose)
+        cache_file = cache_file_path(cache_dir, 'counts', f1, f2) if cache_dir else None
+        evaluator = evaluate(corpora, annotations, verbose=verbose, cache_file=cache_file)
+        if bootstrap > 0:
+            baseline_evaluator = None
+            if baseline:
+                baseline_cache_file = cache_file_path(cache_dir, 'counts', f1, baseline) if cache_dir else None
+                baseline_evaluator = CorpusEvaluator(Corpora(f1, baseline, num_core, cache_dir),
+                                                     cache_file=baseline_cache_file)
+            evaluate_bootstrap(evaluator, annotations[1], baseline_evaluator, num_samples=bootstrap,
+                               confidence=confidence, seed=seed)
 
 
 if __name__ == '__main__':
@@ -486,5 +875,18 @@ if __name__ == '__main__':
     parser.add_argument('--f1', help='First data folder path (gold)')
     parser.add_argument('--f2', help='Second data folder path (system)')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbosity')
+    parser.add_argument('--num_core', default=1, type=int, help='number of processes to parse the .ann files')
+    parser.add_argument('--cache_dir', default=None,
+                        help='where to cache the parsed gold annotations and the counts of each document; '
+                             'unchanged gold files are not parsed again and unchanged documents are not re-evaluated')
+    parser.add_argument('--bootstrap', default=0, type=int,
+                        help='number of document resamples for confidence intervals of the relation micro F1 '
+                             '(e.g., 1000); 0 means no bootstrap')
+    parser.add_argument('--baseline', default=None,
+                        help='folder of another system (brat) on the same gold files; with --bootstrap, the paired '
+                             'F1 differences of f2 to this system are reported')
+    parser.add_argument('--confidence', default=0.95, type=float, help='confidence level of the bootstrap intervals')
+    parser.add_argument('--seed', default=None, type=int, help='random seed of the bootstrap resamples')
     args = parser.parse_args()
-    eval_files(os.path.abspath(args.f1), os.path.abspath(args.f2), args.verbose)
+    eval_files(os.path.abspath(args.f1), os.path.abspath(args.f2), args.verbose, args.num_core, args.cache_dir,
+               args.bootstrap, os.path.abspath(args.baseline) if args.baseline else None, args.confidence, args.seed)
@@ -0,0 +1,223 @@
+# coding=utf-8
+
+"""
+End-to-end relation extraction from brat entity annotations to brat relation annotations in one process
+
+A production run with relation_extraction.py needs four on-disk hand-offs: candidate tsv, prediction text file,
+post_processing re-reading the tsv mappings and the final .ann files. Here the notes are processed in chunks:
+candidates (data_processing/candidate_generation.py) are created in a process pool and kept in memory, features
+are created from them directly, the predicted label ids are kept as an array, and the positive predictions are
+mapped to entity ids and collected (data_processing/post_processing.py RelationCollector) for the brat output.
+The candidate tsv and prediction files can still be written with --debug_dir (post_processing.py can read them).
+"""
+
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+from utils import TransformerLogger
+from batch_prediction import BatchRunner
+from data_utils import relation_extraction_data_loader
+from data_processing.io_utils import save_text, pkl_load
+from data_processing.candidate_generation import (create_note_candidate_records, load_valid_type_pairs,
+                                                  iter_batches, CandidateWriter)
+from data_processing.post_processing import RelationCollector, DEFAULT_MAX_RECORDS_IN_MEMORY
+from data_processing.data_format_conf import NON_RELATION_TAG
+from data_utils import glue_convert_examples_to_features as convert_examples_to_relation_extraction_features
+
+
+class PipelineRunner(BatchRunner):
+    def create_data_loader_from_candidates(self, candidate_columns):
+        """tokenize in-memory candidates (8 tsv columns each) into a data loader"""
+        test_examples = self.data_processor.get_examples_from_lines(candidate_columns, "test")
+        test_features = convert_examples_to_relation_extraction_features(
+            test_examples,
+            tokenizer=self.tokenizer,
+            max_length=self.args.max_seq_length,
+            label_list=self.label2idx,
+            output_mode="classification")
+
+        return relation_extraction_data_loader(
+            test_features,
+            batch_size=self.args.eval_batch_size,
+            task="test", logger=self.args.logger,
+            binary_mode=self.args.use_binary_classification_mode,
+            max_tokens=self.args.eval_max_tokens)
+
+    def predict_label_ids(self, data_loader):
+        """same as predict but return the label ids as an array"""
+        preds, _ = self._run_eval(data_loader)
+        return np.asarray(preds)
+
+    def predict_candidates(self, candidate_columns):
+        """label ids and label probabilities (float16) of in-memory candidates"""
+        return self._predict_probs(self.create_data_loader_from_candidates(candidate_columns))
+
+
+def positive_relations(candidate_columns, pred_ids, idx2label, neg_label_id, type_map=None):
+    """
+        (fid, relation type, arg1, arg2) of the candidates not predicted as neg_label_id
+        the relation type is the predicted label, or the type_map value of the entity type pair in bin mode
+    """
+    for idx in np.nonzero(pred_ids != neg_label_id)[0].tolist():
+        _, _, _, en_type_1, en_type_2, arg1, arg2, fid = candidate_columns[idx]
+        rel_type = type_map[(en_type_1, en_type_2)] if type_map is not None else idx2label[int(pred_ids[idx])]
+        yield fid, rel_type, arg1, arg2
+
+
+def save_debug_artifacts(debug_dir, chunk_id, candidates, preds):
+    """the candidate tsv and prediction file of a chunk, same as relation_extraction.py inputs and outputs"""
+    chunk_dir = Path(debug_dir) / "chunk_{}".format(chunk_id)
+    writer = CandidateWriter(chunk_dir, file_name="test.tsv")
+    try:
+        writer.write([(dist, "\t".join(columns)) for dist, columns in candidates])
+    finally:
+        writer.close()
+    save_text("\n".join(preds), chunk_dir / "prediction.txt")
+
+
+def init_pipeline(gargs):
+    """
+        set the prediction arguments and load the model once (shared with inference_server.py)
+        return the runner, the label id of non_relation_label, the bin mode type map (None in mul mode)
+        and the candidate generation arguments
+    """
+    # make model type case in-sensitive
+    gargs.model_type = gargs.model_type.lower()
+    gargs.progress_bar = False
+    gargs.cache_data = False
+    gargs.do_train = False
+    gargs.do_eval = False
+    gargs.do_predict = True
+    gargs.use_binary_classification_mode = False
+    gargs.data_file_header = True
+
+    if gargs.classification_mode not in ("mul", "bin"):
+        raise RuntimeError("expect classification_mode to be mul or bin but get {}".format(gargs.classification_mode))
+    if gargs.classification_mode == "bin" and not gargs.type_map:
+        raise RuntimeError("no type maps (entity-relation) provided. See help.")
+    type_map = pkl_load(gargs.type_map) if gargs.classification_mode == "bin" else None
+    type2idx, valid_type_pairs = load_valid_type_pairs(gargs.type_pairs, gargs.type_map)
+    candidate_kwargs = dict(type2idx=type2idx,
+                            valid_type_pairs=valid_type_pairs,
+                            max_sent_distance=gargs.max_sent_distance,
+                            split_on_newline=gargs.split_on_newline)
+
+    task_runner = PipelineRunner(gargs)
+    task_runner.task_runner_batch_init()
+    neg_label = gargs.non_relation_label if gargs.non_relation_label else NON_RELATION_TAG
+    if neg_label not in task_runner.label2idx:
+        raise RuntimeError("non_relation_label {} is not a model label ({})".format(
+            neg_label, sorted(task_runner.label2idx)))
+
+    return task_runner, task_runner.label2idx[neg_label], type_map, candidate_kwargs
+
+
+def app(gargs):
+    ann_files = sorted(Path(gargs.brat_data_dir).glob("*.ann"))
+    if not ann_files:
+        raise RuntimeError("no .ann files in {}".format(gargs.brat_data_dir))
+    gargs.data_dir = gargs.brat_data_dir
+    task_runner, neg_label_id, type_map, candidate_kwargs = init_pipeline(gargs)
+    create_candidates = partial(create_note_candidate_records, **candidate_kwargs)
+
+    relation_collector = RelationCollector(max_records=gargs.max_records_in_memory, tmp_dir=gargs.tmp_dir)
+    with ProcessPoolExecutor(max_workers=max(gargs.num_core, 1)) as exe:
+        for chunk_id, chunk_files in iter_batches(ann_files, gargs.notes_per_chunk):
+            candidates = []
+            for note_candidates in exe.map(create_candidates, chunk_files, chunksize=gargs.chunk_size):
+                candidates.extend(note_candidates)
+            gargs.logger.info("chunk {}: {} candidates from {} notes".format(
+                chunk_id, len(candidates), len(chunk_files)))
+            if not candidates:
+                continue
+
+            candidate_columns = [columns for _, columns in candidates]
+            data_loader = task_runner.create_data_loader_from_candidates(candidate_columns)
+            pred_ids = task_runner.predict_label_ids(data_loader)
+            relation_collector.add(positive_relations(
+                candidate_columns, pred_ids, task_runner.idx2label, neg_label_id, type_map=type_map))
+
+            if gargs.debug_dir:
+                save_debug_artifacts(gargs.debug_dir, chunk_id, candidates,
+                                     [task_runner.idx2label[int(pred_id)] for pred_id in pred_ids])
+
+    gargs.logger.info("write {} relations in {} files to {}".format(
+        len(relation_collector), len(relation_collector.file_ids), gargs.brat_result_output_dir))
+    relation_collector.output(gargs.brat_data_dir, gargs.brat_result_output_dir)
+
+
+def get_args_parser():
+    """model and candidate generation arguments, shared with inference_server.py"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", default='bert', type=str, required=True,
+                        help="valid values: bert, roberta, albert, xlnet, megatron, deberta, longformer")
+    parser.add_argument("--data_format_mode", default=0, type=int,
+                        help="valid values: 0: sep mode - [CLS]S1[SEP]S2[SEP]; 1: uni mode - [CLS]S1S2[SEP]")
+    parser.add_argument("--new_model_dir", type=str, required=True,
+                        help="directory of the trained model")
+    parser.add_argument("--ckpt_dir", type=str, default=None,
+                        help="checkpoint (LoRA adapter) dir of a trained llama model")
+    parser.add_argument("--pretrained_model", type=str, default=None,
+                        help="base model of a trained llama model")
+    parser.add_argument("--max_seq_length", default=512, type=int,
+                        help="maximum number of tokens allowed in each sentence")
+    parser.add_argument("--do_lower_case", action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--eval_batch_size", default=32, type=int,
+                        help="The batch size for eval.")
+    parser.add_argument("--eval_max_tokens", default=-1, type=int,
+                        help="if > 0, bound each batch by total tokens instead of eval_batch_size")
+    parser.add_argument("--non_relation_label", default="NonRel", type=str,
+                        help="The label used for representing "
+                             "candidate entity pairs that is not a true relation (negative sample)")
+    parser.add_argument("--classification_mode", type=str, default='mul', required=True,
+                        help="we have two mode for binary (bin) and multiple (mul) classes classification")
+    parser.add_argument("--type_map", type=str, default=None,
+                        help="a map of entity pair types to relation types (required when mode is bin); "
+                             "its entity type pairs are also valid candidate pairs")
+    parser.add_argument("--type_pairs", type=str, nargs='+', default=None,
+                        help="valid entity type pairs (entity1 type:entity2 type), e.g., Strength:Drug ADE:Drug")
+    parser.add_argument("--max_sent_distance", type=int, default=1,
+                        help="max number of sentences between the two entities of a candidate")
+    parser.add_argument("--split_on_newline", action='store_true',
+                        help="end a sentence at every new line (default: only at empty lines and ., !, ?)")
+    parser.add_argument("--num_core", default=1, type=int,
+                        help="how many processes used for candidate generation (and feature creation)")
+    parser.add_argument("--log_file", default=None,
+                        help="where to save the log information")
+    parser.add_argument("--log_lvl", default="i", type=str,
+                        help="d=DEBUG; i=INFO; w=WARNING; e=ERROR")
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_args_parser()
+    parser.add_argument("--brat_data_dir", type=str, required=True,
+                        help="notes (.txt) and their entities (.ann); the .ann files are copied into the output "
+                             "with the predicted relations")
+    parser.add_argument("--brat_result_output_dir", type=str, required=True,
+                        help="where to write the .ann files with entities and predicted relations")
+    parser.add_argument("--notes_per_chunk", default=1000, type=int,
+                        help="number of notes whose candidates and features are kept in memory at once")
+    parser.add_argument("--chunk_size", default=8, type=int,
+                        help="number of notes sent to a candidate generation process at once")
+    parser.add_argument("--max_records_in_memory", default=DEFAULT_MAX_RECORDS_IN_MEMORY, type=int,
+                        help="number of predicted relations kept in memory for the brat outputs; "
+                             "beyond that sorted runs are spilled to --tmp_dir and merged")
+    parser.add_argument("--tmp_dir", default=None, type=str,
+                        help="where to spill sorted runs of predicted relations; default is the system temp dir")
+    parser.add_argument("--debug_dir", default=None, type=str,
+                        help="if set, write the candidate tsv and predictions of each chunk as "
+                             "debug_dir/chunk_{id}/test.tsv and prediction.txt")
+    args = parser.parse_args()
+
+    # other setup
+    args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    args.logger = TransformerLogger(logger_file=args.log_file, logger_level=args.log_lvl).get_logger()
+    app(args)
@@ -1,11 +1,5 @@
-from transformers import (BertConfig, RobertaConfig, XLNetConfig, AlbertConfig, LongformerConfig,LlamaConfig, LlamaForSequenceClassification,
-                          BertTokenizer, RobertaTokenizer, XLNetTokenizer, AlbertTokenizer, LongformerTokenizer,
-                          DebertaConfig, DebertaTokenizer,LlamaTokenizer, MegatronBertConfig )
-from models import (LlamaForRelationIdentification,
-                    BertForRelationIdentification, RoBERTaForRelationIdentification,
-                    XLNetForRelationIdentification, AlbertForRelationIdentification,
-                    LongFormerForRelationIdentification, DebertaForRelationIdentification,
-                    MegatronForRelationIdentification)
+from collections.abc import MutableMapping
+from importlib import import_module
 
 
 EN1_START = "[s1]"
@@ -15,27 +9,82 @@ EN2_END = "[e2]"
 # keep the seq order
 SPEC_TAGS = [EN1_START, EN1_END, EN2_START, EN2_END]
 
+# processed examples cached in data_dir (--cache_data); model type, data format mode, max seq length, tokenizer
+# name and task (train, dev or test)
+CACHED_EXAMPLES_FILE = "cached_{}_{}_{}_{}_{}.pkl"
+
 MODEL_REQUIRE_SEGMENT_ID = {'llama','bert', 'xlnet', 'albert', 'deberta', 'megatron'}
 
-MODEL_DICT = {
-    "llama2":(LlamaForSequenceClassification, LlamaConfig, LlamaTokenizer),
-    "llama1":(LlamaForSequenceClassification, LlamaConfig, LlamaTokenizer),
-    "llama1_pre":(LlamaForSequenceClassification, LlamaConfig, LlamaTokenizer),
-    "llama2_pre":(LlamaForSequenceClassification, LlamaConfig, LlamaTokenizer),
-    "bert": (BertForRelationIdentification, BertConfig, BertTokenizer),
-    "megatron": (MegatronForRelationIdentification, MegatronBertConfig, BertTokenizer),
-    "roberta": (RoBERTaForRelationIdentification, RobertaConfig, RobertaTokenizer),
-    "xlnet": (XLNetForRelationIdentification, XLNetConfig, XLNetTokenizer),
-    "albert": (AlbertForRelationIdentification, AlbertConfig, AlbertTokenizer),
-    "longformer": (LongFormerForRelationIdentification, LongformerConfig, LongformerTokenizer),
-    "deberta": (DebertaForRelationIdentification, DebertaConfig, DebertaTokenizer)
+# model_type: (model class, config class, tokenizer class) as "module.ClassName"
+# classes are imported only when a model_type is requested, so importing config (e.g., via data_utils) is cheap
+LLAMA_CLASS_NAMES = ("transformers.LlamaForSequenceClassification", "transformers.LlamaConfig",
+                     "transformers.LlamaTokenizer")
+MODEL_CLASS_NAMES = {
+    "llama2": LLAMA_CLASS_NAMES,
+    "llama1": LLAMA_CLASS_NAMES,
+    "llama1_pre": LLAMA_CLASS_NAMES,
+    "llama2_pre": LLAMA_CLASS_NAMES,
+    "bert": ("models.BertForRelationIdentification", "transformers.BertConfig", "transformers.BertTokenizer"),
+    "megatron": ("models.MegatronForRelationIdentification", "transformers.MegatronBertConfig",
+                 "transformers.BertTokenizer"),
+    "roberta": ("models.RoBERTaForRelationIdentification", "transformers.RobertaConfig",
+                "transformers.RobertaTokenizer"),
+    "xlnet": ("models.XLNetForRelationIdentification", "transformers.XLNetConfig", "transformers.XLNetTokenizer"),
+    "albert": ("models.AlbertForRelationIdentification", "transformers.AlbertConfig", "transformers.AlbertTokenizer"),
+    "longformer": ("models.LongFormerForRelationIdentification", "transformers.LongformerConfig",
+                   "transformers.LongformerTokenizer"),
+    "deberta": ("models.DebertaForRelationIdentification", "transformers.DebertaConfig",
+                "transformers.DebertaTokenizer")
 }
 
+
+def import_class(name):
+    """the class of a "module.ClassName" string"""
+    module_name, class_name = name.rsplit(".", 1)
+    return getattr(import_module(module_name), class_name)
+
+
+class LazyModelDict(MutableMapping):
+    """
+        model_type -> (model class, config class, tokenizer class) like a dict, but the classes of a model_type
+        are imported on its first lookup; entries can still be set to classes (e.g., run_app.py)
+    """
+    def __init__(self, class_names):
+        self._class_names = dict(class_names)
+        self._classes = dict()
+
+    def __getitem__(self, model_type):
+        if model_type not in self._classes:
+            self._classes[model_type] = tuple(import_class(name) for name in self._class_names[model_type])
+        return self._classes[model_type]
+
+    def __setitem__(self, model_type, classes):
+        self._class_names[model_type] = None
+        self._classes[model_type] = tuple(classes)
+
+    def __delitem__(self, model_type):
+        del self._class_names[model_type]
+        self._classes.pop(model_type, None)
+
+    def __contains__(self, model_type):
+        return model_type in self._class_names
+
+    def __iter__(self):
+        return iter(self._class_names)
+
+    def __len__(self):
+        return len(self._class_names)
+
+
+MODEL_DICT = LazyModelDict(MODEL_CLASS_NAMES)
+
 TOKENIZER_USE_FOUR_SPECIAL_TOKs = {'roberta', 'longformer'}
 
 # change VERSION if any major updates
 VERSION = "0.1"
 CONFIG_VERSION_NAME = "REModelVersion"
+# written last in a serving bundle (see serving_bundle.py); a model dir with this file is loaded as a bundle
+SERVING_BUNDLE_FILE = "serving_bundle.json"
 
 # add new args associated to version
 NEW_ARGS = {"use_focal_loss": False,
@@ -0,0 +1,438 @@
+"""
+Candidate generation
+
+Using this script to create relation candidates (entity pairs) from brat formatted notes (.txt and .ann pairs)
+It replaces the preprocessing notebooks for production runs: no external sentence tokenizer is needed
+
+The .ann files are parsed with the same rules as brat_eval.RecordTrack2
+Each note is tokenized (words and punctuations; entity boundaries are always token boundaries) and split into
+sentences; all ordered entity pairs within max_sent_distance sentences and of a valid entity type pair are candidates
+
+The output is the 8-column tsv used by the data processors and post_processing:
+label  sent1 with [s1] entity1 [e1]  sent2 with [s2] entity2 [e2]  entity1 type  entity2 type  entity1 id  entity2 id  file id
+or, with --feature_store, the processed examples cached for TaskRunner (--cache_data), so no tsv is written and read;
+the last five columns (the mappings used by post-processing) are then written to {task}_mappings.tsv
+"""
+# import logger from upper level dir
+import os
+import sys
+from pathlib import Path
+
+# this dir and the upper level dir, so the module works as a script and as data_processing.candidate_generation
+sys.path.append(Path(os.path.abspath(__file__)).parent.as_posix())
+sys.path.append(Path(os.path.abspath(__file__)).parent.parent.as_posix())
+
+import argparse
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from utils import TransformerLogger
+import pickle
+from io_utils import pkl_load
+from data_format_conf import NON_RELATION_TAG, EN1_START, EN1_END, EN2_START, EN2_END, CANDIDATE_MAPPINGS_FILE
+from brat_eval import RecordTrack2
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+SENT_END_TOKENS = {".", "!", "?"}
+TSV_HEADER = "\t".join([str(i + 1) for i in range(8)])
+# the mappings file of the feature store has the last five columns of the tsv
+MAPPINGS_NUM_COLS = 5
+MAPPINGS_HEADER = "\t".join([str(i + 1) for i in range(8 - MAPPINGS_NUM_COLS, 8)])
+# number of candidates processed into examples at once by the feature store
+FEATURE_STORE_CHUNK_SIZE = 10000
+# label of positive candidates in bin mode (see preprocessing.ipynb DO_BIN)
+BIN_POS_TAG = "pos"
+
+
+def tokenize(text, boundaries=()):
+    """
+        return token start and end char offsets as two arrays
+        tokens are split at every boundary offset (e.g., entity start and end) inside them
+    """
+    spans = [(m.start(), m.end()) for m in TOKEN_PATTERN.finditer(text)]
+    boundaries = np.unique(np.asarray(boundaries, dtype=np.int64))
+    starts, ends = [], []
+    for s, e in spans:
+        cuts = boundaries[np.searchsorted(boundaries, s, side="right"):np.searchsorted(boundaries, e, side="left")]
+        for cut in cuts:
+            starts.append(s)
+            ends.append(int(cut))
+            s = int(cut)
+        starts.append(s)
+        ends.append(e)
+
+    return np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+
+
+def split_sentences(text, tok_starts, tok_ends, en_tok_starts, en_tok_ends, split_on_newline=False):
+    """
+        return the sentence id of each token
+        a sentence ends after ., ! or ? followed by a space, or at an empty line (any new line if split_on_newline);
+        sentences never split an entity
+    """
+    num_tokens = len(tok_starts)
+    if num_tokens == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    gaps = [text[e:s] for e, s in zip(tok_ends[:-1], tok_starts[1:])]
+    newline = "\n" if split_on_newline else "\n\n"
+    is_break = np.array([newline in re.sub(r"[^\n]", "", gap) for gap in gaps], dtype=bool)
+    is_end_token = np.array([text[s:e] in SENT_END_TOKENS for s, e in zip(tok_starts[:-1], tok_ends[:-1])],
+                            dtype=bool)
+    has_space = np.array([len(gap) > 0 for gap in gaps], dtype=bool)
+    is_break |= is_end_token & has_space
+
+    # no break between the first and last token of an entity
+    protected = np.zeros(num_tokens, dtype=np.int64)
+    np.add.at(protected, en_tok_starts, 1)
+    np.add.at(protected, en_tok_ends, -1)
+    is_break &= np.cumsum(protected)[:-1] == 0
+
+    return np.concatenate([[0], np.cumsum(is_break)])
+
+
+def enumerate_pairs(sent_ids, type_ids, valid_type_pairs, max_sent_distance):
+    """
+        vectorized enumeration of ordered entity pairs (i, j), i != j, in the same order as permutations
+        valid_type_pairs is a boolean matrix indexed by the type ids of entity i and j (None means all pairs)
+        return the entity indexes of both sides and the sentence distance of each pair
+    """
+    dist = np.abs(sent_ids[:, None] - sent_ids[None, :])
+    mask = dist <= max_sent_distance
+    if valid_type_pairs is not None:
+        mask &= valid_type_pairs[type_ids[:, None], type_ids[None, :]]
+    np.fill_diagonal(mask, False)
+    en1_idx, en2_idx = np.nonzero(mask)
+
+    return en1_idx, en2_idx, dist[en1_idx, en2_idx]
+
+
+def create_note_candidate_records(ann_file, **kwargs):
+    """
+        create the candidates of one note as (sentence distance, tsv columns) tuples
+        see create_candidate_records for the arguments
+    """
+    record = RecordTrack2(ann_file)
+    return create_candidate_records(record._get_text(), record.annotations, Path(ann_file).stem, **kwargs)
+
+
+def create_candidate_records(text, annotations, fid, type2idx=None, valid_type_pairs=None, max_sent_distance=1,
+                             label_mode="test", split_on_newline=False):
+    """
+        create the candidates of a note text and its annotations (brat_eval.parse_annotations)
+        label_mode: test - all NonRel; mul - gold relation type or NonRel; bin - pos or NonRel
+    """
+    tags = list(annotations['tags'].values())
+    if len(tags) < 2:
+        return []
+    en_starts = np.array([tag.start for tag in tags], dtype=np.int64)
+    en_ends = np.array([tag.end for tag in tags], dtype=np.int64)
+
+    tok_starts, tok_ends = tokenize(text, boundaries=np.concatenate([en_starts, en_ends]))
+    if len(tok_starts) == 0:
+        return []
+    # first token starting in the entity and last token ending in the entity
+    en_tok_starts = np.searchsorted(tok_starts, en_starts, side="left")
+    en_tok_ends = np.searchsorted(tok_ends, en_ends, side="right") - 1
+    has_token = en_tok_starts <= en_tok_ends
+    en_tok_starts = np.where(has_token, en_tok_starts, 0)
+    en_tok_ends = np.where(has_token, en_tok_ends, 0)
+
+    sent_of_token = split_sentences(text, tok_starts, tok_ends, en_tok_starts[has_token], en_tok_ends[has_token],
+                                    split_on_newline=split_on_newline)
+    sent_bounds = np.searchsorted(sent_of_token, np.arange(sent_of_token[-1] + 2), side="left")
+    # entities without any token (e.g., only spaces) are never paired
+    sent_ids = np.where(has_token, sent_of_token[en_tok_starts], -2 * max_sent_distance - 2)
+
+    if type2idx is None:
+        type_ids = None
+    else:
+        # types not in any valid pair get the last (all False) row
+        type_ids = np.array([type2idx.get(tag.ttype, len(type2idx)) for tag in tags], dtype=np.int64)
+    en1_idx, en2_idx, dists = enumerate_pairs(sent_ids, type_ids, valid_type_pairs, max_sent_distance)
+    if not has_token.all():
+        valid = has_token[en1_idx] & has_token[en2_idx]
+        en1_idx, en2_idx, dists = en1_idx[valid], en2_idx[valid], dists[valid]
+
+    gold = dict()
+    if label_mode != "test":
+        for rel in annotations['relations'].values():
+            gold[(rel.arg1.tid, rel.arg2.tid)] = rel.rtype if label_mode == "mul" else BIN_POS_TAG
+
+    # each entity sentence is formatted once per argument position and shared by all its pairs
+    tokens = [text[s:e] for s, e in zip(tok_starts, tok_ends)]
+    marked_sents = dict()
+
+    def _marked_sent(idx, spec_start, spec_end):
+        key = (idx, spec_start)
+        if key not in marked_sents:
+            sent_id = sent_ids[idx]
+            b, e = sent_bounds[sent_id], sent_bounds[sent_id + 1]
+            ts, te = en_tok_starts[idx], en_tok_ends[idx] + 1
+            marked_sents[key] = " ".join(
+                tokens[b:ts] + [spec_start] + tokens[ts:te] + [spec_end] + tokens[te:e])
+        return marked_sents[key]
+
+    candidates = []
+    for i, j, dist in zip(en1_idx.tolist(), en2_idx.tolist(), dists.tolist()):
+        tag1, tag2 = tags[i], tags[j]
+        label = gold.get((tag1.tid, tag2.tid), NON_RELATION_TAG)
+        columns = [label, _marked_sent(i, EN1_START, EN1_END), _marked_sent(j, EN2_START, EN2_END),
+                   tag1.ttype, tag2.ttype, tag1.tid, tag2.tid, fid]
+        candidates.append((dist, columns))
+
+    return candidates
+
+
+def create_note_candidates(ann_file, **kwargs):
+    """same as create_note_candidate_records but as (sentence distance, tsv line) tuples"""
+    return [(dist, "\t".join(columns)) for dist, columns in create_note_candidate_records(ann_file, **kwargs)]
+
+
+def load_valid_type_pairs(type_pairs=None, type_map=None):
+    """
+        valid entity type pairs from --type_pairs (Drug:ADE ...) and/or --type_map (keys of the bin mode mapping pkl)
+        return the type to index dict and the boolean pair matrix, or (None, None) if no filter is given
+    """
+    pairs = set()
+    if type_pairs:
+        for each in type_pairs:
+            en1_type, en2_type = each.split(":")
+            pairs.add((en1_type, en2_type))
+    if type_map:
+        pairs.update(pkl_load(type_map).keys())
+    if not pairs:
+        return None, None
+
+    type2idx = {t: idx for idx, t in enumerate(sorted({t for pair in pairs for t in pair}))}
+    # one extra row and column for the types not in any pair
+    valid_type_pairs = np.zeros((len(type2idx) + 1, len(type2idx) + 1), dtype=bool)
+    for en1_type, en2_type in pairs:
+        valid_type_pairs[type2idx[en1_type], type2idx[en2_type]] = True
+
+    return type2idx, valid_type_pairs
+
+
+class CandidateWriter:
+    """write candidates into output_dir/file_name, or output_dir/cutoff_{distance}/file_name if split_by_distance"""
+    def __init__(self, output_dir, file_name="test.tsv", split_by_distance=False, max_sent_distance=1,
+                 header=TSV_HEADER):
+        self.output_dir = Path(output_dir)
+        self.split_by_distance = split_by_distance
+        self.num_candidates = 0
+        self.files = dict()
+
+        for key in self._keys(max_sent_distance):
+            ofn = self._output_file(key, file_name)
+            ofn.parent.mkdir(parents=True, exist_ok=True)
+            self.files[key] = open(ofn, "w")
+            self.files[key].write("{}\n".format(header))
+
+    def _keys(self, max_sent_distance):
+        return range(max_sent_distance + 1) if self.split_by_distance else [None]
+
+    def _key(self, dist):
+        return dist if self.split_by_distance else None
+
+    def _output_file(self, key, file_name):
+        return self.output_dir / "cutoff_{}".format(key) / file_name if self.split_by_distance \
+            else self.output_dir / file_name
+
+    def write(self, candidates):
+        for dist, line in candidates:
+            f = self.files[self._key(dist)]
+            f.write(line)
+            f.write("\n")
+        self.num_candidates += len(candidates)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+class FeatureStoreWriter(CandidateWriter):
+    """
+        write candidates as the processed (tokenizer truncated) examples that TaskRunner loads with --cache_data:
+        output_dir/cached_{model type}_{data format mode}_{max seq length}_{tokenizer name}_{task}.pkl
+        and their mapping columns (entity types, entity ids, file id) as output_dir/{task}_mappings.tsv
+        every chunk_size candidates are processed and appended to the cache file as a pickled list of examples
+        (see io_utils.pkl_load_chunks), so only one chunk is kept in memory
+    """
+    def __init__(self, output_dir, data_processor, cache_file_name, task="test", split_by_distance=False,
+                 max_sent_distance=1, chunk_size=FEATURE_STORE_CHUNK_SIZE):
+        super().__init__(output_dir, file_name=CANDIDATE_MAPPINGS_FILE.format(task),
+                         split_by_distance=split_by_distance, max_sent_distance=max_sent_distance,
+                         header=MAPPINGS_HEADER)
+        self.data_processor = data_processor
+        self.task = task
+        self.chunk_size = chunk_size
+        self.cache_files = {key: open(self._output_file(key, cache_file_name), "wb")
+                            for key in self._keys(max_sent_distance)}
+        self.chunks = {key: [] for key in self.cache_files}
+
+    def _flush(self, key):
+        examples = self.data_processor.get_examples_from_lines(self.chunks[key], self.task)
+        pickle.dump(examples, self.cache_files[key], protocol=pickle.HIGHEST_PROTOCOL)
+        self.chunks[key] = []
+
+    def write(self, candidates):
+        mappings = []
+        for dist, line in candidates:
+            columns = line.split("\t")
+            key = self._key(dist)
+            self.chunks[key].append(columns)
+            if len(self.chunks[key]) >= self.chunk_size:
+                self._flush(key)
+            mappings.append((dist, "\t".join(columns[-MAPPINGS_NUM_COLS:])))
+        super().write(mappings)
+
+    def close(self):
+        try:
+            for key, f in self.cache_files.items():
+                # an empty list if there are no candidates, so the cache file is always loadable
+                if self.chunks[key] or f.tell() == 0:
+                    self._flush(key)
+        finally:
+            for f in self.cache_files.values():
+                f.close()
+            super().close()
+
+
+def init_feature_store(args):
+    """the data processor (with tokenizer) used by TaskRunner for the model, the task and its cache file name"""
+    from config import MODEL_CLASS_NAMES, SPEC_TAGS, CACHED_EXAMPLES_FILE, import_class
+    from data_utils import RelationDataFormatSepProcessor, RelationDataFormatUniProcessor
+
+    task = Path(args.output_file_name).stem
+    if task not in ("train", "dev", "test"):
+        raise RuntimeError("expect output_file_name to be train.tsv, dev.tsv or test.tsv with --feature_store "
+                           "but get {}".format(args.output_file_name))
+    if args.data_format_mode == 0:
+        data_processor = RelationDataFormatSepProcessor(max_seq_len=args.max_seq_length, num_core=args.num_core)
+    elif args.data_format_mode == 1:
+        data_processor = RelationDataFormatUniProcessor(max_seq_len=args.max_seq_length, num_core=args.num_core)
+    else:
+        raise NotImplementedError("Only support 0, 1 but get data_format_mode as {}".format(args.data_format_mode))
+
+    # the tokenizer as set up by TaskRunner, so the examples are truncated the same way
+    tokenizer_class = import_class(MODEL_CLASS_NAMES[args.model_type][2])
+    tokenizer = tokenizer_class.from_pretrained(args.tokenizer, do_lower_case=args.do_lower_case)
+    tokenizer.add_tokens(SPEC_TAGS)
+    data_processor.set_tokenizer(tokenizer)
+    data_processor.set_tokenizer_type(args.model_type)
+
+    return data_processor, task, CACHED_EXAMPLES_FILE.format(
+        args.model_type, args.data_format_mode, args.max_seq_length, tokenizer.name_or_path.split("/")[-1], task)
+
+
+def iter_batches(ann_files, files_per_batch):
+    if files_per_batch < 1:
+        yield None, ann_files
+        return
+    for batch_id, start in enumerate(range(0, len(ann_files), files_per_batch)):
+        yield batch_id, ann_files[start:start + files_per_batch]
+
+
+def app(args):
+    ann_files = sorted(Path(args.brat_data_dir).glob("*.ann"))
+    if not ann_files:
+        raise RuntimeError("no .ann files in {}".format(args.brat_data_dir))
+    if args.label_mode not in ("test", "mul", "bin"):
+        raise RuntimeError("expect label_mode to be test, mul or bin but get {}".format(args.label_mode))
+
+    type2idx, valid_type_pairs = load_valid_type_pairs(args.type_pairs, args.type_map)
+    args.logger.info("{} notes; max sentence distance: {}; valid entity type pairs: {}".format(
+        len(ann_files), args.max_sent_distance, "all" if type2idx is None else
+        [(t1, t2) for t1 in type2idx for t2 in type2idx if valid_type_pairs[type2idx[t1], type2idx[t2]]]))
+
+    create_candidates = partial(create_note_candidates,
+                                type2idx=type2idx,
+                                valid_type_pairs=valid_type_pairs,
+                                max_sent_distance=args.max_sent_distance,
+                                label_mode=args.label_mode,
+                                split_on_newline=args.split_on_newline)
+
+    if args.feature_store:
+        if not args.tokenizer:
+            raise RuntimeError("--feature_store needs the --tokenizer of the model")
+        data_processor, task, cache_file_name = init_feature_store(args)
+        args.logger.info("write processed examples to {}".format(cache_file_name))
+
+    with ProcessPoolExecutor(max_workers=max(args.num_core, 1)) as exe:
+        for batch_id, batch_files in iter_batches(ann_files, args.files_per_batch):
+            output_dir = Path(args.output_dir)
+            if batch_id is not None:
+                output_dir = output_dir / "batch_{}".format(batch_id)
+            if args.feature_store:
+                writer = FeatureStoreWriter(output_dir, data_processor, cache_file_name, task=task,
+                                            split_by_distance=args.split_by_distance,
+                                            max_sent_distance=args.max_sent_distance)
+            else:
+                writer = CandidateWriter(output_dir, file_name=args.output_file_name,
+                                         split_by_distance=args.split_by_distance,
+                                         max_sent_distance=args.max_sent_distance)
+            try:
+                # notes are processed in parallel but written in file order
+                for candidates in exe.map(create_candidates, batch_files, chunksize=args.chunk_size):
+                    writer.write(candidates)
+            finally:
+                writer.close()
+            args.logger.info("{} candidates from {} notes written to {}".format(
+                writer.num_candidates, len(batch_files), output_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--brat_data_dir", type=str, required=True,
+                        help="dir with the notes (.txt) and annotations (.ann; entities only for prediction)")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="where to write the candidate tsv file(s)")
+    parser.add_argument("--output_file_name", type=str, default="test.tsv",
+                        help="name of the tsv file (e.g., train.tsv, dev.tsv, test.tsv)")
+    parser.add_argument("--label_mode", type=str, default="test",
+                        help="test: all candidates labeled as NonRel; mul: gold relation types from .ann; "
+                             "bin: pos for gold relations (use with post_processing bin mode)")
+    parser.add_argument("--max_sent_distance", type=int, default=1,
+                        help="max number of sentences between the two entities of a candidate")
+    parser.add_argument("--type_pairs", type=str, nargs='+', default=None,
+                        help="valid entity type pairs (entity1 type:entity2 type), e.g., Strength:Drug ADE:Drug; "
+                             "if not set (and no --type_map), all entity pairs are candidates")
+    parser.add_argument("--type_map", type=str, default=None,
+                        help="the bin mode mapping pkl of entity pair types to relation types; "
+                             "its entity type pairs are valid pairs")
+    parser.add_argument("--split_on_newline", action='store_true',
+                        help="end a sentence at every new line (default: only at empty lines and ., !, ?)")
+    parser.add_argument("--split_by_distance", action='store_true',
+                        help="write candidates of each sentence distance to cutoff_{distance}/")
+    parser.add_argument("--files_per_batch", type=int, default=-1,
+                        help="if > 0, write every n notes into output_dir/batch_{id}/ for batch_prediction.py")
+    parser.add_argument("--num_core", default=1, type=int,
+                        help="how many processes used to create the candidates of the notes")
+    parser.add_argument("--chunk_size", default=8, type=int,
+                        help="number of notes sent to a process at once")
+    parser.add_argument("--feature_store", action='store_true',
+                        help="write the processed examples cached for TaskRunner (use with --cache_data and "
+                             "--data_dir set to output_dir) instead of the tsv; the task (train, dev or test) is "
+                             "the stem of --output_file_name. The candidate mappings for post-processing "
+                             "are written to <task>_mappings.tsv")
+    parser.add_argument("--model_type", default="bert", type=str,
+                        help="model type of the feature store (valid values as in relation_extraction.py)")
+    parser.add_argument("--tokenizer", default=None, type=str,
+                        help="the tokenizer of the feature store: --pretrained_model for training or the trained "
+                             "model (checkpoint) dir for prediction, as loaded by TaskRunner")
+    parser.add_argument("--data_format_mode", default=0, type=int,
+                        help="data format mode of the feature store; 0: sep mode, 1: uni mode")
+    parser.add_argument("--max_seq_length", default=512, type=int,
+                        help="maximum number of tokens of the feature store examples")
+    parser.add_argument("--do_lower_case", action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--log_file", default="./log.txt", type=str,
+                        help="where to save the log information")
+    pargs = parser.parse_args()
+
+    pargs.logger = TransformerLogger(logger_file=pargs.log_file,
+                                     logger_level='i').get_logger()
+
+    app(pargs)
@@ -4,4 +4,7 @@ EN1_START = "[s1]"
 EN1_END = "[e1]"
 EN2_START = "[s2]"
 EN2_END = "[e2]"
-SPEC_TAGS = [EN1_START, EN1_END, EN2_START, EN2_END]
\ No newline at end of file
+SPEC_TAGS = [EN1_START, EN1_END, EN2_START, EN2_END]
+# entity types, entity ids and file id of each candidate of a task (the last five tsv columns), written by
+# candidate_generation --feature_store in place of the {task}.tsv
+CANDIDATE_MAPPINGS_FILE = "{}_mappings.tsv"
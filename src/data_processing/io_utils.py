@@ -1,5 +1,8 @@
 import pickle as pkl
 import json
+import hashlib
+import os
+import numpy as np
 
 
 def load_text(ifn):
@@ -24,6 +27,18 @@ def pkl_load(file):
     return data
 
 
+def pkl_load_chunks(file):
+    """the concatenated lists pickled one after another into file; a file saved by pkl_save is a single chunk"""
+    data = []
+    with open(file, "rb") as f:
+        while True:
+            try:
+                data.extend(pkl.load(f))
+            except EOFError:
+                break
+    return data
+
+
 def load_json(file):
     with open(file, "r") as f:
         data = json.load(f)
@@ -33,3 +48,62 @@ def load_json(file):
 def save_json(data, file):
     with open(file, "w") as f:
         json.dump(data, f, indent=2)
+
+
+def file_sha256(file, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def save_json_atomic(data, file):
+    """write to a temp file then rename, so a crash never leaves a partial file"""
+    tmp_file = "{}.{}.tmp".format(file, os.getpid())
+    save_json(data, tmp_file)
+    os.replace(tmp_file, file)
+
+
+def save_text_atomic(text, file):
+    """same as save_json_atomic; concurrent writers of the same file never interleave"""
+    tmp_file = "{}.{}.tmp".format(file, os.getpid())
+    save_text(text, tmp_file)
+    os.replace(tmp_file, file)
+
+
+def pkl_save_atomic(data, file):
+    """same as save_json_atomic"""
+    tmp_file = "{}.{}.tmp".format(file, os.getpid())
+    pkl_save(data, tmp_file)
+    os.replace(tmp_file, file)
+
+
+def prediction_arrays_dir(predict_output_file):
+    """predictions.txt -> predictions_arrays/"""
+    head, tail = os.path.split(str(predict_output_file))
+    return os.path.join(head, "{}_arrays".format(os.path.splitext(tail)[0]))
+
+
+def save_prediction_arrays(pred_dir, label_ids, probs, labels, mappings=None):
+    """
+        binary predictions: label ids (int32), label probabilities (float16), the label table (label of each id)
+        and optionally the candidate mapping columns (entity types, entity ids and file id of each candidate)
+        all arrays are saved as .npy so they can be memory-mapped by load_prediction_arrays
+    """
+    os.makedirs(pred_dir, exist_ok=True)
+    np.save(os.path.join(pred_dir, "label_ids.npy"), np.asarray(label_ids, dtype=np.int32))
+    np.save(os.path.join(pred_dir, "probs.npy"), np.asarray(probs, dtype=np.float16))
+    save_json(list(labels), os.path.join(pred_dir, "labels.json"))
+    if mappings is not None:
+        np.save(os.path.join(pred_dir, "mappings.npy"), np.asarray(mappings, dtype=str))
+
+
+def load_prediction_arrays(pred_dir, mmap_mode="r"):
+    mappings_file = os.path.join(pred_dir, "mappings.npy")
+    return {
+        "label_ids": np.load(os.path.join(pred_dir, "label_ids.npy"), mmap_mode=mmap_mode),
+        "probs": np.load(os.path.join(pred_dir, "probs.npy"), mmap_mode=mmap_mode),
+        "labels": load_json(os.path.join(pred_dir, "labels.json")),
+        "mappings": np.load(mappings_file, mmap_mode=mmap_mode) if os.path.isfile(mappings_file) else None
+    }
@@ -13,135 +13,303 @@ import os
 import sys
 from pathlib import Path
 
+# this dir and the upper level dir, so the module works as a script and as data_processing.post_processing
+sys.path.append(Path(os.path.abspath(__file__)).parent.as_posix())
+sys.path.append(Path(os.path.abspath(__file__)).parent.parent.as_posix())
+
 import argparse
+import heapq
+import itertools
+import shutil
+import tempfile
 import numpy as np
 from utils import TransformerLogger
-from io_utils import load_text, save_text, pkl_load
-from collections import defaultdict
-from data_format_conf import NON_RELATION_TAG, BRAT_REL_TEMPLATE
+from io_utils import load_text, save_text, pkl_load, load_prediction_arrays
+from data_format_conf import NON_RELATION_TAG, BRAT_REL_TEMPLATE, CANDIDATE_MAPPINGS_FILE
 import traceback
 
 
-sys.path.append(Path(os.path.abspath(__file__)).parent.parent.as_posix())
+# number of (file id, relation type, arg1, arg2) records sorted in memory before spilling a sorted run to disk
+DEFAULT_MAX_RECORDS_IN_MEMORY = 1000000
+
 
+def candidate_mappings_file(data_dir, task="test"):
+    """data_dir/{task}.tsv, or the mappings file written in its place by candidate_generation --feature_store"""
+    tsv_file = Path(data_dir) / "{}.tsv".format(task)
+    return tsv_file if tsv_file.is_file() else Path(data_dir) / CANDIDATE_MAPPINGS_FILE.format(task)
+
+
+def iter_mappings(map_file, num_cols=3):
+    """
+        the last num_cols columns of each line of a test data (or mappings) file (header skipped), line by line;
+        arg1, arg2 and file id with num_cols=3, also the two entity types before them with num_cols=5 (bin mode)
+    """
+    with open(map_file, "r") as f:
+        # skip header
+        next(f, None)
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line.split("\t")[-num_cols:]
 
-def load_mappings(map_file):
-    maps = []
-    text = load_text(map_file)
-    for idx, line in enumerate(text.strip().split("\n")):
-        if idx == 0:
+
+def iter_predictions(result_file):
+    """
+        the predicted label of each line of a prediction file, read line by line
+        empty lines inside the file are kept as (empty) predictions, trailing empty lines are ignored
+    """
+    num_empty = 0
+    with open(result_file, "r") as f:
+        for line in f:
+            pred = line.strip()
+            if not pred:
+                # only yield empty lines followed by a prediction, so trailing new lines are ignored
+                num_empty += 1
+                continue
+            for _ in range(num_empty):
+                yield ""
+            num_empty = 0
+            yield pred
+
+
+def iter_maps_predictions(map_file, result_file, num_cols=3):
+    """read the mappings and predictions in lockstep"""
+    llm, llp = 0, 0
+    for m, pred in itertools.zip_longest(iter_mappings(map_file, num_cols), iter_predictions(result_file)):
+        llm += m is not None
+        llp += pred is not None
+        if m is None or pred is None:
             continue
-        info = line.split("\t")
-        maps.append(info[-3:])
+        yield m, pred
+    assert llp == llm, \
+        f"prediction results and mappings should have same amount data, but got preds: {llp} and maps: {llm}"
 
-    return maps
 
+def output_grouped_results(sorted_results, entity_data_dir, output_dir, keep_existing=True):
+    """
+        write entities and predicted relations of each entity file into output_dir as brat .ann files
+        sorted_results are (fid, relation type, arg1, arg2) grouped by file id; each file is written as soon as
+        its relations are read, so only the relations of one file are kept in memory
+        if keep_existing, files without predictions are only written when they do not exist (batch mode rounds)
+    """
+    entity_data_dir = Path(entity_data_dir)
 
-def load_predictions(result_file):
-    results = []
-    text = load_text(result_file)
-    for each in text.strip().split("\n"):
-        results.append(each.strip())
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    return results
+    predicted_fids = set()
+    for fid_key, rels in itertools.groupby(sorted_results, key=lambda x: x[0]):
+        fid = entity_data_dir / "{}.ann".format(fid_key)
+        if not fid.is_file():
+            # predictions without entity file are not written
+            continue
+        if fid_key in predicted_fids:
+            raise RuntimeError("relations of {} are not grouped together".format(fid_key))
+        predicted_fids.add(fid_key)
+        rels = [BRAT_REL_TEMPLATE.format(rel_idx, rt, arg1, arg2)
+                for rel_idx, (_, rt, arg1, arg2) in enumerate(rels, 1)]
+        save_text("\n".join([load_text(fid).strip()] + rels), output_dir / "{}.ann".format(fid_key))
 
+    for fid in entity_data_dir.glob("*.ann"):
+        if fid.stem in predicted_fids:
+            continue
+        ofn = output_dir / "{}.ann".format(fid.stem)
+        # only save when file is not exist
+        # this is important for batch prediction due to multi rounds visiting same files
+        if not keep_existing or not ofn.is_file():
+            save_text(load_text(fid).strip(), ofn)
 
-def map_results(res):
-    mapped_preds = defaultdict(list)
-    prev_fid = "no previous file id"
-    rel_idx = 1
 
-    for each in res:
-        fid, rt, arg1, arg2 = each
-        if prev_fid != fid:
-            prev_fid = fid
-            rel_idx = 1
-        brat_res = BRAT_REL_TEMPLATE.format(rel_idx, rt, arg1, arg2)
-        mapped_preds[fid].append(brat_res)
-        rel_idx += 1
+class ExternalSorter:
+    """
+        stable sort of (fid, relation type, arg1, arg2) records by file id with bounded memory
+        up to max_records records are sorted in memory; beyond that each full buffer is sorted and spilled to a run
+        file in tmp_dir, and the runs are merged lazily when iterating (heapq.merge keeps the order of equal keys)
+        if the input is already in file id order (e.g., candidates generated file by file), the runs are read back
+        one after another without merging
+        the sorter can only be iterated once; the run files are removed after iteration
+    """
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS_IN_MEMORY, tmp_dir=None):
+        if max_records < 1:
+            raise ValueError("max_records should be at least 1 but get {}".format(max_records))
+        self.max_records = max_records
+        self.tmp_dir = tmp_dir
+        self.num_records = 0
+        self._buffer = []
+        self._run_dir = None
+        self._runs = []
+        self._in_order = True
+        self._last_fid = None
+
+    def add(self, record):
+        fid = record[0]
+        if self._last_fid is not None and fid < self._last_fid:
+            self._in_order = False
+        self._last_fid = fid
+        self._buffer.append(record)
+        self.num_records += 1
+        if len(self._buffer) >= self.max_records:
+            self._spill()
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def _spill(self):
+        if self._run_dir is None:
+            self._run_dir = Path(tempfile.mkdtemp(prefix="post_processing_runs_", dir=self.tmp_dir))
+        run_file = self._run_dir / "run_{}.tsv".format(len(self._runs))
+        if not self._in_order:
+            self._buffer.sort(key=lambda x: x[0])
+        with open(run_file, "w") as f:
+            for record in self._buffer:
+                f.write("\t".join(record))
+                f.write("\n")
+        self._runs.append(run_file)
+        self._buffer = []
+
+    @staticmethod
+    def _read_run(run_file):
+        with open(run_file, "r") as f:
+            for line in f:
+                yield tuple(line.rstrip("\n").split("\t"))
+
+    def __iter__(self):
+        self._buffer.sort(key=lambda x: x[0])
+        if not self._runs:
+            yield from self._buffer
+            self._buffer = []
+            return
+
+        try:
+            runs = [self._read_run(run_file) for run_file in self._runs] + [iter(self._buffer)]
+            if self._in_order:
+                yield from itertools.chain(*runs)
+            else:
+                yield from heapq.merge(*runs, key=lambda x: x[0])
+        finally:
+            self.close()
+
+    def close(self):
+        self._buffer = []
+        self._runs = []
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
+
+class RelationCollector:
+    """
+        collect predicted relations by file id across prediction batches,
+        then write each brat output file exactly once with relation ids numbered across all batches
+        relations beyond max_records are spilled to disk (see ExternalSorter)
+    """
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS_IN_MEMORY, tmp_dir=None):
+        self.sorter = ExternalSorter(max_records=max_records, tmp_dir=tmp_dir)
+        self.file_ids = set()
 
-    return mapped_preds
+    def add(self, combined_results):
+        for record in combined_results:
+            self.file_ids.add(record[0])
+            self.sorter.add(record)
 
+    def __len__(self):
+        return self.sorter.num_records
 
-def output_results(mapped_predictions, entity_data_dir, output_dir):
-    entity_data_dir = Path(entity_data_dir)
+    def output(self, entity_data_dir, output_dir):
+        output_grouped_results(self.sorter, entity_data_dir, output_dir, keep_existing=False)
 
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    for fid in entity_data_dir.glob("*.ann"):
-        fid_key = fid.stem
-        ofn = output_dir / "{}.ann".format(fid_key)
-        entities = load_text(fid).strip()
-        if fid_key in mapped_predictions:
-            rels = mapped_predictions[fid_key]
-            rels = "\n".join(rels)
-            outputs = "\n".join([entities, rels])
-            save_text(outputs, ofn)
-        else:
-            # only save when file is not exist
-            # this is important for batch prediction dur to multi rounds visiting same files
-            if not ofn.is_file():
-                save_text(entities, ofn)
+def iter_prediction_arrays(map_file, pred_dir, neg_type, type_maps=None):
+    """
+        positive predictions as (fid, rel_type, arg1, arg2) from memory-mapped prediction arrays
+        (see io_utils.save_prediction_arrays) joined with the candidate mappings in a vectorized way;
+        the mappings are read from map_file only if they are not saved with the arrays
+        rel_type is the predicted label, or the type_maps value of the entity type pair in bin mode
+    """
+    arrays = load_prediction_arrays(pred_dir)
+    labels = np.asarray(arrays["labels"])
+    label_ids = arrays["label_ids"]
+    maps = arrays["mappings"]
+    if maps is None:
+        maps = np.array(list(iter_mappings(map_file, num_cols=5)), dtype=str).reshape(-1, 5)
+    llp, llm = len(label_ids), len(maps)
+    assert llp == llm, \
+        f"prediction results and mappings should have same amount data, but got preds: {llp} and maps: {llm}"
+
+    pos_idx = np.nonzero(labels[label_ids] != neg_type)[0]
+    if len(pos_idx) == 0:
+        return iter(())
+    pos_maps = np.asarray(maps[pos_idx])
+    if type_maps is None:
+        rel_types = labels[label_ids[pos_idx]]
+    else:
+        # look up each distinct entity type pair once
+        type_pairs, inverse = np.unique(pos_maps[:, :2], axis=0, return_inverse=True)
+        rel_types = np.array([type_maps[tuple(pair)] for pair in type_pairs.tolist()])[inverse.reshape(-1)]
+
+    return zip(pos_maps[:, 4].tolist(), rel_types.tolist(), pos_maps[:, 2].tolist(), pos_maps[:, 3].tolist())
+
+
+def _new_sorter(args):
+    return ExternalSorter(max_records=getattr(args, "max_records_in_memory", DEFAULT_MAX_RECORDS_IN_MEMORY),
+                          tmp_dir=getattr(args, "tmp_dir", None))
 
 
 def combine_maps_predictions_mul(args):
-    comb_map_pred = []
+    """
+        positive predictions as (fid, rel_type, arg1, arg2) sorted by file id (a single-use iterable)
+        the test data and prediction files are streamed, so memory is bounded by args.max_records_in_memory
+    """
+    comb_map_pred = _new_sorter(args)
 
     for mf, pf in zip(args.test_data_file, args.predict_result_file):
-        maps = load_mappings(mf)
-        preds = load_predictions(pf)
-        llp = len(preds)
-        llm = len(maps)
-        assert llp == llm, \
-            f"prediction results and mappings should have same amount data, but got preds: {llp} and maps: {llm}"
-        for m, rel_type in zip(maps, preds):
+        if Path(pf).is_dir():
+            comb_map_pred.extend(iter_prediction_arrays(mf, pf, args.neg_type))
+            continue
+        for m, rel_type in iter_maps_predictions(mf, pf):
             if rel_type == args.neg_type:
                 continue
             arg1, arg2, fid = m
-            comb_map_pred.append((fid, rel_type, arg1, arg2))
+            comb_map_pred.add((fid, rel_type, arg1, arg2))
 
-    comb_map_pred.sort(key=lambda x: x[0])
     return comb_map_pred
 
 
-def load_mappings_bin(map_file):
-    maps = []
-    text = load_text(map_file)
-    for idx, line in enumerate(text.strip().split("\n")):
-        if idx == 0:
-            continue
-        info = line.split("\t")
-        maps.append(info[-5:])
-
-    return maps
-
-
 def combine_maps_predictions_bin(args):
     if not args.type_map:
         raise RuntimeError("no type maps (entity-relation) provided. See help.")
     type_maps = pkl_load(args.type_map)
 
-    comb_map_pred = []
+    comb_map_pred = _new_sorter(args)
 
     for mf, pf in zip(args.test_data_file, args.predict_result_file):
-        maps = load_mappings_bin(mf)
-        preds = load_predictions(pf)
-        llp = len(preds)
-        llm = len(maps)
-        assert llp == llm, \
-            f"prediction results and mappings should have same amount data, but got preds: {llp} and maps: {llm}"
-        for m, rel_type in zip(maps, preds):
+        if Path(pf).is_dir():
+            comb_map_pred.extend(iter_prediction_arrays(mf, pf, args.neg_type, type_maps=type_maps))
+            continue
+        for m, rel_type in iter_maps_predictions(mf, pf, num_cols=5):
             if rel_type == args.neg_type:
                 continue
             en_type_1, en_type_2, arg1, arg2, fid = m
             real_rel_type = type_maps[(en_type_1, en_type_2)]
-            comb_map_pred.append((fid, real_rel_type, arg1, arg2))
+            comb_map_pred.add((fid, real_rel_type, arg1, arg2))
 
-    comb_map_pred.sort(key=lambda x: x[0])
     return comb_map_pred
 
 
+def combine_results(args):
+    if args.mode == "mul":
+        combined_results = combine_maps_predictions_mul(args)
+    elif args.mode == "bin":
+        combined_results = combine_maps_predictions_bin(args)
+    else:
+        args.logger.error("expect mode to be mul or bin but get {}".format(args.mode))
+        raise RuntimeError("expect mode to be mul or bin but get {}".format(args.mode))
+
+    return combined_results
+
+
 def app(args):
     lltf = len(args.test_data_file)
     llpf = len(args.predict_result_file)
@@ -163,17 +331,10 @@ def app(args):
         raise RuntimeError(
             f"test and prediction file number should be same but get test: {lltf} and preduction {llpf}.")
 
-    if args.mode == "mul":
-        combined_results = combine_maps_predictions_mul(args)
-    elif args.mode == "bin":
-        combined_results = combine_maps_predictions_bin(args)
-    else:
-        args.logger.error("expect mode to be mul or bin but get {}".format(args.mode))
-        raise RuntimeError("expect mode to be mul or bin but get {}".format(args.mode))
+    combined_results = combine_results(args)
 
     try:
-        combined_results = map_results(combined_results)
-        output_results(combined_results, args.entity_data_dir, args.brat_result_output_dir)
+        output_grouped_results(combined_results, args.entity_data_dir, args.brat_result_output_dir)
     except Exception as ex:
         traceback.print_exc()
         args.logger.error(traceback.format_exc())
@@ -206,13 +367,21 @@ if __name__ == '__main__':
     parser.add_argument("--type_map", type=str, default=None,
                         help="a map of entity pair types to relation types (only use when mode is bin)")
     parser.add_argument("--test_data_file", type=str, nargs='+', required=True,
-                        help="The test data file in which we need to read the maps; available to accept multiple files")
+                        help="The test data file in which we need to read the maps (or the test_mappings.tsv written "
+                             "by candidate_generation --feature_store); available to accept multiple files")
     parser.add_argument("--entity_data_dir", type=str, required=True,
                         help="The annotation/NER output files with only the entities. Used for output NER and RE.")
     parser.add_argument("--predict_result_file", nargs='+', type=str, required=True,
-                        help="prediction results; available to accept multiple files")
+                        help="prediction results; available to accept multiple files. "
+                             "A prediction arrays dir (relation_extraction.py --save_prediction_arrays) "
+                             "is memory-mapped instead of parsing text")
     parser.add_argument("--brat_result_output_dir", type=str, required=True,
                         help="prediction results")
+    parser.add_argument("--max_records_in_memory", default=DEFAULT_MAX_RECORDS_IN_MEMORY, type=int,
+                        help="number of positive predictions sorted in memory; "
+                             "beyond that sorted runs are spilled to --tmp_dir and merged")
+    parser.add_argument("--tmp_dir", default=None, type=str,
+                        help="where to spill sorted runs; default is the system temp dir")
     parser.add_argument("--log_file", default="./log.txt", type=str,
                         help="where to save the log information")
     pargs = parser.parse_args()
@@ -1,5 +1,5 @@
 import logging
-from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+import numpy as np
 import traceback
 from collections import defaultdict
 
@@ -80,48 +80,100 @@ def calc(tp, tp_fp, tp_tn):
     return round(pre, 4), round(rec, 4), round(f1, 4)
 
 
+def confusion_matrix(gs_labels, preds, num_labels=None):
+    """count matrix of (gold label id, predicted label id) pairs built with one bincount"""
+    gs_labels = np.asarray(gs_labels, dtype=np.int64).reshape(-1)
+    preds = np.asarray(preds, dtype=np.int64).reshape(-1)
+    assert len(preds) == len(gs_labels), \
+        f"prediction and gold standard is not equal, prediction: {len(preds)}; gs: {len(gs_labels)}"
+    if num_labels is None:
+        num_labels = int(max(gs_labels.max(initial=-1), preds.max(initial=-1))) + 1
+
+    return np.bincount(gs_labels * num_labels + preds, minlength=num_labels * num_labels).reshape(
+        num_labels, num_labels)
+
+
+def prf(tp, fp, fn):
+    """precision, recall and f1 (0 if undefined) of tp, fp and fn counts; scalars or arrays (one value per entry)"""
+    tp, fp, fn = [np.asarray(x, dtype=np.float64) for x in (tp, fp, fn)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pre = np.where(tp + fp > 0, tp / (tp + fp), 0.)
+        rec = np.where(tp + fn > 0, tp / (tp + fn), 0.)
+        f1 = np.where(pre + rec > 0, 2 * (pre * rec) / (pre + rec), 0.)
+    if pre.ndim == 0:
+        return float(pre), float(rec), float(f1)
+
+    return pre, rec, f1
+
+
+def confusion_counts(cm, label_ids):
+    """tp, fp and fn arrays of label_ids from a confusion matrix"""
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    tp = np.diag(cm)[label_ids]
+
+    return tp, cm.sum(axis=0)[label_ids] - tp, cm.sum(axis=1)[label_ids] - tp
+
+
 def measure_prf(preds, gs_labels, non_rel_label):
     res = dict()
-    temp = defaultdict(PRF)
-    total_tp, total_tp_fp, total_tp_tn = 0, 0, 0
-    tn_dict = defaultdict(lambda: 0)
 
-    assert preds == gs_labels, \
+    assert len(preds) == len(gs_labels), \
         f"prediction and gold standard is not equal, prediction: {len(preds)}; gs: {len(gs_labels)}"
 
-    labels = set(gs_labels)
-    for l in labels:
-        for p, g in zip(preds, gs_labels):
-            if g == l:
-                tn_dict[l] += 1
-            if g == p == l:
-                temp[l].tp += 1
-            elif g != l and p == l:
-                temp[l].fp += 1
-
-    for l in labels:
-        if l == non_rel_label:
-            continue
-        tp, fp = temp[l].tp, temp[l].fp
-        tp_fp = tp + fp
-        tp_tn = tn_dict[l]
-        res[l] = calc(tp, tp_fp, tp_tn)
-
-        total_tp += tp
-        total_tp_fp += tp_fp
-        total_tp_tn += tp_tn
-
-    res['micro_average_pre_rec_f1'] = calc(total_tp, total_tp_fp, total_tp_tn)
+    # label ids of both gold and predicted labels; only gold labels are measured
+    label_names, label_ids = np.unique(np.asarray(list(gs_labels) + list(preds)), return_inverse=True)
+    label_ids = label_ids.reshape(-1)
+    cm = confusion_matrix(label_ids[:len(gs_labels)], label_ids[len(gs_labels):], len(label_names))
+    labels = [idx for idx, l in enumerate(label_names.tolist()) if cm[idx].sum() > 0 and l != non_rel_label]
+    tp, fp, fn = confusion_counts(cm, labels)
+
+    for idx, l_tp, l_fp, l_fn in zip(labels, tp.tolist(), fp.tolist(), fn.tolist()):
+        res[label_names[idx].item()] = calc(l_tp, l_tp + l_fp, l_tp + l_fn)
+
+    total_tp, total_fp, total_fn = int(tp.sum()), int(fp.sum()), int(fn.sum())
+    res['micro_average_pre_rec_f1'] = calc(total_tp, total_tp + total_fp, total_tp + total_fn)
+    # mean of the (unrounded) per label scores
+    res['macro_average_pre_rec_f1'] = tuple(round(float(x.mean()), 4) for x in prf(tp, fp, fn)) \
+        if labels else (0, 0, 0)
     f1 = res['micro_average_pre_rec_f1'][-1]
 
     return res, f1
 
 
-def acc_and_f1(labels, preds, label2idx, non_rel_label):
-    acc = accuracy_score(labels, preds)
-
-    includes = [i for l, i in label2idx.items() if l != non_rel_label]
+def acc_and_f1_from_confusion(cm, label2idx, non_rel_label):
+    """accuracy and micro precision, recall and f1 of all labels but non_rel_label from a confusion matrix"""
+    acc = float(np.trace(cm) / cm.sum()) if cm.sum() > 0 else 0.
 
-    p, r, f1, _ = precision_recall_fscore_support(labels, preds, labels=includes, average="micro")
+    includes = [i for l, i in label2idx.items() if l != non_rel_label and i < len(cm)]
+    tp, fp, fn = confusion_counts(cm, includes)
+    p, r, f1 = prf(tp.sum(), fp.sum(), fn.sum())
 
     return acc, f"precision: {p}; recall: {r}", f1
+
+
+def class_prf_from_confusion(cm, label2idx, non_rel_label):
+    """
+        precision, recall and f1 of each label but non_rel_label and their macro average from a confusion matrix
+        labels that are neither gold nor predicted (or not in cm) get zeros and are left out of the macro average
+        return ({label: (p, r, f1)}, (macro p, macro r, macro f1))
+    """
+    labels = sorted((i, l) for l, i in label2idx.items() if l != non_rel_label)
+    # labels after the last one in cm have no counts
+    num_labels = max([len(cm)] + [i + 1 for i, _ in labels])
+    counts = np.zeros((num_labels, num_labels), dtype=np.int64)
+    counts[:len(cm), :len(cm)] = cm
+    tp, fp, fn = confusion_counts(counts, [i for i, _ in labels])
+    p, r, f1 = prf(tp, fp, fn)
+
+    per_class = {l: (float(p[k]), float(r[k]), float(f1[k])) for k, (_, l) in enumerate(labels)}
+    seen = tp + fp + fn > 0
+    macro = tuple(float(x[seen].mean()) if seen.any() else 0. for x in (p, r, f1))
+
+    return per_class, macro
+
+
+def acc_and_f1(labels, preds, label2idx, non_rel_label):
+    labels, preds = np.asarray(labels).reshape(-1), np.asarray(preds).reshape(-1)
+    num_labels = max(len(label2idx), int(labels.max(initial=-1)) + 1, int(preds.max(initial=-1)) + 1)
+
+    return acc_and_f1_from_confusion(confusion_matrix(labels, preds, num_labels), label2idx, non_rel_label)
@@ -2,14 +2,14 @@ import traceback
 from config import MODEL_REQUIRE_SEGMENT_ID, SPEC_TAGS, TOKENIZER_USE_FOUR_SPECIAL_TOKs
 import csv
 from pathlib import Path
-import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+# torch and transformers are imported where they are used, so the data processors (e.g., for preprocessing and
+# candidate generation) can be imported without them
 import re
 from tqdm import tqdm
 from functools import partial
 from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from collections import Counter
+from collections import Counter, deque
 
 
 class InputExample(object):
@@ -88,7 +88,17 @@ def convert_examples_to_relation_extraction_features(
     return features
 
 
+def glue_convert_examples_to_features(examples, **kwargs):
+    """transformers.glue_convert_examples_to_features, imported on first use"""
+    from transformers import glue_convert_examples_to_features as convert_examples_to_features
+
+    return convert_examples_to_features(examples, **kwargs)
+
+
 def features2tensors(features, binary_mode=False, logger=None):
+    import torch
+    from torch.utils.data import TensorDataset
+
     tensor_input_ids = []
     tensor_attention_masks = []
     tensor_token_type_ids = []
@@ -118,7 +128,105 @@ def features2tensors(features, binary_mode=False, logger=None):
     return TensorDataset(tensor_input_ids, tensor_attention_masks, tensor_token_type_ids, tensor_label_ids)
 
 
-def relation_extraction_data_loader(dataset, batch_size=2, task='train', logger=None, binary_mode=False):
+class NegativeDownsampleSampler(object):
+    """
+    sample all positive examples and a fresh random neg_sample_ratio of the negative examples in each epoch
+    (in random order); the number of samples is the same in every epoch
+    a plain iterable with a length, as TokenBudgetBatchSampler (DataLoader takes any iterable as sampler)
+    """
+    def __init__(self, label_ids, neg_label_id, neg_sample_ratio, generator=None):
+        import torch
+
+        label_ids = torch.as_tensor(label_ids)
+        self.pos_idx = torch.nonzero(label_ids != neg_label_id, as_tuple=False).view(-1)
+        self.neg_idx = torch.nonzero(label_ids == neg_label_id, as_tuple=False).view(-1)
+        self.num_neg_samples = int(round(len(self.neg_idx) * neg_sample_ratio))
+        self.generator = generator
+
+    def __iter__(self):
+        import torch
+
+        neg_idx = self.neg_idx[torch.randperm(len(self.neg_idx), generator=self.generator)[:self.num_neg_samples]]
+        epoch_idx = torch.cat([self.pos_idx, neg_idx])
+        epoch_idx = epoch_idx[torch.randperm(len(epoch_idx), generator=self.generator)]
+        return iter(epoch_idx.tolist())
+
+    def __len__(self):
+        return len(self.pos_idx) + self.num_neg_samples
+
+
+class TokenBudgetBatchSampler(object):
+    """
+    group the indices drawn from sampler (RandomSampler or SequentialSampler) into batches
+    bounded by total (padded) tokens instead of number of examples:
+        batch size * longest sequence in batch <= max_tokens
+    the sampler order is kept (batches are packed greedily), so prediction order is not changed
+    an example longer than max_tokens is put into a batch by itself
+
+    the number of batches differs between epochs with RandomSampler,
+    so the batches are planned ahead by epoch (see plan_epochs); __len__ is the size of the running epoch,
+    or of the next epoch between epochs. Call reset when training stops before all planned epochs are run
+    """
+    def __init__(self, sampler, lengths, max_tokens):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self._planned_epochs = deque()
+        self._current_epoch = None
+
+    def _pack(self):
+        batches = []
+        batch, batch_max_len = [], 0
+        for idx in self.sampler:
+            new_max_len = max(batch_max_len, self.lengths[idx])
+            if batch and new_max_len * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, new_max_len = [], self.lengths[idx]
+            batch.append(idx)
+            batch_max_len = new_max_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def plan_epochs(self, num_epochs):
+        """plan the batches of the next num_epochs epochs and return the number of batches in each epoch"""
+        while len(self._planned_epochs) < num_epochs:
+            self._planned_epochs.append(self._pack())
+        return [len(self._planned_epochs[i]) for i in range(num_epochs)]
+
+    def reset(self):
+        """drop the planned epochs and the running epoch (e.g., after early stopping)"""
+        self._planned_epochs.clear()
+        self._current_epoch = None
+
+    def __iter__(self):
+        self._current_epoch = self._planned_epochs.popleft() if self._planned_epochs else self._pack()
+        yield from self._current_epoch
+        self._current_epoch = None
+
+    def __len__(self):
+        if self._current_epoch is not None:
+            return len(self._current_epoch)
+        return self.plan_epochs(1)[0]
+
+
+def trim_padding_collate(batch):
+    """
+    stack a batch and remove the padding columns shared by all sequences in the batch (left or right padding)
+    used with TokenBudgetBatchSampler since features are padded to max_seq_length
+    """
+    from torch.utils.data.dataloader import default_collate
+
+    input_ids, attention_mask, token_type_ids, label_ids = default_collate(batch)
+    keep = attention_mask.sum(dim=0) > 0
+    # token_type_ids has the same shape as attention_mask (all zeros if the model does not use it)
+    input_ids, attention_mask, token_type_ids = input_ids[:, keep], attention_mask[:, keep], token_type_ids[:, keep]
+
+    return [input_ids, attention_mask, token_type_ids, label_ids]
+
+
+def relation_extraction_data_loader(dataset, batch_size=2, task='train', logger=None, binary_mode=False,
+                                    max_tokens=-1, neg_label_id=None, neg_sample_ratio=1.0):
     """
     task has two levels:
     train for training using RandomSampler
@@ -126,22 +234,63 @@ def relation_extraction_data_loader(dataset, batch_size=2, task='train', logger=
 
     if set auto to True we will default call convert_features_to_tensors,
     so features can be directly passed into the function
+
+    if max_tokens > 0, each batch is bounded by total tokens (see TokenBudgetBatchSampler) instead of batch_size
+    if neg_sample_ratio < 1 (train only), only sample this ratio of negative (neg_label_id) examples in each epoch
     """
+    from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+
     dataset = features2tensors(dataset, binary_mode=binary_mode, logger=logger)
 
-    if task == 'train':
+    if task == 'train' and neg_sample_ratio < 1.0:
+        label_ids = dataset.tensors[3]
+        if binary_mode:
+            # one-hot labels in binary mode
+            label_ids = label_ids.argmax(dim=-1)
+        sampler = NegativeDownsampleSampler(label_ids, neg_label_id, neg_sample_ratio)
+        if logger:
+            logger.info("sample all {} positive and {} of {} negative examples in each epoch".format(
+                len(sampler.pos_idx), sampler.num_neg_samples, len(sampler.neg_idx)))
+    elif task == 'train':
         sampler = RandomSampler(dataset)
     elif task == 'test':
         sampler = SequentialSampler(dataset)
     else:
         raise ValueError('task argument only support train or test but get {}'.format(task))
 
-    data_loader = DataLoader(dataset, sampler=sampler, batch_size=batch_size, pin_memory=True)
+    if max_tokens > 0:
+        lengths = dataset.tensors[1].sum(dim=1).tolist()
+        batch_sampler = TokenBudgetBatchSampler(sampler, lengths, max_tokens)
+        data_loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=trim_padding_collate,
+                                 pin_memory=True)
+    else:
+        data_loader = DataLoader(dataset, sampler=sampler, batch_size=batch_size, pin_memory=True)
 
     return data_loader
 
 
-def batch_to_model_input(batch, model_type="bert", device=torch.device("cpu")):
+def stratified_sample_features(features, sample_ratio=1.0, seed=None):
+    """
+    sample a fraction of features from each label (keep the label distribution)
+    at least one feature is kept for each label; the original order is kept
+    used to build a small dev set for frequent evaluation during training
+    """
+    if sample_ratio >= 1.0:
+        return features
+
+    rng = np.random.RandomState(seed)
+    labels = np.array([feature.label for feature in features])
+    selected = []
+    for label in np.unique(labels):
+        label_idx = np.nonzero(labels == label)[0]
+        num_to_keep = max(1, int(round(len(label_idx) * sample_ratio)))
+        selected.append(rng.choice(label_idx, num_to_keep, replace=False))
+    selected = np.sort(np.concatenate(selected))
+
+    return [features[idx] for idx in selected]
+
+
+def batch_to_model_input(batch, model_type="bert", device="cpu"):
     return {"input_ids": batch[0].to(device),
             "attention_mask": batch[1].to(device),
             "labels": batch[3].to(device)}
@@ -207,6 +356,10 @@ class DataProcessor(object):
         return self._create_examples(
             self._read_tsv(input_file_name), "test")
 
+    def get_examples_from_lines(self, lines, set_type="test"):
+        """same as get_test_examples but from in-memory tsv columns (e.g., created by candidate_generation)"""
+        return self._create_examples(lines, set_type)
+
     def get_sample_distribution(self, train_file=None):
         # the distribution will be measured based on training data
         if train_file:
@@ -0,0 +1,110 @@
+# coding=utf-8
+
+"""
+Import time of the entry point modules, each imported in a fresh python process
+
+python src/import_benchmark.py --repeat 5
+python src/import_benchmark.py --repeat 5 --compare_src_dir /path/to/old_checkout/src
+
+Post-processing, evaluation and data preprocessing should not load torch or transformers (the "loaded" column);
+config only imports the model classes when a model_type is looked up in MODEL_DICT.
+With --compare_src_dir, the same modules are also imported from another source tree (e.g., a checkout of an
+older commit) and the speedup is printed.
+"""
+
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+
+# (dir relative to src, module); data_processing scripts are run from their own dir
+MODULES = [
+    (".", "brat_eval"),
+    ("data_processing", "post_processing"),
+    ("data_processing", "candidate_generation"),
+    (".", "config"),
+    (".", "data_utils"),
+    (".", "task"),
+    (".", "relation_extraction"),
+]
+HEAVY_MODULES = ("torch", "transformers", "peft", "wandb", "accelerate", "sklearn")
+
+IMPORT_CODE = """
+import json, sys, time
+sys.path.insert(0, ".")
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+print(json.dumps({{"time": duration, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(src_dir, module_dir, module):
+    """seconds to import module in a fresh python process and the heavy modules it loaded; (None, error) if failed"""
+    code = IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], cwd=Path(src_dir) / module_dir,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return None, lines[-1] if lines else "exit code {}".format(result.returncode)
+    output = json.loads(result.stdout.strip().splitlines()[-1])
+
+    return output["time"], output["loaded"]
+
+
+def benchmark(src_dir, repeat):
+    """module -> (median import seconds or None, heavy modules loaded or error message)"""
+    results = dict()
+    for module_dir, module in MODULES:
+        times, loaded = [], None
+        for _ in range(repeat):
+            duration, loaded = time_import(src_dir, module_dir, module)
+            if duration is None:
+                break
+            times.append(duration)
+        results[module] = (float(np.median(times)) if times else None, loaded)
+
+    return results
+
+
+def format_time(duration):
+    return "{:.3f}".format(duration) if duration is not None else "failed"
+
+
+def app(args):
+    src_dir = Path(args.src_dir) if args.src_dir else Path(__file__).resolve().parent
+    results = benchmark(src_dir, args.repeat)
+    compare_results = benchmark(args.compare_src_dir, args.repeat) if args.compare_src_dir else None
+
+    print("median import time (sec) of {} runs; src: {}".format(args.repeat, src_dir))
+    if compare_results is not None:
+        print("compared to: {}".format(args.compare_src_dir))
+        print("{:24}{:>10}{:>10}{:>10}  {}".format("module", "before", "after", "speedup", "loaded"))
+    else:
+        print("{:24}{:>10}  {}".format("module", "time", "loaded"))
+    for _, module in MODULES:
+        duration, loaded = results[module]
+        loaded = ", ".join(loaded) if isinstance(loaded, list) else loaded
+        if compare_results is None:
+            print("{:24}{:>10}  {}".format(module, format_time(duration), loaded or "-"))
+            continue
+        before, _ = compare_results[module]
+        speedup = "{:.1f}x".format(before / duration) if before is not None and duration else "-"
+        print("{:24}{:>10}{:>10}{:>10}  {}".format(
+            module, format_time(before), format_time(duration), speedup, loaded or "-"))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src_dir", default=None, type=str,
+                        help="source dir to benchmark; default is the dir of this script")
+    parser.add_argument("--compare_src_dir", default=None, type=str,
+                        help="another source dir (e.g., src of a checkout of an older commit) to compare with")
+    parser.add_argument("--repeat", default=5, type=int,
+                        help="number of fresh processes per module; the median time is reported")
+    app(parser.parse_args())
@@ -0,0 +1,126 @@
+# coding=utf-8
+
+"""
+Client of inference_server.py and a load test
+
+python inference_client.py --url http://127.0.0.1:8000 --test_data_file data/test.tsv \
+    --num_requests 1000 --concurrency 16 --candidates_per_request 4
+"""
+
+
+import argparse
+import http.client
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class InferenceClient:
+    """one keep-alive connection; not thread safe, use one client per thread"""
+    def __init__(self, url="http://127.0.0.1:8000", unix_socket=None, timeout=300):
+        if unix_socket:
+            self.conn = UnixHTTPConnection(unix_socket, timeout=timeout)
+        else:
+            url = urlparse(url)
+            self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else dict()
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        result = json.loads(response.read().decode("utf-8"))
+        if response.status != 200:
+            raise RuntimeError("{} {} failed with {}: {}".format(method, path, response.status, result.get("error")))
+        return result
+
+    def predict_candidates(self, candidates, return_probs=False):
+        """candidates as [sent1, sent2] pairs, 8-column tsv rows or dicts; return one prediction per candidate"""
+        return self._request("POST", "/predict/candidates",
+                             {"candidates": candidates, "return_probs": return_probs})["predictions"]
+
+    def predict_note(self, text, ann, fid="note"):
+        """the relations predicted between the entities of one note (brat .txt and .ann contents)"""
+        return self._request("POST", "/predict/note", {"text": text, "ann": ann, "fid": fid})
+
+    def metrics(self):
+        return self._request("GET", "/metrics")
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def close(self):
+        self.conn.close()
+
+
+def load_test(args):
+    with open(args.test_data_file, "r") as f:
+        lines = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+    if args.data_file_header:
+        lines = lines[1:]
+    requests = [[lines[(i * args.candidates_per_request + j) % len(lines)] for j in range(args.candidates_per_request)]
+                for i in range(args.num_requests)]
+
+    def _worker(worker_requests):
+        client = InferenceClient(args.url, args.unix_socket)
+        latencies = []
+        try:
+            for candidates in worker_requests:
+                start = time.time()
+                client.predict_candidates(candidates)
+                latencies.append(time.time() - start)
+        finally:
+            client.close()
+        return latencies
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as exe:
+        latencies = [latency for each in exe.map(
+            _worker, [requests[i::args.concurrency] for i in range(args.concurrency)]) for latency in each]
+    total = time.time() - start
+    latencies = np.array(latencies) * 1000
+
+    print("requests: {}; candidates: {}; concurrency: {}; time: {:.2f} sec".format(
+        len(latencies), len(latencies) * args.candidates_per_request, args.concurrency, total))
+    print("throughput: {:.1f} requests/sec; {:.1f} candidates/sec".format(
+        len(latencies) / total, len(latencies) * args.candidates_per_request / total))
+    print("latency ms: p50 {:.1f}; p95 {:.1f}; p99 {:.1f}; max {:.1f}".format(
+        *np.percentile(latencies, [50, 95, 99]), latencies.max()))
+
+    client = InferenceClient(args.url, args.unix_socket)
+    print("server metrics:", json.dumps(client.metrics(), indent=2))
+    client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000", type=str,
+                        help="address of inference_server.py")
+    parser.add_argument("--unix_socket", default=None, type=str,
+                        help="if set, connect to this Unix socket instead of --url")
+    parser.add_argument("--test_data_file", type=str, required=True,
+                        help="candidate tsv file (8 columns) to send")
+    parser.add_argument("--data_file_header", default=True, type=bool,
+                        help="whether the test data file has a header line")
+    parser.add_argument("--num_requests", default=1000, type=int,
+                        help="total number of requests")
+    parser.add_argument("--concurrency", default=8, type=int,
+                        help="number of concurrent clients")
+    parser.add_argument("--candidates_per_request", default=1, type=int,
+                        help="number of candidates in each request")
+    load_test(parser.parse_args())
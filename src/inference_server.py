@@ -0,0 +1,350 @@
+# coding=utf-8
+
+"""
+A long-lived relation extraction service
+
+The model is loaded once (minutes for a llama checkpoint) and kept in memory. Requests are served with asyncio over
+HTTP (--port) or a Unix socket (--unix_socket). Concurrent requests are gathered into micro-batches: a batch is run
+when it has --max_batch_candidates candidates or when the oldest request has waited --max_wait_ms.
+The model runs in one worker thread so the event loop keeps accepting requests during inference.
+
+endpoints (json in and out):
+    POST /predict/candidates  {"candidates": [[sent1, sent2], ...] or 8-column tsv rows or
+                                             [{"sent1": ..., "sent2": ..., "en1_type": ..., ...}, ...],
+                               "return_probs": false}
+                              -> {"predictions": [{"label": ..., "score": ...}, ...], "labels": [...]}
+    POST /predict/note        {"text": note text, "ann": brat entities, "fid": "note"}
+                              -> {"relations": [{"type": ..., "arg1": ..., "arg2": ..., "score": ...}], "ann": ...}
+    GET  /metrics             throughput, queue depth, batch sizes and latencies
+    GET  /health
+
+See inference_client.py for a client and a load test.
+"""
+
+
+import asyncio
+import json
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import torch
+from utils import TransformerLogger
+from brat_eval import parse_annotations
+from brat_pipeline import init_pipeline, get_args_parser
+from relation_extractor import candidate_columns
+from data_processing.candidate_generation import create_candidate_records
+from data_processing.data_format_conf import BRAT_REL_TEMPLATE
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                500: "Internal Server Error"}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ServiceMetrics:
+    """counters since start, recent (window_sec) throughput and recent request latencies"""
+    def __init__(self, window_sec=60, max_samples=10000):
+        self.start_time = time.time()
+        self.window_sec = window_sec
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_candidates = 0
+        self.num_batches = 0
+        self.inference_sec = 0.
+        self._recent = deque()
+        self._latencies = deque(maxlen=max_samples)
+        self._batch_sizes = deque(maxlen=max_samples)
+
+    def add_batch(self, num_requests, num_candidates, inference_sec):
+        now = time.time()
+        self.num_batches += 1
+        self.num_candidates += num_candidates
+        self.inference_sec += inference_sec
+        self._batch_sizes.append((num_requests, num_candidates))
+        self._recent.append((now, num_candidates))
+        while self._recent and self._recent[0][0] < now - self.window_sec:
+            self._recent.popleft()
+
+    def add_request(self, latency_sec, error=False):
+        self.num_requests += 1
+        self.num_errors += int(error)
+        self._latencies.append(latency_sec)
+
+    def snapshot(self, queue_requests=0, queue_candidates=0):
+        now = time.time()
+        uptime = now - self.start_time
+        recent = sum([n for t, n in self._recent if t >= now - self.window_sec])
+        latencies = np.array(self._latencies) * 1000 if self._latencies else np.zeros(1)
+        batch_sizes = np.array(self._batch_sizes) if self._batch_sizes else np.zeros((1, 2))
+        return {
+            "uptime_sec": round(uptime, 1),
+            "requests": self.num_requests,
+            "errors": self.num_errors,
+            "candidates": self.num_candidates,
+            "batches": self.num_batches,
+            "queue_requests": queue_requests,
+            "queue_candidates": queue_candidates,
+            "throughput_candidates_per_sec": round(self.num_candidates / max(uptime, 1e-6), 2),
+            "recent_throughput_candidates_per_sec": round(recent / min(self.window_sec, max(uptime, 1e-6)), 2),
+            "inference_candidates_per_sec": round(self.num_candidates / max(self.inference_sec, 1e-6), 2),
+            "mean_batch_requests": round(float(batch_sizes[:, 0].mean()), 2),
+            "mean_batch_candidates": round(float(batch_sizes[:, 1].mean()), 2),
+            "latency_ms_p50": round(float(np.percentile(latencies, 50)), 2),
+            "latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+            "latency_ms_p99": round(float(np.percentile(latencies, 99)), 2),
+        }
+
+
+class MicroBatcher:
+    """
+        gather the candidates of concurrent requests into one model call
+        a batch is run when it has max_batch_candidates candidates or when its first request waited max_wait_ms
+        predict_fn(candidate_columns) -> (label ids, probs) runs in a single worker thread
+    """
+    def __init__(self, predict_fn, max_batch_candidates=256, max_wait_ms=20, metrics=None):
+        self.predict_fn = predict_fn
+        self.max_batch_candidates = max_batch_candidates
+        self.max_wait_sec = max_wait_ms / 1000
+        self.metrics = metrics if metrics is not None else ServiceMetrics()
+        self.queue = None
+        self.queue_candidates = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, candidate_columns):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue_candidates += len(candidate_columns)
+        await self.queue.put((loop.time(), candidate_columns, future))
+        return await future
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self.queue.get()
+            batch = [first]
+            num_candidates = len(first[1])
+            deadline = first[0] + self.max_wait_sec
+            while num_candidates < self.max_batch_candidates:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and self.queue.empty():
+                    break
+                try:
+                    item = self.queue.get_nowait() if timeout <= 0 else \
+                        await asyncio.wait_for(self.queue.get(), timeout)
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                batch.append(item)
+                num_candidates += len(item[1])
+            self.queue_candidates -= num_candidates
+
+            batch_columns = [columns for _, each_columns, _ in batch for columns in each_columns]
+            start = time.time()
+            try:
+                label_ids, probs = await loop.run_in_executor(self._executor, self.predict_fn, batch_columns)
+            except Exception as ex:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(ex)
+                continue
+            self.metrics.add_batch(len(batch), num_candidates, time.time() - start)
+
+            offset = 0
+            for _, each_columns, future in batch:
+                end = offset + len(each_columns)
+                if not future.done():
+                    future.set_result((label_ids[offset:end], probs[offset:end]))
+                offset = end
+
+
+class InferenceService:
+    def __init__(self, task_runner, neg_label_id, type_map=None, candidate_kwargs=None, max_batch_candidates=256,
+                 max_wait_ms=20, logger=None):
+        self.task_runner = task_runner
+        self.labels = [task_runner.idx2label[idx] for idx in range(len(task_runner.label2idx))]
+        self.neg_label_id = neg_label_id
+        self.type_map = type_map
+        self.candidate_kwargs = candidate_kwargs if candidate_kwargs else dict()
+        self.logger = logger
+        self.metrics = ServiceMetrics()
+        self.batcher = MicroBatcher(task_runner.predict_candidates, max_batch_candidates=max_batch_candidates,
+                                    max_wait_ms=max_wait_ms, metrics=self.metrics)
+
+    async def predict_candidates(self, request):
+        candidates = request.get("candidates")
+        if not isinstance(candidates, list):
+            raise BadRequest("expect a list of candidates")
+        if not candidates:
+            return {"predictions": [], "labels": self.labels}
+        neg_label = self.labels[self.neg_label_id]
+        label_ids, probs = await self.batcher.submit([candidate_columns(c, neg_label) for c in candidates])
+
+        predictions = []
+        for label_id, prob in zip(label_ids.tolist(), probs.astype(np.float32)):
+            prediction = {"label": self.labels[label_id], "score": round(float(prob[label_id]), 4)}
+            if request.get("return_probs"):
+                prediction["probs"] = [round(float(p), 4) for p in prob]
+            predictions.append(prediction)
+        return {"predictions": predictions, "labels": self.labels}
+
+    async def predict_note(self, request):
+        text, ann = request.get("text"), request.get("ann")
+        if not isinstance(text, str) or not isinstance(ann, str):
+            raise BadRequest("expect text and ann (brat entities) of a note")
+        fid = str(request.get("fid", "note"))
+        loop = asyncio.get_running_loop()
+        try:
+            candidates = await loop.run_in_executor(None, partial(
+                create_candidate_records, text, parse_annotations(ann.split("\n")), fid, **self.candidate_kwargs))
+        except Exception as ex:
+            raise BadRequest("cannot create candidates from the note: {}".format(ex))
+
+        relations = []
+        if candidates:
+            note_columns = [columns for _, columns in candidates]
+            label_ids, probs = await self.batcher.submit(note_columns)
+            for idx in np.nonzero(label_ids != self.neg_label_id)[0].tolist():
+                _, _, _, en_type_1, en_type_2, arg1, arg2, _ = note_columns[idx]
+                label_id = int(label_ids[idx])
+                rel_type = self.type_map[(en_type_1, en_type_2)] if self.type_map is not None \
+                    else self.labels[label_id]
+                relations.append({"type": rel_type, "arg1": arg1, "arg2": arg2,
+                                  "score": round(float(probs[idx][label_id]), 4)})
+
+        rels = [BRAT_REL_TEMPLATE.format(idx, rel["type"], rel["arg1"], rel["arg2"])
+                for idx, rel in enumerate(relations, 1)]
+        return {"fid": fid, "num_candidates": len(candidates), "relations": relations,
+                "ann": "\n".join([ann.strip()] + rels)}
+
+    def metrics_snapshot(self):
+        return self.metrics.snapshot(queue_requests=self.batcher.queue.qsize() if self.batcher.queue else 0,
+                                     queue_candidates=self.batcher.queue_candidates)
+
+    async def route(self, method, path, body):
+        routes = {"/predict/candidates": ("POST", self.predict_candidates),
+                  "/predict/note": ("POST", self.predict_note)}
+        if path == "/health":
+            return 200, {"status": "ok", "labels": self.labels}
+        if path == "/metrics":
+            return 200, self.metrics_snapshot()
+        if path not in routes:
+            return 404, {"error": "unknown path {}".format(path)}
+        expected_method, handler = routes[path]
+        if method != expected_method:
+            return 405, {"error": "{} only accepts {}".format(path, expected_method)}
+
+        start = time.time()
+        try:
+            request = json.loads(body.decode("utf-8")) if body else dict()
+            if not isinstance(request, dict):
+                raise BadRequest("expect a json object")
+            response = 200, await handler(request)
+        except (BadRequest, ValueError) as ex:
+            response = 400, {"error": str(ex)}
+        except Exception as ex:
+            if self.logger:
+                self.logger.error("Prediction error:\n{}".format(traceback.format_exc()))
+            response = 500, {"error": str(ex)}
+        self.metrics.add_request(time.time() - start, error=response[0] != 200)
+        return response
+
+    @staticmethod
+    async def _write_response(writer, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+            status, HTTP_REASONS[status], len(data)).encode("latin-1") + data)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        """a minimal HTTP/1.1 server with keep-alive; bodies are read by Content-Length"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError
+                except ValueError:
+                    # the end of the body is unknown, so the connection cannot be kept alive
+                    await self._write_response(writer, 400, {"error": "invalid Content-Length {}".format(
+                        headers["content-length"])})
+                    break
+                body = await reader.readexactly(content_length)
+
+                status, payload = await self.route(method, path.split("?")[0], body)
+                await self._write_response(writer, status, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_socket=None):
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            address = unix_socket
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            address = "http://{}:{}".format(host, port)
+        if self.logger:
+            self.logger.info("relation extraction service is ready at {} (labels: {})".format(address, self.labels))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+def app(gargs):
+    # the service does not read any data dir
+    gargs.data_dir = gargs.new_model_dir
+    start = time.time()
+    task_runner, neg_label_id, type_map, candidate_kwargs = init_pipeline(gargs)
+    gargs.logger.info("model loaded in {:.1f} sec".format(time.time() - start))
+
+    service = InferenceService(task_runner, neg_label_id, type_map=type_map, candidate_kwargs=candidate_kwargs,
+                               max_batch_candidates=gargs.max_batch_candidates, max_wait_ms=gargs.max_wait_ms,
+                               logger=gargs.logger)
+    asyncio.run(service.serve(host=gargs.host, port=gargs.port, unix_socket=gargs.unix_socket))
+
+
+if __name__ == '__main__':
+    parser = get_args_parser()
+    parser.add_argument("--host", default="127.0.0.1", type=str,
+                        help="address to listen on")
+    parser.add_argument("--port", default=8000, type=int,
+                        help="port to listen on")
+    parser.add_argument("--unix_socket", default=None, type=str,
+                        help="if set, listen on this Unix socket instead of host:port")
+    parser.add_argument("--max_batch_candidates", default=256, type=int,
+                        help="run a micro-batch once it has this many candidates")
+    parser.add_argument("--max_wait_ms", default=20, type=float,
+                        help="run a micro-batch once its first request waited this long (latency deadline)")
+    args = parser.parse_args()
+
+    # other setup
+    args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    args.logger = TransformerLogger(logger_file=args.log_file, logger_level=args.log_lvl).get_logger()
+    app(args)
@@ -0,0 +1,210 @@
+"""
+Run a LoRA sweep (e.g., rank 4/8/16 or several cutoff data sets) in a single process
+
+run_lora_exp.sh and run_cutoff_exp.sh launch one process per setting, so each setting reloads the base LLaMA
+and re-tokenizes the same data. Here the base model is loaded once and the features are created once per data dir.
+For each setting, a fresh LoRA adapter is created on the loaded base model, trained, evaluated on dev and unloaded.
+All results are written into one table (sweep_results.tsv under new_model_dir).
+"""
+
+
+import itertools
+import time
+import traceback
+from pathlib import Path
+
+import torch
+from peft import get_peft_model
+from utils import TransformerLogger
+from task import TaskRunner, mycache_dir, mod_to_save, loss_dict
+from relation_extraction import get_args_parser, set_seed, check_args
+from data_processing.io_utils import save_text, save_json
+from data_utils import RelationDataFormatSepProcessor, RelationDataFormatUniProcessor
+
+
+# modules fully trained (not LoRA) during fine-tuning; peft adds the classification head for SEQ_CLS
+SWEEP_RESET_MODULES = set(mod_to_save) | {"score", "classifier"}
+SWEEP_MODEL_TYPES = {"llama1", "llama2"}
+SWEEP_RESULT_HEADER = ["data_dir", "lora_rank", "lora_alpha", "best_dev_f1", "final_dev_acc", "final_dev_f1",
+                       "train_time_sec"]
+
+
+class SweepRunner(TaskRunner):
+    def task_runner_sweep_init(self):
+        # set up data processor
+        if self.args.data_format_mode == 0:
+            self.data_processor = RelationDataFormatSepProcessor(
+                max_seq_len=self.args.max_seq_length, num_core=self.args.num_core)
+        elif self.args.data_format_mode == 1:
+            self.data_processor = RelationDataFormatUniProcessor(
+                max_seq_len=self.args.max_seq_length, num_core=self.args.num_core)
+        else:
+            raise NotImplementedError("Only support 0, 1 but get data_format_mode as {}"
+                                      .format(self.args.data_format_mode))
+        self.data_processor.set_data_dir(self.args.data_dir)
+        self.data_processor.set_header(self.args.data_file_header)
+
+        if self.args.fp16:
+            self._load_amp_for_fp16()
+        self._init_base_model()
+        self.data_processor.set_tokenizer(self.tokenizer)
+        self.data_processor.set_tokenizer_type(self.args.model_type)
+
+    def _init_base_model(self):
+        """same as _init_new_model for llama1 and llama2 but without any LoRA adapter"""
+        self.args.logger.info("Init base model for sweep...")
+        model, _, _ = self.model_dict[self.args.model_type]
+        total_token_num = self._init_new_tokenizer_and_config()
+
+        self.base_model = model.from_pretrained(
+            self.args.pretrained_model,
+            cache_dir=mycache_dir if self.args.model_type == "llama2" else None,
+            config=self.config,
+            torch_dtype=getattr(torch, 'bfloat16'),
+            low_cpu_mem_usage=True,
+        )
+        self.config.vocab_size = total_token_num
+        # resize embedding layer as we add special tokens
+        self.base_model.resize_token_embeddings(total_token_num)
+        self.base_model.to(self.args.device)
+
+        # keep a copy of the fully trained modules so every adapter starts from the same weights
+        self._base_module_state = {
+            n: p.detach().cpu().clone() for n, p in self.base_model.named_parameters()
+            if SWEEP_RESET_MODULES & set(n.split("."))}
+
+    def init_new_adapter(self, lora_rank, lora_alpha):
+        peft_config = self._new_lora_config(lora_rank=lora_rank, lora_alpha=lora_alpha)
+        self.args.logger.info("new LoRA adapter:\n{}".format(peft_config))
+        self.model = get_peft_model(self.base_model, peft_config)
+        self.model.print_trainable_parameters()
+        self._convert_model_to_bfloat16()
+        self.model.to(self.args.device)
+
+        self.train_data_loader = self._train_data_loader
+        self._init_optimizer()
+
+    def unload_adapter(self):
+        # unload removes LoRA layers but keeps the trained copy of modules_to_save; restore them from the base
+        self.base_model = self.model.unload()
+        if hasattr(self.base_model, "peft_config"):
+            del self.base_model.peft_config
+        # strict=False since only the reset modules are restored; each of them must be restored by name
+        restored = self.base_model.load_state_dict(self._base_module_state, strict=False)
+        not_restored = {n for n, _ in self.base_model.named_parameters() if SWEEP_RESET_MODULES & set(n.split("."))} \
+            - set(self._base_module_state)
+        if restored.unexpected_keys or not_restored:
+            raise RuntimeError("cannot restore the base modules after unloading the adapter; unknown keys: {}; "
+                               "keys not restored: {}".format(sorted(restored.unexpected_keys), sorted(not_restored)))
+        self.model, self.optimizer, self.scheduler = None, None, None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def reset_train_dev_dataloader(self, data_dir):
+        """create train/dev (and test) features for a new data dir; reused by all adapters in the sweep"""
+        self.args.data_dir = str(data_dir)
+        self.data_processor.set_data_dir(data_dir)
+        _, label2idx, _ = self.data_processor.get_labels()
+        if set(label2idx) != set(self.label2idx):
+            raise RuntimeError("all data dirs in a sweep must share the same labels, but get {} in {} and {}"
+                               .format(sorted(label2idx), data_dir, sorted(self.label2idx)))
+        self.train_data_loader = None
+        self.dev_data_loader = None
+        self.dev_sample_data_loader = None
+        self.test_data_loader = None
+        self._init_dataloader()
+        # train() replaces train_data_loader with the accelerate prepared one, keep the original for next adapter
+        self._train_data_loader = self.train_data_loader
+
+    def set_run_dir(self, run_dir):
+        self.new_model_dir_path = Path(run_dir)
+        self.new_model_dir_path.mkdir(parents=True, exist_ok=True)
+        self.loss_file_path = self.new_model_dir_path / "final_loss_dict.pickle"
+
+
+def format_results(results):
+    lines = ["\t".join(SWEEP_RESULT_HEADER)]
+    for res in results:
+        lines.append("\t".join([str(res[k]) for k in SWEEP_RESULT_HEADER]))
+    return "\n".join(lines)
+
+
+def app(gargs):
+    gargs.model_type = gargs.model_type.lower()
+    if gargs.model_type not in SWEEP_MODEL_TYPES:
+        raise NotImplementedError("LoRA sweep only support {} but get model_type as {}"
+                                  .format(sorted(SWEEP_MODEL_TYPES), gargs.model_type))
+    # a sweep is compared on dev
+    gargs.do_train = True
+    gargs.do_eval = True
+    set_seed(gargs)
+    check_args(gargs)
+
+    sweep_data_dirs = gargs.sweep_data_dirs if gargs.sweep_data_dirs else [gargs.data_dir]
+    sweep_configs = list(itertools.product(gargs.lora_ranks, gargs.lora_alphas))
+    gargs.logger.info("LoRA sweep on data: {}; (rank, alpha): {}".format(sweep_data_dirs, sweep_configs))
+
+    task_runner = SweepRunner(gargs)
+    start = time.time()
+    task_runner.task_runner_sweep_init()
+    gargs.logger.info("base model loaded in {:.1f} sec (paid once for the sweep)".format(time.time() - start))
+
+    results = []
+    for data_dir in sweep_data_dirs:
+        start = time.time()
+        task_runner.reset_train_dev_dataloader(data_dir)
+        gargs.logger.info("features for {} created in {:.1f} sec".format(data_dir, time.time() - start))
+
+        for lora_rank, lora_alpha in sweep_configs:
+            # every setting starts from the same seed as a separate run would
+            set_seed(gargs)
+            run_name = "{}_lora_r{}_a{}".format(Path(data_dir).name, lora_rank, lora_alpha)
+            task_runner.set_run_dir(Path(gargs.new_model_dir) / run_name)
+            loss_dict.clear()
+
+            try:
+                task_runner.init_new_adapter(lora_rank, lora_alpha)
+                start = time.time()
+                best_f1 = task_runner.train()
+                train_time = time.time() - start
+                acc, _, f1 = task_runner.eval(gargs.non_relation_label)
+
+                if gargs.do_predict:
+                    preds = task_runner.predict()
+                    save_text("\n".join([str(pred) for pred in preds]),
+                              task_runner.new_model_dir_path / "predictions.txt")
+            except Exception as ex:
+                gargs.logger.error("Sweep error in {}:\n{}".format(run_name, traceback.format_exc()))
+                raise RuntimeError(traceback.format_exc())
+
+            results.append({"data_dir": data_dir, "lora_rank": lora_rank, "lora_alpha": lora_alpha,
+                            "best_dev_f1": best_f1, "final_dev_acc": acc, "final_dev_f1": f1,
+                            "train_time_sec": round(train_time, 1)})
+            gargs.logger.info("sweep result:\n{}".format(format_results(results[-1:])))
+            task_runner.unload_adapter()
+
+    table = format_results(results)
+    save_text(table, Path(gargs.new_model_dir) / "sweep_results.tsv")
+    gargs.logger.info("LoRA sweep results:\n{}".format(table))
+
+
+if __name__ == '__main__':
+    parser = get_args_parser()
+    parser.add_argument("--lora_ranks", default=[4, 8, 16], type=int, nargs='+',
+                        help="LoRA ranks to sweep")
+    parser.add_argument("--lora_alphas", default=[32], type=int, nargs='+',
+                        help="LoRA alphas to sweep; every (rank, alpha) combination is trained")
+    parser.add_argument("--sweep_data_dirs", default=None, type=str, nargs='+',
+                        help="data dirs to sweep (e.g., cutoff_0 cutoff_1 ...); "
+                             "features are created once per dir and shared by all LoRA settings. "
+                             "If not set, only use data_dir")
+    args = parser.parse_args()
+
+    # save the experiment arguments into a file under new model dir
+    Path(args.new_model_dir).mkdir(exist_ok=True, parents=True)
+    save_json(vars(args), Path(args.new_model_dir) / "sweep_arguments.json")
+
+    # other setup
+    args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    args.logger = TransformerLogger(logger_file=args.log_file, logger_level=args.log_lvl).get_logger()
+    app(args)
@@ -5,7 +5,8 @@ import random
 from utils import TransformerLogger
 from task import TaskRunner
 from pathlib import Path
-from data_processing.io_utils import save_text, save_json
+from data_processing.io_utils import save_text, save_json, prediction_arrays_dir, save_prediction_arrays
+from data_processing.post_processing import iter_mappings, candidate_mappings_file
 import traceback
 import warnings
 
@@ -35,15 +36,50 @@ def check_args(args):
         warnings.warn("You set the eval mode so we expect max_num_checkpoints large than 0 so we set it to 1.")
         args.max_num_checkpoints = 1
 
+    if (args.eval_step > 0 or args.early_stop_patience > 0) and not args.do_eval:
+        warnings.warn("Intra-epoch evaluation (eval_step) and early stopping (early_stop_patience) "
+                      "require evaluation mode (do_eval). We disabled both for you.")
+        args.eval_step = -1
+        args.early_stop_patience = -1
+
+    if args.dev_brat_dir and not args.do_eval:
+        warnings.warn("dev_brat_dir is only used with evaluation mode (do_eval).")
+
+    if not 0 < args.train_neg_sample_ratio <= 1:
+        raise RuntimeError("train_neg_sample_ratio should be in (0, 1] but get {}".format(args.train_neg_sample_ratio))
+
+    if not 0 < args.eval_sample_ratio <= 1:
+        raise RuntimeError("eval_sample_ratio should be in (0, 1] but get {}".format(args.eval_sample_ratio))
+
     if args.do_train and Path(args.new_model_dir).exists() and not args.overwrite_model_dir:
         raise RuntimeError("{} is exist and overwrite this dir is not permitted.".format(args.new_model_dir))
 
+    if args.ckpt_dirs:
+        if args.do_train or not args.do_predict:
+            raise RuntimeError("ckpt_dirs (multi-adapter prediction) is only available with do_predict "
+                               "and without do_train.")
+        if len({Path(ckpt_dir).resolve() for ckpt_dir in args.ckpt_dirs}) != len(args.ckpt_dirs):
+            raise RuntimeError("ckpt_dirs should not have duplicated dirs but get {}".format(args.ckpt_dirs))
+        # the first adapter is loaded with the base model, the others are switched in during prediction
+        args.ckpt_dir = args.ckpt_dirs[0]
+        if args.save_prediction_arrays:
+            warnings.warn("save_prediction_arrays is not supported with ckpt_dirs; only text predictions are saved")
+
     if args.use_binary_classification_mode:
         line = "*" * 20
         info = "You turn on the binary mode, make sure you use binary data format."
         warnings.warn(f"{line}\n{info}\n{line}\n")
 
 
+def adapter_predict_output_file(predict_output_file, ckpt_dir, idx):
+    """
+        predictions.txt + 1 (position in ckpt_dirs) + /models/lora_8/ckpt_0 -> predictions_1_lora_8_ckpt_0.txt
+        the position keeps the files of dirs with the same last two names (/a/run/ckpt_1, /b/run/ckpt_1) apart
+    """
+    pof, ckpt_dir = Path(predict_output_file), Path(ckpt_dir)
+    return pof.parent / "{}_{}_{}_{}{}".format(pof.stem, idx, ckpt_dir.parent.name, ckpt_dir.name, pof.suffix)
+
+
 def app(gargs):
     set_seed(gargs)
     check_args(gargs)
@@ -62,10 +98,26 @@ def app(gargs):
             traceback.print_exc()
             raise RuntimeError()
 
-    if gargs.do_predict:
+    if gargs.do_predict and gargs.ckpt_dirs:
+        # run prediction for each adapter; base model and test features are loaded only once
+        try:
+            for idx, (ckpt_dir, preds) in enumerate(task_runner.predict_with_adapters(gargs.ckpt_dirs)):
+                pred_res = "\n".join([str(pred) for pred in preds])
+                ofn = adapter_predict_output_file(gargs.predict_output_file, ckpt_dir, idx)
+                ofn.parent.mkdir(parents=True, exist_ok=True)
+                save_text(pred_res, ofn)
+                gargs.logger.info("predictions of {} saved at {}".format(ckpt_dir, ofn))
+        except Exception as ex:
+            gargs.logger.error("Prediction error:\n{}".format(traceback.format_exc()))
+            raise RuntimeError(traceback.format_exc())
+    elif gargs.do_predict:
         # run prediction
         try:
-            preds = task_runner.predict()
+            if gargs.save_prediction_arrays:
+                label_ids, probs = task_runner.predict_with_probs()
+                preds = [task_runner.idx2label[label_id] for label_id in label_ids.tolist()]
+            else:
+                preds = task_runner.predict()
         except Exception as ex:
             gargs.logger.error("Prediction error:\n{}".format(traceback.format_exc()))
             raise RuntimeError(traceback.format_exc())
@@ -76,8 +128,22 @@ def app(gargs):
         Path(gargs.predict_output_file).parent.mkdir(parents=True, exist_ok=True)
         save_text(pred_res, gargs.predict_output_file)
 
+        if gargs.save_prediction_arrays:
+            # keep the mapping columns (entity types, entity ids, file id) so post-processing needs no tsv parsing
+            # test.tsv, or test_mappings.tsv of a feature store
+            mappings_file = candidate_mappings_file(gargs.data_dir, "test")
+            mappings = list(iter_mappings(mappings_file, num_cols=5)) if mappings_file.is_file() else []
+            if len(mappings) != len(preds) or any(len(m) != 5 for m in mappings):
+                gargs.logger.warning("{} has no candidate mappings; save predictions only".format(mappings_file))
+                mappings = None
+            pred_dir = prediction_arrays_dir(gargs.predict_output_file)
+            save_prediction_arrays(pred_dir, label_ids, probs,
+                                   [task_runner.idx2label[idx] for idx in range(len(task_runner.label2idx))],
+                                   mappings=mappings)
+            gargs.logger.info("prediction arrays saved at {}".format(pred_dir))
 
-if __name__ == '__main__':
+
+def get_args_parser():
     parser = argparse.ArgumentParser()
     # parse arguments
     parser.add_argument("--model_type", default='bert', type=str, required=True,
@@ -119,6 +185,11 @@ if __name__ == '__main__':
                         help="The batch size for training.")
     parser.add_argument("--eval_batch_size", default=8, type=int,
                         help="The batch size for eval.")
+    parser.add_argument("--train_max_tokens", default=-1, type=int,
+                        help="if > 0, bound each training batch by total tokens (e.g., 4096) "
+                             "instead of train_batch_size; padding is trimmed per batch")
+    parser.add_argument("--eval_max_tokens", default=-1, type=int,
+                        help="if > 0, bound each dev/test batch by total tokens instead of batch size")
     parser.add_argument("--learning_rate", default=1e-5, type=float,
                         help="The initial learning rate for Adam.")
     parser.add_argument("--num_train_epochs", default=10, type=int,
@@ -138,6 +209,23 @@ if __name__ == '__main__':
     parser.add_argument("--max_num_checkpoints", default=0, type=int,
                         help="max number of checkpoints saved during training, old checkpoints will be removed."
                              "if 0, then only save the last one at the end of training")
+    parser.add_argument("--eval_step", default=-1, type=int,
+                        help="evaluate on dev every eval_step global steps within each epoch (require do_eval). "
+                             "If < 0, only evaluate at the end of each epoch. "
+                             "Checkpoints are then named by global step (ckpt_<step>) instead of epoch.")
+    parser.add_argument("--eval_sample_ratio", default=1.0, type=float,
+                        help="ratio of a stratified dev sample used for intra-epoch evaluation (with eval_step); "
+                             "1.0 means using the whole dev set")
+    parser.add_argument("--dev_brat_dir", default=None, type=str,
+                        help="gold brat annotations (.ann) of the dev notes; if set (with do_eval), the relation "
+                             "scores of the dev predictions against them (as post_processing and brat_eval) are "
+                             "also reported at each full dev evaluation")
+    parser.add_argument("--brat_type_map", default=None, type=str,
+                        help="a map of entity pair types to relation types for dev_brat_dir scores in bin mode "
+                             "(labels are pos and non_relation_label)")
+    parser.add_argument("--early_stop_patience", default=-1, type=int,
+                        help="stop training if dev F1 has not improved for this many evaluations in a row "
+                             "(require do_eval). If < 1, no early stopping")
     parser.add_argument("--log_file", default=None,
                         help="where to save the log information")
     parser.add_argument("--log_lvl", default="i", type=str,
@@ -164,6 +252,10 @@ if __name__ == '__main__':
                         help="if use this mode, we will use BCEWithLogitsLoss or binary focal loss functions.")
     parser.add_argument('--balance_sample_weights', action='store_true',
                         help="Whether to create sample weights and pass it to loss functions")
+    parser.add_argument("--train_neg_sample_ratio", default=1.0, type=float,
+                        help="ratio of negative (non_relation_label) training examples sampled in each epoch; "
+                             "all positive examples are always used and a fresh sample of negatives is drawn "
+                             "every epoch. 1.0 means using all negative examples")
     
     # using pytorch ddp
     # parser.add_argument('--ddp', action='store_true',
@@ -173,11 +265,25 @@ if __name__ == '__main__':
 
     parser.add_argument('--ckpt_dir', default=None, type=str,
                         help="The checkpoint path for loading the model during prediction")  
+    parser.add_argument("--save_prediction_arrays", action='store_true',
+                        help="also save label ids, float16 label probabilities, the label table and the candidate "
+                             "mappings as .npy files in <predict_output_file stem>_arrays/; "
+                             "post_processing.py accepts this dir as --predict_result_file")
+    parser.add_argument('--ckpt_dirs', default=None, type=str, nargs='+',
+                        help="several LoRA adapter checkpoint paths (e.g., different ranks or ckpt_N) to predict with; "
+                             "the base model and test data are loaded once and one prediction file "
+                             "(predict_output_file with the checkpoint name appended) is written for each adapter")
     ## New arguments for LoRA
     parser.add_argument('--lora_rank', default=8, type=int,
                         help="The rank of the LoRA weight matrix")
     parser.add_argument('--lora_alpha', default=32, type=int,
                         help="The alpha parameter of the LoRA")
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_args_parser()
     args = parser.parse_args()
     
     # save the experiment arguments into a file under new model dir
@@ -29,6 +29,8 @@ class Args:
         self.do_lower_case = True
         self.train_batch_size = 8
         self.eval_batch_size = 32
+        self.train_max_tokens = -1
+        self.eval_max_tokens = -1
         self.learning_rate = 1e-5
         self.num_train_epochs = 4
         self.gradient_accumulation_steps = 1
@@ -38,6 +40,13 @@ class Args:
         self.adam_epsilon = 1e-8
         self.max_grad_norm = 1.0
         self.max_num_checkpoints = 0
+        self.eval_step = -1
+        self.eval_sample_ratio = 1.0
+        self.dev_brat_dir = None
+        self.brat_type_map = None
+        self.early_stop_patience = -1
+        self.ckpt_dirs = None
+        self.save_prediction_arrays = False
         self.log_file = "./bert_re_log_txt"
         self.log_lvl = "i"
         self.log_step = 100
@@ -50,6 +59,7 @@ class Args:
         self.focal_loss_gamma = 2
         self.use_binary_classification_mode = False
         self.balance_sample_weights = False
+        self.train_neg_sample_ratio = 1.0
 
         self.__update_args(**kwargs)
 
@@ -0,0 +1,120 @@
+# coding=utf-8
+
+"""
+Relation extraction as a python library: load a trained model once and predict many in-memory candidates
+
+    from relation_extractor import RelationExtractor
+
+    extractor = RelationExtractor("./model", model_type="bert", do_lower_case=True)
+    labels, scores = extractor.predict([
+        {"sent1": "... [s1] metoprolol [e1] ...", "sent2": "... [s2] 100 mg [e2] ...",
+         "en1_type": "Drug", "en2_type": "Strength"},
+        ("... [s1] rash [e1] ...", "... [s2] penicillin [e2] ..."),
+    ])
+
+Nothing is written (no training_arguments.json, data dirs or prediction files); the model dir is only read.
+Unlike run_app.py, no Args object with training options is needed.
+"""
+
+
+import argparse
+import logging
+
+import numpy as np
+import torch
+from brat_pipeline import PipelineRunner
+from data_processing.data_format_conf import NON_RELATION_TAG
+
+
+# keys of a candidate record given as a dict, in the order of the tsv columns after the label
+CANDIDATE_KEYS = ("sent1", "sent2", "en1_type", "en2_type", "en1_id", "en2_id", "fid")
+
+
+def candidate_columns(record, label):
+    """
+        a candidate record as the 8 tsv columns used for feature creation (label, sent1, sent2, en1_type, ...)
+        record: a dict with CANDIDATE_KEYS (sent1 and sent2 required), (sent1, sent2) or the 8 tsv columns
+        label is a placeholder when the record has no label column; it is not used for prediction
+    """
+    if isinstance(record, dict):
+        if "sent1" not in record or "sent2" not in record:
+            raise ValueError("a candidate needs sent1 and sent2 but get {}".format(sorted(record)))
+        return [label] + [str(record.get(k, "")) for k in CANDIDATE_KEYS]
+    if isinstance(record, (list, tuple)):
+        if len(record) == 2:
+            return [label] + [str(c) for c in record] + [""] * 5
+        if len(record) == 8:
+            return [label] + [str(c) for c in record[1:]]
+    raise ValueError("a candidate should be (sent1, sent2), 8 tsv columns or a dict but get {}".format(record))
+
+
+class RelationExtractor:
+    """
+        load a trained model once (new_model_dir, or ckpt_dir and pretrained_model for llama) for prediction
+        predict(records) returns the predicted labels and their probabilities
+    """
+    def __init__(self, new_model_dir, model_type="bert", data_format_mode=0, max_seq_length=512,
+                 do_lower_case=False, eval_batch_size=32, eval_max_tokens=-1, non_relation_label=NON_RELATION_TAG,
+                 ckpt_dir=None, pretrained_model=None, device=None, logger=None):
+        self.args = argparse.Namespace(
+            model_type=model_type.lower(),
+            data_format_mode=data_format_mode,
+            new_model_dir=new_model_dir,
+            # not read; the data processor requires a data dir
+            data_dir=new_model_dir,
+            ckpt_dir=ckpt_dir,
+            pretrained_model=pretrained_model,
+            max_seq_length=max_seq_length,
+            do_lower_case=do_lower_case,
+            eval_batch_size=eval_batch_size,
+            eval_max_tokens=eval_max_tokens,
+            non_relation_label=non_relation_label,
+            num_core=1,
+            data_file_header=True,
+            cache_data=False,
+            progress_bar=False,
+            fp16=False,
+            do_train=False,
+            do_eval=False,
+            do_predict=True,
+            use_binary_classification_mode=False,
+            device=torch.device(device) if device else torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+            logger=logger if logger else logging.getLogger(__name__))
+
+        self.task_runner = PipelineRunner(self.args)
+        self.task_runner.task_runner_batch_init()
+        self.labels = [self.task_runner.idx2label[idx] for idx in range(len(self.task_runner.label2idx))]
+        # placeholder label of records without a label column
+        self._placeholder_label = non_relation_label if non_relation_label in self.task_runner.label2idx \
+            else self.labels[0]
+
+    def predict_ids(self, records, batch_size=1024):
+        """
+            label ids (array) and label probabilities (float16 array, one column per label) of the records
+            records are tokenized and predicted batch_size at a time to bound memory
+        """
+        label_ids, probs = [], []
+        records = list(records)
+        for start in range(0, len(records), batch_size):
+            columns = [candidate_columns(record, self._placeholder_label)
+                       for record in records[start:start+batch_size]]
+            batch_label_ids, batch_probs = self.task_runner.predict_candidates(columns)
+            label_ids.append(batch_label_ids)
+            probs.append(batch_probs)
+        if not label_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(self.labels)), dtype=np.float16)
+
+        return np.concatenate(label_ids), np.concatenate(probs)
+
+    def predict(self, records, batch_size=1024, return_probs=False):
+        """
+            the predicted label and its probability (score) of each record
+            return labels (list) and scores (float32 array); and the probabilities of all labels if return_probs
+        """
+        label_ids, probs = self.predict_ids(records, batch_size=batch_size)
+        labels = [self.labels[label_id] for label_id in label_ids.tolist()]
+        scores = probs[np.arange(len(label_ids)), label_ids].astype(np.float32)
+        if return_probs:
+            return labels, scores, probs
+
+        return labels, scores
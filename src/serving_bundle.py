@@ -0,0 +1,103 @@
+# coding=utf-8
+
+"""
+Export a trained model as a serving bundle for fast loading at prediction
+
+python src/serving_bundle.py --model_type llama2 --new_model_dir ./model --ckpt_dir ./model/ckpt_3 \
+    --pretrained_model meta-llama/Llama-2-7b-hf --bundle_dir ./model_bundle --dtype bfloat16
+
+A trained model is normally loaded with several transforms: the base weights are loaded, the token embeddings
+are resized (twice for llama), the LoRA adapter is applied with peft and the parameters are cast to bfloat16 one
+by one. The bundle stores the result of these steps: safetensors weights (LoRA merged into the base weights,
+embeddings resized, in the target dtype), the model config, the tokenizer (with the special tags and pad token)
+and label_index.pkl, for any MODEL_DICT model_type.
+
+Pass the bundle dir as --new_model_dir (or --ckpt_dir) to relation_extraction.py, batch_prediction.py,
+brat_pipeline.py, inference_server.py or RelationExtractor; the weights are memory-mapped and used as saved.
+"""
+
+
+import argparse
+from pathlib import Path
+
+import torch
+from relation_extractor import RelationExtractor
+from config import VERSION, SERVING_BUNDLE_FILE
+from data_processing.io_utils import pkl_save, save_json_atomic
+
+
+DTYPES = ("float32", "float16", "bfloat16")
+LLAMA_MODEL_TYPES = ("llama1", "llama2", "llama1_pre", "llama2_pre")
+
+
+def default_dtype(model_type):
+    """the dtype used for prediction without a bundle: bfloat16 for llama, float32 for the others"""
+    return "bfloat16" if model_type in LLAMA_MODEL_TYPES else "float32"
+
+
+def export_serving_bundle(task_runner, bundle_dir, dtype=None):
+    """
+        save the loaded model of task_runner (after _init_trained_model) as a serving bundle in bundle_dir
+        dtype is one of DTYPES; default_dtype of the model type if None
+    """
+    model_type = task_runner.args.model_type
+    dtype = dtype if dtype else default_dtype(model_type)
+    if dtype not in DTYPES:
+        raise ValueError("expect dtype to be one of {} but get {}".format(DTYPES, dtype))
+    bundle_dir = Path(bundle_dir)
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+
+    model = task_runner.model
+    if hasattr(model, "merge_and_unload"):
+        # LoRA (peft) model: merge the adapter into the base weights; the trained classification head is kept
+        model = model.merge_and_unload()
+    model = model.to(getattr(torch, dtype))
+    model.config.torch_dtype = getattr(torch, dtype)
+
+    # the marker file is written last, so an interrupted export is not loaded as a bundle
+    (bundle_dir / SERVING_BUNDLE_FILE).unlink(missing_ok=True)
+    model.save_pretrained(bundle_dir, safe_serialization=True)
+    task_runner.tokenizer.save_pretrained(bundle_dir)
+    pkl_save((task_runner.label2idx, task_runner.idx2label), bundle_dir/"label_index.pkl")
+    save_json_atomic({"model_type": model_type,
+                      "dtype": dtype,
+                      "num_labels": len(task_runner.label2idx),
+                      "vocab_size": len(task_runner.tokenizer),
+                      "version": VERSION}, bundle_dir / SERVING_BUNDLE_FILE)
+
+    return bundle_dir
+
+
+def app(gargs):
+    for model_dir in (gargs.ckpt_dir, gargs.new_model_dir):
+        if model_dir and (Path(model_dir) / SERVING_BUNDLE_FILE).exists():
+            raise RuntimeError("{} is already a serving bundle".format(model_dir))
+    extractor = RelationExtractor(
+        gargs.new_model_dir, model_type=gargs.model_type, do_lower_case=gargs.do_lower_case,
+        ckpt_dir=gargs.ckpt_dir, pretrained_model=gargs.pretrained_model, device=gargs.device)
+    bundle_dir = export_serving_bundle(extractor.task_runner, gargs.bundle_dir, dtype=gargs.dtype)
+    print("serving bundle of {} ({}) saved in {}".format(
+        gargs.model_type, gargs.dtype if gargs.dtype else default_dtype(gargs.model_type), bundle_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", default='bert', type=str, required=True,
+                        help="valid values: bert, roberta, albert, xlnet, megatron, deberta, longformer, "
+                             "llama1, llama2, llama1_pre, llama2_pre")
+    parser.add_argument("--new_model_dir", type=str, required=True,
+                        help="directory of the trained model")
+    parser.add_argument("--ckpt_dir", type=str, default=None,
+                        help="checkpoint dir to export (LoRA adapter for llama); "
+                             "default is the latest checkpoint in new_model_dir")
+    parser.add_argument("--pretrained_model", type=str, default=None,
+                        help="base model of a trained llama model")
+    parser.add_argument("--do_lower_case", action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--bundle_dir", type=str, required=True,
+                        help="where to save the serving bundle")
+    parser.add_argument("--dtype", type=str, default=None, choices=DTYPES,
+                        help="dtype of the saved weights; default bfloat16 for llama and float32 for the others")
+    parser.add_argument("--device", type=str, default="cpu",
+                        help="device used to load and merge the model before saving")
+    app(parser.parse_args())
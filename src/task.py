@@ -6,23 +6,24 @@ This script is used for training and test
 # from data_utils import convert_examples_to_relation_extraction_features
 from data_utils import (features2tensors, relation_extraction_data_loader,
                         batch_to_model_input, RelationDataFormatSepProcessor,
-                        RelationDataFormatUniProcessor)
-from utils import acc_and_f1
-from data_processing.io_utils import pkl_save, pkl_load, save_json
-from transformers import glue_convert_examples_to_features as convert_examples_to_relation_extraction_features
-from transformers import get_linear_schedule_with_warmup, get_cosine_schedule_with_warmup
-from peft import LoraConfig, TaskType, get_peft_model, PeftModel, PeftConfig
+                        RelationDataFormatUniProcessor, stratified_sample_features,
+                        TokenBudgetBatchSampler)
+from utils import acc_and_f1_from_confusion, class_prf_from_confusion, EarlyStopping
+from data_processing.io_utils import pkl_save, pkl_load, pkl_load_chunks, save_json, load_json
+from data_processing.post_processing import candidate_mappings_file
+from brat_eval import BratScorer
+from data_utils import glue_convert_examples_to_features as convert_examples_to_relation_extraction_features
 import torch
 from tqdm import trange, tqdm
 import numpy as np
 from packaging import version
 from pathlib import Path
-from config import SPEC_TAGS, MODEL_DICT, VERSION, NEW_ARGS, CONFIG_VERSION_NAME
+from config import (SPEC_TAGS, MODEL_DICT, VERSION, NEW_ARGS, CONFIG_VERSION_NAME, SERVING_BUNDLE_FILE,
+                    CACHED_EXAMPLES_FILE)
 import shutil
 import os
-import wandb
 import pickle
-from accelerate import Accelerator
+# peft (llama), wandb (training) and accelerate are imported where they are used, so importing task stays cheap
 # from transformers.deepspeed import HfDeepSpeedConfig
 #import deepspeed
 
@@ -58,8 +59,12 @@ class TaskRunner(object):
         self.model_dict = MODEL_DICT
         self.train_data_loader = None
         self.dev_data_loader = None
+        self.dev_sample_data_loader = None
         self.test_data_loader = None
         self.data_processor = None
+        self.dev_brat_scorer = None
+        # the checkpoint (or serving bundle) dir the model for prediction is loaded from
+        self.trained_model_dir = None
         self.new_model_dir_path = Path(self.args.new_model_dir)
         self.new_model_dir_path.mkdir(parents=True, exist_ok=True)
         self._use_amp_for_fp16_from = 0
@@ -111,7 +116,11 @@ class TaskRunner(object):
         self.args.logger.info("Saving loss in file..{}".format(self.loss_file_path))
         tr_loss = .0
         t_step = 1
-        latest_best_score = .0
+        early_stopper = EarlyStopping(patience=self.args.early_stop_patience)
+        # batches planned ahead by a token budget sampler are dropped when training ends (see below)
+        batch_sampler = self.train_data_loader.batch_sampler
+        import wandb
+        from accelerate import Accelerator
         accelerator = Accelerator()
         self.train_data_loader, self.model, self.optimizer = accelerator.prepare(
                             self.train_data_loader, self.model, self.optimizer
@@ -173,26 +182,31 @@ class TaskRunner(object):
                     wandb.log({"train_loss/step": tr_loss/t_step}, step=t_step)    
                     loss_dict[t_step] = tr_loss/t_step
 
+                # eval on (sampled) dev every eval_step steps within the epoch
+                if self.args.do_eval and self.args.eval_step > 0 and t_step % self.args.eval_step == 0:
+                    self._eval_and_save(epoch, t_step, early_stopper, use_dev_sample=True)
+                    if early_stopper.should_stop:
+                        t_step += 1
+                        break
+
                 t_step += 1
             batch_iter.close()
 
+            if early_stopper.should_stop:
+                self.args.logger.info("early stop at epoch {}; {}".format(epoch+1, early_stopper))
+                break
+
             # at each epoch end, we do eval on dev
-            if self.args.do_eval:
-                acc, pr, f1 = self.eval(self.args.non_relation_label)
-                self.args.logger.info("""
-                ******************************
-                Epcoh: {}
-                evaluation on dev set
-                acc: {}
-                {}; f1:{}
-                ******************************
-                """.format(epoch+1, acc, pr, f1))
-                # max_num_checkpoints > 0, save based on eval
-                # save model
-                if self.args.max_num_checkpoints > 0 and latest_best_score < f1:
-                    self._save_model(epoch+1)
-                    latest_best_score = f1
+            # with intra-epoch eval, use the same (sampled) dev set so scores are comparable for early stopping
+            if self.args.do_eval and not (self.args.eval_step > 0 and (t_step-1) % self.args.eval_step == 0):
+                self._eval_and_save(epoch, t_step-1, early_stopper, use_dev_sample=self.args.eval_step > 0)
+                if early_stopper.should_stop:
+                    self.args.logger.info("early stop at epoch {}; {}".format(epoch+1, early_stopper))
+                    break
         epoch_iter.close()
+        if isinstance(batch_sampler, TokenBudgetBatchSampler):
+            # after early stopping the unused planned epochs must not carry over (e.g., to the next sweep adapter)
+            batch_sampler.reset()
         self.model = accelerator.unwrap_model(self.model)
 
         wandb.finish()
@@ -205,17 +219,60 @@ class TaskRunner(object):
         with open(self.loss_file_path, 'wb') as handle:
             pickle.dump(loss_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-    def eval(self, non_rel_label=""):
+        # best dev F1 seen during training (None if do_eval is not set)
+        return early_stopper.best_score
+
+    def eval(self, non_rel_label="", use_dev_sample=False):
         self.args.logger.info("start evaluation...")
 
-        # this is done on dev
-        true_labels = np.array([dev_fea.label for dev_fea in self.dev_features])
-        preds, eval_loss = self._run_eval(self.dev_data_loader)
-        eval_res = acc_and_f1(
-            labels=true_labels, preds=preds, label2idx=self.label2idx, non_rel_label=non_rel_label)
+        # this is done on dev (or the stratified dev sample for intra-epoch evaluation)
+        if use_dev_sample and self.dev_sample_data_loader is not None:
+            dev_data_loader = self.dev_sample_data_loader
+        else:
+            dev_data_loader = self.dev_data_loader
+        # brat level scores need the predictions of all dev candidates; otherwise only the counts are kept
+        use_brat_eval = self.dev_brat_scorer is not None and dev_data_loader is self.dev_data_loader
+        eval_output = self._run_eval_counts(dev_data_loader, return_preds=use_brat_eval)
+        eval_res = acc_and_f1_from_confusion(eval_output[0], self.label2idx, non_rel_label)
+        per_class, macro = class_prf_from_confusion(eval_output[0], self.label2idx, non_rel_label)
+        self.args.logger.info("macro scores on dev set: precision: {:.4f}; recall: {:.4f}; f1: {:.4f}\n{}".format(
+            *macro, "\n".join(["{}: precision: {:.4f}; recall: {:.4f}; f1: {:.4f}".format(label, *scores)
+                               for label, scores in per_class.items()])))
+
+        if use_brat_eval:
+            for mode, scores in self.brat_eval(eval_output[2]).items():
+                self.args.logger.info("brat {} relation scores on dev set: precision: {}; recall: {}; f1: {}".format(
+                    mode, scores['micro']['precision'], scores['micro']['recall'], scores['micro']['f1']))
 
         return eval_res
 
+    def brat_eval(self, preds):
+        """
+            strict and lenient relation scores of dev predictions (label ids) against the gold brat annotations
+            (dev_brat_dir), same as post_processing and brat_eval but in memory
+        """
+        return self.dev_brat_scorer.score(
+            [self.idx2label[pred] for pred in preds], self.dev_mappings, self.args.non_relation_label,
+            type_map=self.dev_brat_type_map)
+
+    def _eval_and_save(self, epoch, t_step, early_stopper, use_dev_sample=False):
+        import wandb
+        acc, pr, f1 = self.eval(self.args.non_relation_label, use_dev_sample=use_dev_sample)
+        self.args.logger.info("""
+        ******************************
+        Epcoh: {}; global step: {}
+        evaluation on {}
+        acc: {}
+        {}; f1:{}
+        ******************************
+        """.format(epoch+1, t_step, "sampled dev set" if use_dev_sample else "dev set", acc, pr, f1))
+        wandb.log({"dev_f1/step": f1}, step=t_step)
+        # max_num_checkpoints > 0, save based on eval
+        # if we eval within epochs, checkpoints are named by global step instead of epoch
+        is_best = early_stopper.step(f1)
+        if self.args.max_num_checkpoints > 0 and is_best:
+            self._save_model(t_step if self.args.eval_step > 0 else epoch+1)
+
     def predict(self):
         self.args.logger.info("start prediction...")
         # this is for prediction
@@ -226,64 +283,66 @@ class TaskRunner(object):
 
         return preds
 
-    def _init_new_model(self):
-        """initialize a new model for fine-tuning"""
-        self.args.logger.info("Init new model...")
+    def predict_with_probs(self):
+        """same as predict but return the label ids and the label probabilities (float16) as arrays"""
+        self.args.logger.info("start prediction...")
+        return self._predict_probs(self.test_data_loader)
 
-        model, config, tokenizer = self.model_dict[self.args.model_type]
+    def _predict_probs(self, data_loader):
+        logits, _ = self._run_eval(data_loader, return_logits=True)
+        logits = logits.astype(np.float32)
+        probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probs /= probs.sum(axis=-1, keepdims=True)
 
-        # init tokenizer and add special tags
-        self.tokenizer = tokenizer.from_pretrained(self.args.pretrained_model, do_lower_case=self.args.do_lower_case)
-        print("Setting pd_token_______________________")
-        
-        if getattr(self.tokenizer, "pad_token_id") is None:
-            print("assigning custom pad token ---> ", self.tokenizer.eos_token_id)
-            self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
-            
-        last_token_idx = len(self.tokenizer)
-        self.tokenizer.add_tokens(SPEC_TAGS)
-        spec_token_new_ids = tuple([(last_token_idx + idx) for idx in range(len(self.tokenizer) - last_token_idx)])
-        total_token_num = len(self.tokenizer)
+        return np.argmax(logits, axis=-1), probs.astype(np.float16)
 
-        # init config
-        unique_labels, label2idx, idx2label = self.data_processor.get_labels()
-        self.args.logger.info("label to index:\n{}".format(label2idx))
-        save_json(label2idx, self.new_model_dir_path/"label2idx.json")
-        num_labels = len(unique_labels)
-        self.label2idx = label2idx
-        self.idx2label = idx2label
+    def predict_with_adapters(self, ckpt_dirs):
+        """
+            score the test set under each LoRA adapter checkpoint in ckpt_dirs over the loaded base model
+            the base model and test features are loaded once (with args.ckpt_dir as the first adapter),
+            adapters are switched between passes (by position, so a dir can not be skipped);
+            yield (ckpt_dir, preds) for each adapter
+        """
+        from peft import PeftModel
+        if not isinstance(self.model, PeftModel):
+            raise NotImplementedError("multi-adapter prediction only support LoRA (llama) models but get {}"
+                                      .format(self.args.model_type))
+
+        active_adapter = self.model.active_adapter
+        for idx, ckpt_dir in enumerate(ckpt_dirs):
+            ckpt_dir = Path(ckpt_dir)
+            if idx > 0:
+                label2idx, _ = pkl_load(ckpt_dir/"label_index.pkl")
+                if label2idx != self.label2idx:
+                    raise RuntimeError("adapters must share the same label index but get {} in {} and {}"
+                                       .format(label2idx, ckpt_dir, self.label2idx))
+                adapter_name = "adapter_{}".format(idx)
+                self.model.load_adapter(ckpt_dir, adapter_name=adapter_name)
+                self.model.set_adapter(adapter_name)
+                # only keep one adapter in memory
+                self.model.delete_adapter(active_adapter)
+                active_adapter = adapter_name
+                self._convert_model_to_bfloat16()
+                self.model.to(self.args.device)
+
+            self.args.logger.info("predict with adapter from {}".format(ckpt_dir))
+            yield ckpt_dir, self.predict()
+
+    def _convert_model_to_bfloat16(self):
+        for param in self.model.parameters():
+            # Check if parameter dtype is  Float (float32)
+            if param.dtype == torch.float32 or param.dtype == torch.float16 :
+                param.data = param.data.to(torch.bfloat16)
 
-        self.config = config.from_pretrained(self.args.pretrained_model, num_labels=num_labels)
-        self.config.torch_dtype = getattr(torch, 'bfloat16')
-        print("##############")
-        print(self.config)
-        print("##############")
-        self.config.update({CONFIG_VERSION_NAME: VERSION})
-        # The number of tokens to cache.
-        # The key/value pairs that have already been pre-computed in a previous forward pass won’t be re-computed.
-        if self.args.model_type == "xlnet":
-            self.config.mem_len = self.config.d_model
-            # change dropout name
-            self.config.hidden_dropout_prob = self.config.dropout
+    def _init_new_model(self):
+        """initialize a new model for fine-tuning"""
+        self.args.logger.info("Init new model...")
+
+        model, _, _ = self.model_dict[self.args.model_type]
+        total_token_num = self._init_new_tokenizer_and_config()
+        if self.args.model_type in ("llama1", "llama2", "llama1_pre", "llama2_pre"):
+            from peft import get_peft_model, PeftModel
 
-        self.config.tags = spec_token_new_ids
-        self.config.scheme = self.args.classification_scheme
-        # binary mode
-        self.config.binary_mode = self.args.use_binary_classification_mode
-        # focal loss config
-        self.config.use_focal_loss = self.args.use_focal_loss
-        self.config.focal_loss_gamma = self.args.focal_loss_gamma
-        # sample weights in loss functions
-        self.config.balance_sample_weights = self.args.balance_sample_weights
-        if self.args.balance_sample_weights:
-            label2freq = self.data_processor.get_sample_distribution()
-            label_id2freq = {label2idx[k]: v for k, v in label2freq.items()}
-            self.config.sample_weights = np.zeros(len(label2freq))
-            for k, v in label_id2freq.items():
-                self.config.sample_weights[k] = v
-            self.args.logger.info(
-                f"using sample weights: {label_id2freq} and converted weight matrix is {self.config.sample_weights}")
-        
         # init model: modified for llama1, llama2, llama1_pre, llama2_pre
         if(self.args.model_type=="llama1"):
             print("Initialising llama 1 with new peft model ....")
@@ -293,13 +352,7 @@ class TaskRunner(object):
                 torch_dtype=getattr(torch, 'bfloat16'),
                 low_cpu_mem_usage=True,  
             )
-            peft_config = LoraConfig(
-                task_type=TaskType.SEQ_CLS,
-                target_modules=target_modules,
-                inference_mode=False,
-                r=self.args.lora_rank, lora_alpha=self.args.lora_alpha,
-                lora_dropout=lora_dropout,
-                modules_to_save=mod_to_save)
+            peft_config = self._new_lora_config()
             print("#### NEW PEFT config ####")
             print(peft_config)
             print(self.config)
@@ -314,13 +367,7 @@ class TaskRunner(object):
                 torch_dtype=getattr(torch, 'bfloat16'),
                 low_cpu_mem_usage=True,  
             )
-            peft_config = LoraConfig(
-                task_type=TaskType.SEQ_CLS,
-                target_modules=target_modules,
-                inference_mode=False,
-                r=self.args.lora_rank, lora_alpha=self.args.lora_alpha,
-                lora_dropout=lora_dropout,
-                modules_to_save=mod_to_save)
+            peft_config = self._new_lora_config()
             print("#### NEW PEFT config ####")
             print(peft_config)
             print(self.config)
@@ -372,6 +419,76 @@ class TaskRunner(object):
         print("Model loaded on device ------ ",self.args.device)
         self.model.to(self.args.device)
 
+    def _init_new_tokenizer_and_config(self):
+        """init tokenizer with special tags, labels and model config for a new model; return vocab size"""
+        _, config, tokenizer = self.model_dict[self.args.model_type]
+
+        # init tokenizer and add special tags
+        self.tokenizer = tokenizer.from_pretrained(self.args.pretrained_model, do_lower_case=self.args.do_lower_case)
+        print("Setting pd_token_______________________")
+        
+        if getattr(self.tokenizer, "pad_token_id") is None:
+            print("assigning custom pad token ---> ", self.tokenizer.eos_token_id)
+            self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+            
+        last_token_idx = len(self.tokenizer)
+        self.tokenizer.add_tokens(SPEC_TAGS)
+        spec_token_new_ids = tuple([(last_token_idx + idx) for idx in range(len(self.tokenizer) - last_token_idx)])
+        total_token_num = len(self.tokenizer)
+
+        # init config
+        unique_labels, label2idx, idx2label = self.data_processor.get_labels()
+        self.args.logger.info("label to index:\n{}".format(label2idx))
+        save_json(label2idx, self.new_model_dir_path/"label2idx.json")
+        num_labels = len(unique_labels)
+        self.label2idx = label2idx
+        self.idx2label = idx2label
+
+        self.config = config.from_pretrained(self.args.pretrained_model, num_labels=num_labels)
+        self.config.torch_dtype = getattr(torch, 'bfloat16')
+        print("##############")
+        print(self.config)
+        print("##############")
+        self.config.update({CONFIG_VERSION_NAME: VERSION})
+        # The number of tokens to cache.
+        # The key/value pairs that have already been pre-computed in a previous forward pass won’t be re-computed.
+        if self.args.model_type == "xlnet":
+            self.config.mem_len = self.config.d_model
+            # change dropout name
+            self.config.hidden_dropout_prob = self.config.dropout
+
+        self.config.tags = spec_token_new_ids
+        self.config.scheme = self.args.classification_scheme
+        # binary mode
+        self.config.binary_mode = self.args.use_binary_classification_mode
+        # focal loss config
+        self.config.use_focal_loss = self.args.use_focal_loss
+        self.config.focal_loss_gamma = self.args.focal_loss_gamma
+        # sample weights in loss functions
+        self.config.balance_sample_weights = self.args.balance_sample_weights
+        if self.args.balance_sample_weights:
+            label2freq = self.data_processor.get_sample_distribution()
+            label_id2freq = {label2idx[k]: v for k, v in label2freq.items()}
+            self.config.sample_weights = np.zeros(len(label2freq))
+            for k, v in label_id2freq.items():
+                self.config.sample_weights[k] = v
+            self.args.logger.info(
+                f"using sample weights: {label_id2freq} and converted weight matrix is {self.config.sample_weights}")
+
+        return total_token_num
+
+    def _new_lora_config(self, lora_rank=None, lora_alpha=None):
+        """LoRA adapter config for fine-tuning; rank and alpha default to args.lora_rank and args.lora_alpha"""
+        from peft import LoraConfig, TaskType
+        return LoraConfig(
+            task_type=TaskType.SEQ_CLS,
+            target_modules=target_modules,
+            inference_mode=False,
+            r=lora_rank if lora_rank else self.args.lora_rank,
+            lora_alpha=lora_alpha if lora_alpha else self.args.lora_alpha,
+            lora_dropout=lora_dropout,
+            modules_to_save=mod_to_save)
+
     def _init_optimizer(self):
         # set up optimizer
         no_decay = ["bias", "LayerNorm.weight"]
@@ -390,7 +507,13 @@ class TaskRunner(object):
 
         # set up optimizer warm up scheduler (you can set warmup_ratio=0 to deactivated this function)
         if self.args.do_warmup:
-            t_total = len(self.train_data_loader) // self.args.gradient_accumulation_steps * self.args.num_train_epochs
+            from transformers import get_linear_schedule_with_warmup
+            if isinstance(self.train_data_loader.batch_sampler, TokenBudgetBatchSampler):
+                # the number of batches changes between epochs with token budget batching
+                t_total = sum([num_batches // self.args.gradient_accumulation_steps for num_batches in
+                               self.train_data_loader.batch_sampler.plan_epochs(self.args.num_train_epochs)])
+            else:
+                t_total = len(self.train_data_loader) // self.args.gradient_accumulation_steps * self.args.num_train_epochs
             warmup_steps = np.dtype('int64').type(self.args.warmup_ratio * t_total)
             self.scheduler = get_linear_schedule_with_warmup(self.optimizer,
                                                              num_warmup_steps=warmup_steps,
@@ -405,7 +528,14 @@ class TaskRunner(object):
         """initialize a fine-tuned model for prediction"""
         self.args.logger.info("Init trained model...")
         model, config, tokenizer = self.model_dict[self.args.model_type]
-        
+
+        bundle_dir = self._serving_bundle_dir()
+        if bundle_dir is not None:
+            self._init_serving_bundle(bundle_dir)
+            self.trained_model_dir = bundle_dir
+            self.model.to(self.args.device)
+            return
+
         # Handle separately for (llama1 or llama1_pre) and (llama2_pre or llama2) 
         if(self.args.model_type=="llama1_pre" or self.args.model_type=="llama1" ): 
 
@@ -447,6 +577,7 @@ class TaskRunner(object):
             # self.model = PeftModel.from_pretrained(self.model,LLAMA1_PEFT_MODEL_PATH,is_trainable=False)
             # self.model.resize_token_embeddings(len(self.tokenizer))
 
+            from peft import PeftModel
             self.model = PeftModel.from_pretrained(self.model,latest_ckpt_dir,config=self.config)
             self.model.resize_token_embeddings(len(self.tokenizer))
         
@@ -492,6 +623,7 @@ class TaskRunner(object):
             # self.model = PeftModel.from_pretrained(llamaModel,LLAMA2_PEFT_MODEL_PATH, is_trainable=False)
             # self.model.resize_token_embeddings(len(self.tokenizer))
 
+            from peft import PeftModel
             self.model = PeftModel.from_pretrained(llamaModel,latest_ckpt_dir)
             self.model.resize_token_embeddings(len(self.tokenizer))
         
@@ -501,9 +633,15 @@ class TaskRunner(object):
                 if param.dtype == torch.float32 or param.dtype == torch.float16 :
                     param.data = param.data.to(torch.bfloat16)    
         else:
+            # ckpt_dir if set, else the latest ckpt_{epoch or step} saved in new_model_dir (or new_model_dir itself)
+            if getattr(self.args, "ckpt_dir", None):
+                latest_ckpt_dir = Path(self.args.ckpt_dir)
+            else:
+                dir_list = [d for d in self.new_model_dir_path.iterdir()
+                            if d.is_dir() and d.stem.startswith("ckpt_") and d.stem.split("_")[-1].isdigit()]
+                latest_ckpt_dir = sorted(dir_list, key=lambda x: int(x.stem.split("_")[-1]))[-1] \
+                    if dir_list else self.new_model_dir_path
             self.args.logger.info("Init model from {} for prediction".format(latest_ckpt_dir))
-            # dir_list = [d for d in self.new_model_dir_path.iterdir() if d.is_dir()]
-            # latest_ckpt_dir = sorted(dir_list, key=lambda x: int(x.stem.split("_")[-1]))[-1]
             self.config = config.from_pretrained(latest_ckpt_dir)
             # compatibility check for config arguments
             if not (self.config.to_dict().get(CONFIG_VERSION_NAME, None) == VERSION):
@@ -518,9 +656,42 @@ class TaskRunner(object):
 
             # load label2idx
             self.label2idx, self.idx2label = pkl_load(latest_ckpt_dir/"label_index.pkl")
+        self.trained_model_dir = latest_ckpt_dir
         # load model to device
         self.model.to(self.args.device)
 
+    def _serving_bundle_dir(self):
+        """ckpt_dir or new_model_dir if it is a serving bundle (has SERVING_BUNDLE_FILE), else None"""
+        for model_dir in (getattr(self.args, "ckpt_dir", None), self.args.new_model_dir):
+            if model_dir and (Path(model_dir) / SERVING_BUNDLE_FILE).exists():
+                return Path(model_dir)
+
+        return None
+
+    def _init_serving_bundle(self, bundle_dir):
+        """
+            load a serving bundle exported by serving_bundle.py; its safetensors weights are already resized,
+            merged (LoRA) and in the target dtype, so they are memory-mapped with no post-load transforms
+        """
+        model, config, tokenizer = self.model_dict[self.args.model_type]
+        bundle_info = load_json(bundle_dir / SERVING_BUNDLE_FILE)
+        if bundle_info["model_type"] != self.args.model_type:
+            raise RuntimeError("the serving bundle {} is exported for model_type {} but get {}".format(
+                bundle_dir, bundle_info["model_type"], self.args.model_type))
+        self.args.logger.info("Init model from serving bundle {} ({}) for prediction".format(
+            bundle_dir, bundle_info["dtype"]))
+
+        self.label2idx, self.idx2label = pkl_load(bundle_dir/"label_index.pkl")
+        self.config = config.from_pretrained(bundle_dir)
+        # special tags and the pad token are already in the saved tokenizer
+        self.tokenizer = tokenizer.from_pretrained(bundle_dir, do_lower_case=self.args.do_lower_case)
+        self.model = model.from_pretrained(
+            bundle_dir,
+            config=self.config,
+            torch_dtype=getattr(torch, bundle_info["dtype"]),
+            low_cpu_mem_usage=True,
+            use_safetensors=True)
+
     def _load_amp_for_fp16(self):
         # first try to load PyTorch naive amp; if fail, try apex; if fail again, throw a RuntimeError
         if version.parse(torch.__version__) >= version.parse("1.6.0"):
@@ -551,10 +722,11 @@ class TaskRunner(object):
             oldest_ckpt_dir = sorted(dir_list, key=lambda x: int(x.stem.split("_")[-1]))[0]
             shutil.rmtree(oldest_ckpt_dir)
 
-    def _run_eval(self, data_loader):
+    def _run_eval(self, data_loader, return_logits=False):
         temp_loss = .0
         # set model to evaluate mode
         self.model.eval()
+        from accelerate import Accelerator
         accelerator = Accelerator()
         data_loader, self.model = accelerator.prepare(data_loader, self.model)
 
@@ -577,10 +749,59 @@ class TaskRunner(object):
 
         batch_iter.close()
         temp_loss = temp_loss / total_sample_num
+        if return_logits:
+            return preds, temp_loss
         preds = np.argmax(preds, axis=-1)
 
         return preds, temp_loss
 
+    def _run_eval_counts(self, data_loader, return_preds=False):
+        """
+            confusion matrix (gold x predicted label ids) and loss of a labeled data loader (e.g., dev)
+            the counts are accumulated on the device as each batch finishes and no logits are kept;
+            only the count matrix (and the predicted label ids if return_preds) is moved to the host at the end
+        """
+        # set model to evaluate mode
+        self.model.eval()
+        from accelerate import Accelerator
+        accelerator = Accelerator()
+        data_loader, self.model = accelerator.prepare(data_loader, self.model)
+
+        num_labels = len(self.label2idx)
+        counts, temp_loss, preds = None, None, []
+        batch_iter = tqdm(data_loader, desc="Batch", disable=not self.args.progress_bar)
+        total_sample_num = len(batch_iter)
+        for batch in batch_iter:
+            batch_input = batch_to_model_input(batch, model_type=self.args.model_type, device=self.args.device)
+            with torch.no_grad():
+                batch_output = self.model(**batch_input)
+                loss, logits = batch_output[:2]
+                batch_preds = logits.argmax(dim=-1).view(-1)
+                labels = batch_input["labels"]
+                if labels.dim() > 1:
+                    # one-hot labels in binary mode
+                    labels = labels.argmax(dim=-1)
+                batch_counts = torch.bincount(labels.view(-1).to(batch_preds.device) * num_labels + batch_preds,
+                                              minlength=num_labels * num_labels)
+                if counts is None:
+                    counts, temp_loss = batch_counts, loss.detach().float()
+                else:
+                    counts += batch_counts
+                    temp_loss += loss.detach().float()
+                if return_preds:
+                    preds.append(batch_preds)
+
+        batch_iter.close()
+        if counts is None:
+            cm, temp_loss = np.zeros((num_labels, num_labels), dtype=np.int64), .0
+        else:
+            cm, temp_loss = counts.view(num_labels, num_labels).cpu().numpy(), temp_loss.item() / total_sample_num
+        if return_preds:
+            preds = torch.cat(preds).cpu().numpy() if preds else np.zeros(0, dtype=np.int64)
+            return cm, temp_loss, preds
+
+        return cm, temp_loss
+
     def _load_examples_by_task(self, task="train"):
         examples = None
 
@@ -596,12 +817,13 @@ class TaskRunner(object):
         return examples
 
     def _check_cache(self, task="train"):
-        cached_examples_file = Path(self.args.data_dir) / "cached_{}_{}_{}_{}_{}.pkl".format(
+        cached_examples_file = Path(self.args.data_dir) / CACHED_EXAMPLES_FILE.format(
             self.args.model_type, self.args.data_format_mode, self.args.max_seq_length,
             self.tokenizer.name_or_path.split("/")[-1], task)
         # load examples from files or cache
         if self.args.cache_data and cached_examples_file.exists():
-            examples = pkl_load(cached_examples_file)
+            # candidate_generation --feature_store writes the examples in chunks
+            examples = pkl_load_chunks(cached_examples_file)
             self.args.logger.info("load {} data from cached file: {}".format(task, cached_examples_file))
         elif self.args.cache_data and not cached_examples_file.exists():
             self.args.logger.info(
@@ -639,12 +861,22 @@ class TaskRunner(object):
                 label_list=self.label2idx,
                 output_mode="classification")
 
+            neg_label_id = None
+            if self.args.train_neg_sample_ratio < 1.0:
+                if self.args.non_relation_label not in self.label2idx:
+                    raise RuntimeError("cannot downsample negative examples, non_relation_label {} is not in labels {}"
+                                       .format(self.args.non_relation_label, self.label2idx))
+                neg_label_id = self.label2idx[self.args.non_relation_label]
+
             self.train_data_loader = relation_extraction_data_loader(
                 train_features,
                 batch_size=self.args.train_batch_size,
                 task="train",
                 logger=self.args.logger,
-                binary_mode=self.args.use_binary_classification_mode)
+                binary_mode=self.args.use_binary_classification_mode,
+                max_tokens=self.args.train_max_tokens,
+                neg_label_id=neg_label_id,
+                neg_sample_ratio=self.args.train_neg_sample_ratio)
 
         if self.args.do_eval and self.dev_data_loader is None:
             dev_examples = self._check_cache(task="dev")
@@ -657,12 +889,43 @@ class TaskRunner(object):
                 output_mode="classification")
             self.dev_features = dev_features
 
+            # gold brat annotations of the dev notes for brat level scores (see brat_eval)
+            if self.args.dev_brat_dir:
+                self.dev_brat_scorer = BratScorer(self.args.dev_brat_dir, num_core=self.args.num_core)
+                self.dev_brat_type_map = pkl_load(self.args.brat_type_map) if self.args.brat_type_map else None
+                # entity types, entity ids and file id of each dev candidate (the last five tsv columns)
+                # from dev.tsv, or dev_mappings.tsv (always with a header) of a feature store
+                mappings_file = candidate_mappings_file(self.data_processor.data_dir, "dev")
+                with open(mappings_file, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+                if self.args.data_file_header or mappings_file.name != "dev.tsv":
+                    lines = lines[1:]
+                self.dev_mappings = [line.rstrip("\n").split("\t")[-5:] for line in lines]
+                if len(self.dev_mappings) != len(dev_features):
+                    raise RuntimeError("expect {} dev candidates in {} but get {}".format(
+                        len(dev_features), mappings_file, len(self.dev_mappings)))
+
             self.dev_data_loader = relation_extraction_data_loader(
                 dev_features,
                 batch_size=self.args.train_batch_size,
                 task="test",
                 logger=self.args.logger,
-                binary_mode=self.args.use_binary_classification_mode)
+                binary_mode=self.args.use_binary_classification_mode,
+                max_tokens=self.args.eval_max_tokens)
+
+            # a stratified dev sample used for intra-epoch evaluation
+            if self.args.eval_step > 0 and self.args.eval_sample_ratio < 1.0:
+                self.dev_sample_features = stratified_sample_features(
+                    dev_features, sample_ratio=self.args.eval_sample_ratio, seed=self.args.seed)
+                self.args.logger.info("sample {} of {} dev examples for intra-epoch evaluation".format(
+                    len(self.dev_sample_features), len(dev_features)))
+                self.dev_sample_data_loader = relation_extraction_data_loader(
+                    self.dev_sample_features,
+                    batch_size=self.args.train_batch_size,
+                    task="test",
+                    logger=self.args.logger,
+                    binary_mode=self.args.use_binary_classification_mode,
+                    max_tokens=self.args.eval_max_tokens)
 
         if self.args.do_predict and self.test_data_loader is None:
             test_examples = self._check_cache(task="test")
@@ -681,4 +944,5 @@ class TaskRunner(object):
                 test_features,
                 batch_size=self.args.eval_batch_size,
                 task="test", logger=self.args.logger,
-                binary_mode=self.args.use_binary_classification_mode)
+                binary_mode=self.args.use_binary_classification_mode,
+                max_tokens=self.args.eval_max_tokens)
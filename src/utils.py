@@ -1,7 +1,8 @@
 import logging
-from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 import traceback
-from collections import defaultdict
+# one metric implementation, shared with the data_processing scripts (which import their own utils)
+from data_processing.utils import (PRF, calc, confusion_matrix, prf, confusion_counts, measure_prf,
+                                   acc_and_f1_from_confusion, class_prf_from_confusion, acc_and_f1)
 
 
 def try_catch_annotator(func):
@@ -52,76 +53,29 @@ class TransformerLogger:
         return self._create_logger("Transformer_Relation_Extraction")
 
 
-class PRF:
-    def __init__(self):
-        self.tp = 0
-        self.fp = 0
+class EarlyStopping:
+    """
+        track dev F1 across evaluations and signal stop once F1 has not improved
+        for patience evaluations in a row; patience < 1 means never stop
+    """
+    def __init__(self, patience=-1, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_score = None
+        self.num_bad_evals = 0
+
+    def step(self, score):
+        """return True if score is a new best"""
+        if self.best_score is None or score > self.best_score + self.min_delta:
+            self.best_score = score
+            self.num_bad_evals = 0
+            return True
+        self.num_bad_evals += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return 0 < self.patience <= self.num_bad_evals
 
     def __repr__(self):
-        return f"tp: {self.tp}; fp: {self.fp}"
-
-
-def calc(tp, tp_fp, tp_tn):
-    if tp_fp != 0:
-        pre = tp / tp_fp
-    else:
-        pre = 0
-
-    if tp_tn == 0:
-        rec = 0
-    else:
-        rec = tp / tp_tn
-
-    if pre == 0 and rec == 0:
-        f1 = 0
-    else:
-        f1 = 2 * pre * rec / (pre + rec)
-
-    return round(pre, 4), round(rec, 4), round(f1, 4)
-
-
-def measure_prf(preds, gs_labels, non_rel_label):
-    res = dict()
-    temp = defaultdict(PRF)
-    total_tp, total_tp_fp, total_tp_tn = 0, 0, 0
-    tn_dict = defaultdict(lambda: 0)
-
-    assert preds == gs_labels, \
-        f"prediction and gold standard is not equal, prediction: {len(preds)}; gs: {len(gs_labels)}"
-
-    labels = set(gs_labels)
-    for l in labels:
-        for p, g in zip(preds, gs_labels):
-            if g == l:
-                tn_dict[l] += 1
-            if g == p == l:
-                temp[l].tp += 1
-            elif g != l and p == l:
-                temp[l].fp += 1
-
-    for l in labels:
-        if l == non_rel_label:
-            continue
-        tp, fp = temp[l].tp, temp[l].fp
-        tp_fp = tp + fp
-        tp_tn = tn_dict[l]
-        res[l] = calc(tp, tp_fp, tp_tn)
-
-        total_tp += tp
-        total_tp_fp += tp_fp
-        total_tp_tn += tp_tn
-
-    res['micro_average_pre_rec_f1'] = calc(total_tp, total_tp_fp, total_tp_tn)
-    f1 = res['micro_average_pre_rec_f1'][-1]
-
-    return res, f1
-
-
-def acc_and_f1(labels, preds, label2idx, non_rel_label):
-    acc = accuracy_score(labels, preds)
-
-    includes = [i for l, i in label2idx.items() if l != non_rel_label]
-
-    p, r, f1, _ = precision_recall_fscore_support(labels, preds, labels=includes, average="micro")
-
-    return acc, f"precision: {p}; recall: {r}", f1
+        return f"best: {self.best_score}; bad evals: {self.num_bad_evals}; patience: {self.patience}"
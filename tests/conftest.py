@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules are imported as scripts from src (e.g., "from utils import ...")
+sys.path.insert(0, (Path(__file__).resolve().parent.parent / "src").as_posix())
@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+import batch_prediction
+from batch_prediction import (BatchRunner, BatchManifest, BatchWorkQueue, iter_batch_dirs, checkpoint_run_args,
+                              _produce_data_loaders, _PIPELINE_END)
+from data_processing.io_utils import file_sha256
+from data_utils import InputFeatures
+
+LABELS = ["NonRel", "Strength-Drug"]
+TSV_HEADER = "\t".join(str(i + 1) for i in range(8))
+
+
+class _Tokenizer:
+    name_or_path = "test_tokenizer"
+
+    def tokenize(self, text):
+        return text.split(" ")
+
+
+def _convert_features(examples, tokenizer, max_length, label_list, output_mode):
+    return [InputFeatures(input_ids=[1, 2, 0, 0], attention_mask=[1, 1, 0, 0], token_type_ids=[0, 0, 0, 0],
+                          label=label_list[example.label]) for example in examples]
+
+
+def _write_batches(data_dir, entity_dir, num_batches=2, notes_per_batch=2):
+    """batch dirs of candidates (T1 -> T2 of each note) and the entity .ann files of the notes"""
+    Path(entity_dir).mkdir(parents=True)
+    for batch_id in range(num_batches):
+        rows = []
+        for note_id in range(notes_per_batch):
+            fid = "note{}_{}".format(batch_id, note_id)
+            Path(entity_dir, fid + ".ann").write_text("T1\tStrength 0 5\t10 mg\nT2\tDrug 9 16\taspirin\n")
+            rows.append("\t".join(["NonRel", "[s1] 10 mg [e1] of aspirin", "[s2] aspirin [e2]",
+                                   "Strength", "Drug", "T1", "T2", fid]))
+        batch_dir = Path(data_dir, "batch_{}".format(batch_id))
+        batch_dir.mkdir(parents=True)
+        (batch_dir / "test.tsv").write_text("\n".join([TSV_HEADER] + rows) + "\n")
+
+
+def _args(data_dir, tmp_dir, **kwargs):
+    args = Namespace(
+        model_type="bert", data_format_mode=0, data_dir=str(data_dir), new_model_dir=str(tmp_dir / "model"),
+        predict_output_dir=str(tmp_dir / "pred"), max_seq_length=16, data_file_header=True, do_lower_case=False,
+        eval_batch_size=2, eval_max_tokens=-1, resume=False, pipeline_depth=1, max_records_in_memory=100,
+        tmp_dir=None, work_queue=False, worker_id=None, lease_timeout=600, poll_interval=0.1, merge_only=False,
+        num_core=1, non_relation_label="NonRel", classification_mode="mul", use_binary_classification_mode=False,
+        type_map=None,
+        entity_data_dir=str(tmp_dir / "entities"), brat_result_output_dir=str(tmp_dir / "brat"), device="cpu",
+        logger=logging.getLogger("batch_prediction_test"))
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def _init_trained_model(self):
+    self.trained_model_dir = self.new_model_dir_path
+    self.tokenizer = _Tokenizer()
+    self.label2idx = {label: idx for idx, label in enumerate(LABELS)}
+    self.idx2label = {idx: label for idx, label in enumerate(LABELS)}
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    monkeypatch.setattr(BatchRunner, "_init_trained_model", _init_trained_model)
+    monkeypatch.setattr(batch_prediction, "convert_examples_to_relation_extraction_features", _convert_features)
+
+
+def test_producer_reads_batches_of_a_relative_data_dir(tmp_path, monkeypatch, fake_model):
+    monkeypatch.chdir(tmp_path)
+    _write_batches("data/batch_data", "entities")
+    args = _args("data/batch_data", Path("."))
+    task_runner = BatchRunner(args)
+    task_runner.task_runner_batch_init()
+    batch_dirs = list(iter_batch_dirs(args.data_dir))
+
+    data_queue = queue.Queue()
+    _produce_data_loaders(task_runner, batch_dirs, data_queue,
+                          BatchManifest(tmp_path / "manifest", run_args={}))
+    items = []
+    while not items or items[-1] is not _PIPELINE_END:
+        items.append(data_queue.get(timeout=10))
+        if isinstance(items[-1], Exception):
+            raise items[-1]
+
+    assert [item[0] for item in items[:-1]] == batch_dirs
+    assert [len(item[2].dataset) for item in items[:-1]] == [2, 2]
+
+
+def test_failed_prediction_writes_no_brat_outputs(tmp_path, monkeypatch, fake_model):
+    _write_batches(tmp_path / "data", tmp_path / "entities")
+    predicted = []
+
+    def _predict(self):
+        if predicted:
+            raise ValueError("inference failed")
+        predicted.append(len(self.test_data_loader.dataset))
+        return ["Strength-Drug"] * predicted[-1]
+
+    monkeypatch.setattr(BatchRunner, "predict", _predict)
+    with pytest.raises(RuntimeError, match="inference failed"):
+        batch_prediction.app(_args(tmp_path / "data", tmp_path))
+    assert predicted == [2]
+    assert not Path(tmp_path / "brat").exists() or not list(Path(tmp_path / "brat").iterdir())
+
+
+def test_predicted_relations_are_written_to_brat(tmp_path, monkeypatch, fake_model):
+    _write_batches(tmp_path / "data", tmp_path / "entities")
+    monkeypatch.setattr(BatchRunner, "predict", lambda self: ["Strength-Drug"] * len(self.test_data_loader.dataset))
+    batch_prediction.app(_args(tmp_path / "data", tmp_path))
+
+    ann_files = sorted(Path(tmp_path / "brat").glob("*.ann"))
+    assert [f.stem for f in ann_files] == ["note0_0", "note0_1", "note1_0", "note1_1"]
+    for ann_file in ann_files:
+        assert "R1\tStrength-Drug Arg1:T1 Arg2:T2" in ann_file.read_text()
+
+
+def _completed_batch(tmp_path, run_args):
+    _write_batches(tmp_path / "data", tmp_path / "entities", num_batches=1)
+    batch_dir, pred_file = tmp_path / "data" / "batch_0", tmp_path / "pred" / "batch_0.txt"
+    pred_file.parent.mkdir()
+    pred_file.write_text("Strength-Drug\nStrength-Drug\n")
+    BatchManifest(tmp_path / "manifest", run_args).complete(batch_dir, pred_file, file_sha256(batch_dir / "test.tsv"))
+    return batch_dir, pred_file
+
+
+def test_manifest_reuses_unchanged_batches_on_resume(tmp_path):
+    run_args = {"max_seq_length": 16, "checkpoint": {"ckpt_dir": "/models/ckpt_3", "files": {"model.bin": [8, 1]}}}
+    batch_dir, pred_file = _completed_batch(tmp_path, run_args)
+
+    assert BatchManifest(tmp_path / "manifest", run_args, resume=True).is_completed(batch_dir, pred_file)
+    assert not BatchManifest(tmp_path / "manifest", run_args).is_completed(batch_dir, pred_file)
+
+
+def test_manifest_does_not_reuse_a_changed_test_file(tmp_path):
+    run_args = {"max_seq_length": 16}
+    batch_dir, pred_file = _completed_batch(tmp_path, run_args)
+    with open(batch_dir / "test.tsv", "a") as f:
+        f.write("\t".join(["NonRel", "[s1] 5 mg [e1]", "[s2] aspirin [e2]", "Strength", "Drug", "T3", "T2", "n"]))
+
+    assert not BatchManifest(tmp_path / "manifest", run_args, resume=True).is_completed(batch_dir, pred_file)
+
+
+@pytest.mark.parametrize("changed_run_args", [
+    {"max_seq_length": 32, "checkpoint": {"ckpt_dir": "/models/ckpt_3", "files": {"model.bin": [8, 1]}}},
+    {"max_seq_length": 16, "checkpoint": {"ckpt_dir": "/models/ckpt_4", "files": {"model.bin": [8, 1]}}},
+    {"max_seq_length": 16, "checkpoint": {"ckpt_dir": "/models/ckpt_3", "files": {"model.bin": [8, 2]}}}])
+def test_manifest_does_not_reuse_batches_of_other_run_args(tmp_path, changed_run_args):
+    run_args = {"max_seq_length": 16, "checkpoint": {"ckpt_dir": "/models/ckpt_3", "files": {"model.bin": [8, 1]}}}
+    batch_dir, pred_file = _completed_batch(tmp_path, run_args)
+
+    assert not BatchManifest(tmp_path / "manifest", changed_run_args, resume=True).is_completed(batch_dir, pred_file)
+
+
+def test_checkpoint_run_args_change_with_the_weights(tmp_path, monkeypatch):
+    ckpt_dir = tmp_path / "model" / "ckpt_1"
+    ckpt_dir.mkdir(parents=True)
+    (ckpt_dir / "pytorch_model.bin").write_bytes(b"weights")
+    os.utime(ckpt_dir / "pytorch_model.bin", ns=(1, 1))
+    monkeypatch.chdir(tmp_path)
+    ckpt_args = checkpoint_run_args("model/ckpt_1")
+    assert ckpt_args["ckpt_dir"] == str(ckpt_dir.resolve())
+    # the manifest records are json, so the args must compare equal after a round trip
+    assert json.loads(json.dumps(ckpt_args)) == ckpt_args
+
+    (ckpt_dir / "pytorch_model.bin").write_bytes(b"retrained")
+    assert checkpoint_run_args(ckpt_dir) != ckpt_args
+
+
+@pytest.fixture
+def work_queues(tmp_path):
+    queues = [BatchWorkQueue(tmp_path / "leases", "worker{}".format(idx), lease_timeout=600) for idx in range(2)]
+    yield queues
+    for work_queue in queues:
+        work_queue.close()
+
+
+def _lease_owner(work_queue, name):
+    return work_queue._lease_file(name).read_text().split("\t")[0]
+
+
+def test_work_queue_batch_is_claimed_by_one_worker(work_queues):
+    worker0, worker1 = work_queues
+    assert worker0.claim("batch_0")
+    assert not worker1.claim("batch_0")
+    assert worker1.claim("batch_1")
+    assert _lease_owner(worker0, "batch_0") == "worker0" and _lease_owner(worker0, "batch_1") == "worker1"
+
+
+def test_work_queue_reclaims_an_expired_lease(work_queues):
+    worker0, worker1 = work_queues
+    assert worker0.claim("batch_0")
+    expired = time.time() - worker0.lease_timeout - 10
+    os.utime(worker0._lease_file("batch_0"), (expired, expired))
+
+    assert worker1.claim("batch_0")
+    assert _lease_owner(worker1, "batch_0") == "worker1"
+    assert not worker0.claim("batch_0")
+    assert not worker1._lease_file("batch_0").with_suffix(".reclaim").exists()
+
+
+def test_work_queue_removes_a_reclaim_lock_of_a_dead_worker(work_queues):
+    worker0, worker1 = work_queues
+    assert worker0.claim("batch_0")
+    reclaim_file = worker0._lease_file("batch_0").with_suffix(".reclaim")
+    reclaim_file.write_text("worker2")
+    expired = time.time() - worker0.lease_timeout - 10
+    for lease_file in (worker0._lease_file("batch_0"), reclaim_file):
+        os.utime(lease_file, (expired, expired))
+
+    # the first claim removes the stale lock of the dead reclaimer, the next one reclaims
+    assert not worker1.claim("batch_0")
+    assert not reclaim_file.exists()
+    assert worker1.claim("batch_0")
+
+
+def test_work_queue_release_and_close_remove_the_leases(work_queues):
+    worker0, worker1 = work_queues
+    assert worker0.claim("batch_0") and worker0.claim("batch_1")
+
+    worker0.release("batch_0")
+    assert not worker0._lease_file("batch_0").exists()
+    assert worker1.claim("batch_0")
+
+    worker0.close()
+    assert not worker0._lease_file("batch_1").exists()
+    assert worker1.claim("batch_1")
+    assert sorted(f.name for f in worker1.lease_dir.iterdir()) == ["batch_0.lease", "batch_1.lease"]
+
+
+def test_work_queue_concurrent_claims_have_one_winner(tmp_path):
+    queues = [BatchWorkQueue(tmp_path / "leases", "worker{}".format(idx), lease_timeout=600) for idx in range(8)]
+    barrier = threading.Barrier(len(queues))
+    claimed = [None] * len(queues)
+
+    def _claim(idx):
+        barrier.wait()
+        claimed[idx] = queues[idx].claim(BatchWorkQueue.MERGE_LEASE)
+
+    threads = [threading.Thread(target=_claim, args=(idx,)) for idx in range(len(queues))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for work_queue in queues:
+        work_queue.close()
+    assert claimed.count(True) == 1
+
+
+def test_work_queue_workers_predict_all_batches_and_merge_once(tmp_path, monkeypatch, fake_model):
+    _write_batches(tmp_path / "data", tmp_path / "entities", num_batches=4)
+    monkeypatch.setattr(BatchRunner, "predict", lambda self: ["Strength-Drug"] * len(self.test_data_loader.dataset))
+    merged = []
+    merge_batch_predictions = batch_prediction.merge_batch_predictions
+
+    def _merge(gargs, batch_dirs):
+        merged.append(gargs.worker_id)
+        merge_batch_predictions(gargs, batch_dirs)
+
+    monkeypatch.setattr(batch_prediction, "merge_batch_predictions", _merge)
+    errors = []
+
+    def _worker(worker_id):
+        try:
+            batch_prediction.app(_args(tmp_path / "data", tmp_path, work_queue=True, worker_id=worker_id,
+                                       poll_interval=0.01))
+        except Exception as ex:
+            errors.append(ex)
+
+    workers = [threading.Thread(target=_worker, args=("worker{}".format(idx),)) for idx in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+    assert not errors
+    assert len(merged) == 1
+    assert len(list(Path(tmp_path / "brat").glob("*.ann"))) == 8
+    assert list(Path(tmp_path / "pred" / "batch_leases").iterdir()) == []
@@ -0,0 +1,248 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import brat_eval
+from brat_eval import (ClinicalConcept, Relation, match_annotations, tag_index, relation_index, bootstrap_f1,
+                       evaluate_bootstrap, Corpora, CorpusEvaluator, load_annotations)
+from data_processing.io_utils import pkl_load
+from utils import prf
+
+TAG_TYPES = ["Drug", "Strength", "ADE"]
+REL_TYPES = ["Strength-Drug", "ADE-Drug"]
+
+
+def _tags(rng, num_tags, prefix="T", text_len=60):
+    tags = []
+    for idx in range(num_tags):
+        start = rng.randrange(text_len)
+        tags.append(ClinicalConcept("{}{}".format(prefix, idx), start, start + rng.randint(1, 6),
+                                    rng.choice(TAG_TYPES)))
+    return tags
+
+
+def _relations(rng, tags, num_relations, prefix="R"):
+    return [Relation("{}{}".format(prefix, idx), rng.choice(tags), rng.choice(tags), rng.choice(REL_TYPES))
+            for idx in range(num_relations)]
+
+
+def _system(rng, gold, tags_fn):
+    # copies of gold annotations (some shifted) mixed with random ones, so there are several matches per gold one
+    return [g for g in gold if rng.random() < 0.5] + tags_fn()
+
+
+def brute_force_match(gol, sys, mode):
+    """the pairwise pare down of the original evaluator"""
+    sys_check = list(sys)
+    gol_matched = []
+    for s in sys:
+        for g in gol:
+            if g.equals(s, mode):
+                if g not in gol_matched:
+                    gol_matched.append(g)
+                elif s in sys_check:
+                    sys_check.remove(s)
+    is_tp = [any(g.equals(s, mode) for g in gol) for s in sys_check]
+    kept_gol_matched = {g for s in sys_check for g in gol if g.equals(s, mode)}
+    return sys_check, is_tp, kept_gol_matched
+
+
+@pytest.mark.parametrize("mode", ["strict", "lenient"])
+@pytest.mark.parametrize("seed", range(20))
+def test_tag_matching_equals_brute_force(mode, seed):
+    rng = random.Random(seed)
+    gol = _tags(rng, 30)
+    sys = _system(rng, gol, lambda: _tags(rng, 30, prefix="S"))
+    rng.shuffle(sys)
+
+    index = tag_index(gol, mode)
+    for s in sys:
+        expected = {g for g in gol if g.ttype == s.ttype and g.span_matches(s, mode)}
+        assert set(index.candidates(s)) == expected
+    assert match_annotations(gol, sys, index, mode) == brute_force_match(gol, sys, mode)
+
+
+@pytest.mark.parametrize("mode", ["strict", "lenient"])
+@pytest.mark.parametrize("seed", range(20))
+def test_relation_matching_equals_brute_force(mode, seed):
+    rng = random.Random(seed)
+    gol_tags, sys_tags = _tags(rng, 20), _tags(rng, 20, prefix="S")
+    gol = _relations(rng, gol_tags, 30)
+    sys = _system(rng, gol, lambda: _relations(rng, gol_tags + sys_tags, 30, prefix="Q"))
+    rng.shuffle(sys)
+
+    assert match_annotations(gol, sys, relation_index(gol, mode), mode) == brute_force_match(gol, sys, mode)
+
+
+def test_lenient_matching_keeps_one_of_the_overlapping_system_tags():
+    gol = [ClinicalConcept("T1", 10, 20, "Drug")]
+    sys = [ClinicalConcept("T1", 8, 12, "Drug"), ClinicalConcept("T2", 15, 25, "Drug"),
+           ClinicalConcept("T3", 30, 35, "Drug")]
+
+    kept, is_tp, gol_matched = match_annotations(gol, sys, tag_index(gol, "lenient"), "lenient")
+    assert [s.tid for s in kept] == ["T1", "T3"]
+    assert is_tp == [True, False]
+    assert gol_matched == set(gol)
+
+
+def _doc_counts(num_docs=80, num_types=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 10, size=(num_docs, num_types, 3))
+
+
+def test_bootstrap_interval_contains_the_point_estimate():
+    doc_counts = _doc_counts()
+    totals = doc_counts.sum(axis=0)
+    f1 = prf(totals[:, 0], totals[:, 1], totals[:, 2])[2]
+
+    samples = bootstrap_f1([doc_counts], num_samples=500, seed=0)
+    assert samples.shape == (1, 500, 3)
+    lower, upper = np.percentile(samples[0], [2.5, 97.5], axis=0)
+    assert np.all(lower <= f1) and np.all(f1 <= upper)
+
+
+def test_bootstrap_is_reproducible_with_a_seed():
+    doc_counts = [_doc_counts(seed=0), _doc_counts(seed=1)]
+    samples = bootstrap_f1(doc_counts, num_samples=300, seed=7, chunk_size=64)
+
+    assert np.array_equal(samples, bootstrap_f1(doc_counts, num_samples=300, seed=7))
+    assert not np.array_equal(samples, bootstrap_f1(doc_counts, num_samples=300, seed=8))
+    # the same resamples are used for all systems: a system compared with itself never differs
+    assert np.array_equal(bootstrap_f1([doc_counts[0]] * 2, num_samples=50, seed=7)[0], samples[0, :50])
+
+
+def _write_ann(folder, name, relations):
+    tags = ["T{}\tDrug {} {}\tdrug".format(idx, idx * 10, idx * 10 + 4) for idx in range(1, 5)]
+    rels = ["R{}\t{} Arg1:T{} Arg2:T{}".format(idx, rtype, arg1, arg2)
+            for idx, (rtype, arg1, arg2) in enumerate(relations, 1)]
+    folder.mkdir(exist_ok=True)
+    (folder / "{}.ann".format(name)).write_text("\n".join(tags + rels) + "\n")
+
+
+def test_bootstrap_overall_counts_the_types_of_the_main_report(tmp_path, capsys):
+    for doc in range(6):
+        _write_ann(tmp_path / "gold", "d{}".format(doc), [("ADE-Drug", 1, 2), ("ADE-Drug", 3, 4)])
+        # a relation type that is only predicted is a false positive of the overall scores
+        _write_ann(tmp_path / "system", "d{}".format(doc), [("ADE-Drug", 1, 2), ("Route-Drug", 3, 4)])
+    evaluator = CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")))
+    capsys.readouterr()
+
+    evaluate_bootstrap(evaluator, ["ADE-Drug"], num_samples=20, seed=0)
+    overall = [line for line in capsys.readouterr().out.split("\n") if "Overall (micro)" in line][0]
+    strict_f1 = float(overall.split()[2])
+    assert strict_f1 == pytest.approx(evaluator.scores("relations", "strict")["micro"]["f1"], abs=1e-4)
+    assert strict_f1 == pytest.approx(0.5, abs=1e-4)
+
+
+def _write_corpus(tmp_path, num_docs=4):
+    for doc in range(num_docs):
+        _write_ann(tmp_path / "gold", "d{}".format(doc), [("ADE-Drug", 1, 2), ("Strength-Drug", 3, 4)])
+        _write_ann(tmp_path / "system", "d{}".format(doc), [("ADE-Drug", 1, 2)])
+    return ["d{}.ann".format(doc) for doc in range(num_docs)]
+
+
+@pytest.fixture
+def parsed_files(monkeypatch):
+    parsed = []
+    parse_ann_file = brat_eval._parse_ann_file
+
+    def _parse(path, with_sha256=False):
+        parsed.append(os.path.basename(path))
+        return parse_ann_file(path, with_sha256=with_sha256)
+
+    monkeypatch.setattr(brat_eval, "_parse_ann_file", _parse)
+    return parsed
+
+
+def _relation_types(annotations):
+    return {name: sorted(r.rtype for r in ann["relations"].values()) for name, ann in annotations.items()}
+
+
+def test_gold_cache_reuses_unchanged_files(tmp_path, parsed_files):
+    file_names = _write_corpus(tmp_path)
+    cache_file = tmp_path / "gold.pkl"
+    annotations = load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)
+    assert sorted(parsed_files) == file_names
+
+    del parsed_files[:]
+    assert _relation_types(load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)) == \
+        _relation_types(annotations)
+    assert parsed_files == []
+
+
+def test_gold_cache_parses_changed_files_only(tmp_path, parsed_files):
+    file_names = _write_corpus(tmp_path)
+    cache_file = tmp_path / "gold.pkl"
+    load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)
+    del parsed_files[:]
+
+    _write_ann(tmp_path / "gold", "d1", [("ADE-Drug", 1, 2)])
+    annotations = load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)
+    assert parsed_files == ["d1.ann"]
+    assert _relation_types(annotations)["d1.ann"] == ["ADE-Drug"]
+    assert _relation_types(annotations)["d0.ann"] == ["ADE-Drug", "Strength-Drug"]
+
+
+def test_gold_cache_does_not_parse_a_touched_identical_file(tmp_path, parsed_files):
+    file_names = _write_corpus(tmp_path)
+    cache_file = tmp_path / "gold.pkl"
+    load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)
+    del parsed_files[:]
+
+    touched = tmp_path / "gold" / "d2.ann"
+    touched.write_text(touched.read_text())
+    os.utime(touched, ns=(1, 1))
+    load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)
+    assert parsed_files == []
+    # the new mtime is recorded, so the next run does not hash the file again
+    assert pkl_load(cache_file)["d2.ann"][0] == 1
+
+
+def test_gold_cache_drops_deleted_files(tmp_path, parsed_files):
+    file_names = _write_corpus(tmp_path)
+    cache_file = tmp_path / "gold.pkl"
+    load_annotations(tmp_path / "gold", file_names, cache_file=cache_file)
+
+    os.remove(tmp_path / "gold" / "d3.ann")
+    load_annotations(tmp_path / "gold", file_names[:3], cache_file=cache_file)
+    assert sorted(pkl_load(cache_file)) == file_names[:3]
+
+
+def _scores(evaluator):
+    return [evaluator.scores(target, mode) for target in ("tags", "relations") for mode in ("strict", "lenient")]
+
+
+def test_evaluator_cache_reuses_unchanged_documents(tmp_path):
+    file_names = _write_corpus(tmp_path)
+    cache_file = tmp_path / "counts.pkl"
+    evaluator = CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")), cache_file=cache_file)
+    assert evaluator.num_cached_docs == 0
+
+    cached = CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")), cache_file=cache_file)
+    assert cached.num_cached_docs == len(file_names)
+    assert _scores(cached) == _scores(evaluator)
+
+
+def test_evaluator_cache_evaluates_a_changed_system_file_again(tmp_path):
+    file_names = _write_corpus(tmp_path)
+    cache_file = tmp_path / "counts.pkl"
+    CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")), cache_file=cache_file)
+
+    _write_ann(tmp_path / "system", "d0", [("ADE-Drug", 1, 2), ("Strength-Drug", 3, 4)])
+    cached = CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")), cache_file=cache_file)
+    assert cached.num_cached_docs == len(file_names) - 1
+    assert _scores(cached) == _scores(CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system"))))
+    assert cached.scores("relations", "strict")["tp"] == len(file_names) + 1
+
+
+def test_evaluator_cache_drops_deleted_documents(tmp_path):
+    _write_corpus(tmp_path)
+    cache_file = tmp_path / "counts.pkl"
+    CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")), cache_file=cache_file)
+
+    os.remove(tmp_path / "gold" / "d3.ann")
+    os.remove(tmp_path / "system" / "d3.ann")
+    cached = CorpusEvaluator(Corpora(str(tmp_path / "gold"), str(tmp_path / "system")), cache_file=cache_file)
+    assert cached.num_cached_docs == 3
+    assert sorted(pkl_load(cache_file)) == ["d0.ann", "d1.ann", "d2.ann"]
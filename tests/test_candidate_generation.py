@@ -0,0 +1,57 @@
+from data_processing.candidate_generation import FeatureStoreWriter
+from data_processing.io_utils import pkl_load_chunks
+from data_processing.post_processing import candidate_mappings_file, iter_mappings
+
+
+class _DataProcessor:
+    def __init__(self):
+        self.chunk_sizes = []
+
+    def get_examples_from_lines(self, lines, set_type="test"):
+        self.chunk_sizes.append(len(lines))
+        return [(set_type, line[1], line[2]) for line in lines]
+
+
+def _candidates(fid, num_candidates):
+    return [(idx % 2, "\t".join(["NonRel", "[s1] a [e1]", "[s2] b{} [e2]".format(idx), "Drug", "ADE",
+                                 "T1", "T{}".format(idx + 2), fid]))
+            for idx in range(num_candidates)]
+
+
+def test_feature_store_writes_examples_in_chunks_and_mappings(tmp_path):
+    data_processor = _DataProcessor()
+    writer = FeatureStoreWriter(tmp_path, data_processor, "cached_test.pkl", task="test", chunk_size=3)
+    writer.write(_candidates("note1", 4))
+    writer.write(_candidates("note2", 3))
+    writer.close()
+
+    assert data_processor.chunk_sizes == [3, 3, 1]
+    examples = pkl_load_chunks(tmp_path / "cached_test.pkl")
+    assert [example[2] for example in examples] == ["[s2] b{} [e2]".format(idx) for idx in [0, 1, 2, 3, 0, 1, 2]]
+    assert writer.num_candidates == 7
+
+    # no test.tsv is written, post-processing reads the mappings file in its place
+    mappings_file = candidate_mappings_file(tmp_path, "test")
+    assert mappings_file == tmp_path / "test_mappings.tsv"
+    mappings = list(iter_mappings(mappings_file, num_cols=5))
+    assert mappings[:2] == [["Drug", "ADE", "T1", "T2", "note1"], ["Drug", "ADE", "T1", "T3", "note1"]]
+    assert [m[-1] for m in mappings] == ["note1"] * 4 + ["note2"] * 3
+    assert list(iter_mappings(mappings_file)) == [m[2:] for m in mappings]
+
+
+def test_feature_store_split_by_distance(tmp_path):
+    writer = FeatureStoreWriter(tmp_path, _DataProcessor(), "cached_dev.pkl", task="dev", split_by_distance=True,
+                                max_sent_distance=2)
+    writer.write(_candidates("note1", 3))
+    writer.close()
+
+    assert len(pkl_load_chunks(tmp_path / "cutoff_0" / "cached_dev.pkl")) == 2
+    assert len(pkl_load_chunks(tmp_path / "cutoff_1" / "cached_dev.pkl")) == 1
+    # a distance without candidates still has a loadable (empty) cache file
+    assert pkl_load_chunks(tmp_path / "cutoff_2" / "cached_dev.pkl") == []
+    assert len(list(iter_mappings(candidate_mappings_file(tmp_path / "cutoff_0", "dev")))) == 2
+
+
+def test_candidate_mappings_file_prefers_the_tsv(tmp_path):
+    (tmp_path / "test.tsv").write_text("1\t2\t3\t4\t5\t6\t7\t8\n")
+    assert candidate_mappings_file(tmp_path) == tmp_path / "test.tsv"
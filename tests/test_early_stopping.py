@@ -0,0 +1,37 @@
+from utils import EarlyStopping
+
+
+def test_new_best_resets_bad_evals():
+    early_stopper = EarlyStopping(patience=2)
+    assert early_stopper.step(0.5)
+    assert not early_stopper.step(0.4)
+    assert early_stopper.num_bad_evals == 1
+    assert early_stopper.step(0.6)
+    assert early_stopper.num_bad_evals == 0
+    assert early_stopper.best_score == 0.6
+
+
+def test_stop_after_patience_evals_without_improvement():
+    early_stopper = EarlyStopping(patience=2)
+    early_stopper.step(0.5)
+    early_stopper.step(0.5)
+    assert not early_stopper.should_stop
+    early_stopper.step(0.3)
+    assert early_stopper.should_stop
+    assert early_stopper.best_score == 0.5
+
+
+def test_min_delta():
+    early_stopper = EarlyStopping(patience=1, min_delta=0.01)
+    early_stopper.step(0.5)
+    assert not early_stopper.step(0.505)
+    assert early_stopper.should_stop
+    assert early_stopper.best_score == 0.5
+
+
+def test_never_stop_without_patience():
+    for patience in (-1, 0):
+        early_stopper = EarlyStopping(patience=patience)
+        for score in (0.5, 0.4, 0.3, 0.2, 0.1):
+            early_stopper.step(score)
+        assert not early_stopper.should_stop
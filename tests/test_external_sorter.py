@@ -0,0 +1,52 @@
+import random
+
+import pytest
+from data_processing.post_processing import ExternalSorter
+
+
+def _records(num_records=200, num_files=17, seed=0):
+    rng = random.Random(seed)
+    # the index in the relation type column tells the input order of records with the same file id
+    return [("doc{:02d}".format(rng.randrange(num_files)), "rel{}".format(idx), "T1", "T2")
+            for idx in range(num_records)]
+
+
+def _run_files(sorter):
+    return list(sorter._run_dir.iterdir()) if sorter._run_dir is not None else []
+
+
+@pytest.mark.parametrize("max_records", [1, 7, 50, 1000])
+def test_external_sort_is_stable_sort_by_file_id(tmp_path, max_records):
+    records = _records()
+    sorter = ExternalSorter(max_records=max_records, tmp_dir=tmp_path).extend(records)
+    assert len(_run_files(sorter)) == len(records) // max_records
+
+    assert list(sorter) == sorted(records, key=lambda x: x[0])
+    # the run files are removed after iteration
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_external_sort_of_ordered_input_keeps_order(tmp_path):
+    records = sorted(_records(), key=lambda x: x[0])
+    sorter = ExternalSorter(max_records=9, tmp_dir=tmp_path).extend(records)
+    assert sorter._in_order and len(_run_files(sorter)) == len(records) // 9
+
+    assert list(sorter) == records
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_external_sort_merges_runs_sorted_before_spill(tmp_path):
+    sorter = ExternalSorter(max_records=3, tmp_dir=tmp_path)
+    sorter.extend([("b", "r0", "T1", "T2"), ("c", "r1", "T1", "T2"), ("a", "r2", "T1", "T2"),
+                   ("b", "r3", "T1", "T2"), ("a", "r4", "T1", "T2"), ("c", "r5", "T1", "T2"),
+                   ("a", "r6", "T1", "T2")])
+    run_files = sorted(_run_files(sorter))
+    assert [line.split("\t")[0] for line in run_files[1].read_text().splitlines()] == ["a", "b", "c"]
+
+    assert [record[:2] for record in sorter] == [("a", "r2"), ("a", "r4"), ("a", "r6"), ("b", "r0"),
+                                                  ("b", "r3"), ("c", "r1"), ("c", "r5")]
+
+
+def test_external_sorter_rejects_empty_buffer():
+    with pytest.raises(ValueError):
+        ExternalSorter(max_records=0)
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from http.client import HTTPConnection
+
+import numpy as np
+import pytest
+import inference_server
+from brat_pipeline import PipelineRunner, get_args_parser
+
+LABELS = ["NonRel", "Strength-Drug"]
+
+
+def _init_trained_model(self):
+    # no checkpoint is loaded; the service only needs the labels and a tokenizer
+    self.tokenizer = None
+    self.label2idx = {label: idx for idx, label in enumerate(LABELS)}
+    self.idx2label = {idx: label for idx, label in enumerate(LABELS)}
+
+
+def _predict_candidates(self, candidate_columns):
+    label_ids = np.ones(len(candidate_columns), dtype=np.int64)
+    return label_ids, np.tile(np.array([[0.25, 0.75]], dtype=np.float16), (len(candidate_columns), 1))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _request(port, method, path, payload=None):
+    connection = HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.request(method, path, body=json.dumps(payload) if payload is not None else None)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_service_starts_with_the_default_arguments(tmp_path, monkeypatch):
+    monkeypatch.setattr(PipelineRunner, "_init_trained_model", _init_trained_model)
+    monkeypatch.setattr(PipelineRunner, "predict_candidates", _predict_candidates)
+    port = _free_port()
+    parser = get_args_parser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=port, type=int)
+    parser.add_argument("--unix_socket", default=None)
+    parser.add_argument("--max_batch_candidates", default=256, type=int)
+    parser.add_argument("--max_wait_ms", default=5, type=float)
+    args = parser.parse_args(["--model_type", "bert", "--new_model_dir", str(tmp_path),
+                              "--classification_mode", "mul"])
+    args.device = "cpu"
+    args.logger = logging.getLogger("inference_server_test")
+    threading.Thread(target=inference_server.app, args=(args,), daemon=True).start()
+
+    for _ in range(100):
+        try:
+            status, health = _request(port, "GET", "/health")
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        pytest.fail("the service did not start")
+    assert status == 200 and health == {"status": "ok", "labels": LABELS}
+
+    status, response = _request(port, "POST", "/predict/candidates",
+                                {"candidates": [["[s1] 10 mg [e1] of", "[s2] aspirin [e2] daily"]]})
+    assert status == 200
+    assert response["predictions"] == [{"label": "Strength-Drug", "score": 0.75}]
+
+
+def _predict_columns(batches):
+    """fake predict_fn: the label id of a candidate is its first column, so results show the slicing"""
+    def _predict(candidate_columns):
+        batches.append((len(candidate_columns), time.time()))
+        label_ids = np.array([int(columns[0]) for columns in candidate_columns], dtype=np.int64)
+        return label_ids, label_ids.astype(np.float16)[:, None]
+    return _predict
+
+
+async def _submit_all(batcher, requests, delays_sec=None):
+    batcher_task = asyncio.ensure_future(batcher.run())
+    await asyncio.sleep(0)
+    try:
+        async def _submit(columns, delay_sec):
+            await asyncio.sleep(delay_sec)
+            return await batcher.submit(columns)
+        return await asyncio.gather(*[_submit(columns, delays_sec[idx] if delays_sec else 0)
+                                      for idx, columns in enumerate(requests)])
+    finally:
+        batcher_task.cancel()
+
+
+def _requests(sizes):
+    return [[(str(req_id * 100 + idx),) for idx in range(size)] for req_id, size in enumerate(sizes)]
+
+
+def _check_results(requests, results):
+    for columns, (label_ids, probs) in zip(requests, results):
+        assert label_ids.tolist() == [int(c[0]) for c in columns]
+        assert probs.shape == (len(columns), 1)
+
+
+def test_micro_batches_are_cut_at_max_batch_candidates():
+    batches = []
+    batcher = inference_server.MicroBatcher(_predict_columns(batches), max_batch_candidates=4, max_wait_ms=500)
+    requests = _requests([2, 2, 1, 3, 1])
+    start = time.time()
+    results = asyncio.run(_submit_all(batcher, requests))
+
+    assert [size for size, _ in batches] == [4, 4, 1]
+    # full batches run at once, the last one at the deadline of its first request
+    assert batches[1][1] - start < 0.5 <= batches[2][1] - start
+    _check_results(requests, results)
+    assert batcher.metrics.num_batches == 3 and batcher.queue_candidates == 0
+
+
+def test_micro_batches_are_cut_at_the_deadline():
+    batches = []
+    batcher = inference_server.MicroBatcher(_predict_columns(batches), max_batch_candidates=100, max_wait_ms=100)
+    requests = _requests([1, 2, 3])
+    start = time.time()
+    # the third request comes after the deadline of the first batch
+    results = asyncio.run(_submit_all(batcher, requests, delays_sec=[0, 0.02, 0.3]))
+
+    assert [size for size, _ in batches] == [3, 3]
+    assert 0.1 <= batches[0][1] - start < 0.3
+    _check_results(requests, results)
+
+
+def test_micro_batch_errors_reach_every_request():
+    def _predict(candidate_columns):
+        raise RuntimeError("out of memory")
+
+    batcher = inference_server.MicroBatcher(_predict, max_batch_candidates=100, max_wait_ms=50)
+    with pytest.raises(RuntimeError, match="out of memory"):
+        asyncio.run(_submit_all(batcher, _requests([1, 2])))
+
+
+class _TaskRunner:
+    label2idx = {label: idx for idx, label in enumerate(LABELS)}
+    idx2label = {idx: label for idx, label in enumerate(LABELS)}
+
+    @staticmethod
+    def predict_candidates(candidate_columns):
+        # Strength -> Drug pairs are relations
+        label_ids = np.array([int(columns[3:5] == ["Strength", "Drug"]) for columns in candidate_columns])
+        return label_ids, np.tile(np.array([[0.25, 0.75]], dtype=np.float16), (len(candidate_columns), 1))
+
+
+async def _route_all(service, requests):
+    batcher_task = asyncio.ensure_future(service.batcher.run())
+    await asyncio.sleep(0)
+    try:
+        return [await service.route(method, path, body) for method, path, body in requests]
+    finally:
+        batcher_task.cancel()
+
+
+def test_predict_note():
+    service = inference_server.InferenceService(_TaskRunner(), neg_label_id=0, max_wait_ms=1)
+    ann = "T1\tStrength 5 10\t10 mg\nT2\tDrug 14 21\taspirin"
+    note = {"text": "Take 10 mg of aspirin daily.", "ann": ann, "fid": "note1"}
+    (status, response), (bad_status, _) = asyncio.run(_route_all(service, [
+        ("POST", "/predict/note", json.dumps(note).encode("utf-8")),
+        ("POST", "/predict/note", json.dumps({"text": note["text"]}).encode("utf-8"))]))
+
+    assert status == 200
+    assert response["fid"] == "note1" and response["num_candidates"] == 2
+    assert response["relations"] == [{"type": "Strength-Drug", "arg1": "T1", "arg2": "T2", "score": 0.75}]
+    assert response["ann"] == ann + "\nR1\tStrength-Drug Arg1:T1 Arg2:T2"
+    assert bad_status == 400
+
+
+async def _raw_requests(service, raw_requests):
+    server = await asyncio.start_server(service.handle_connection, host="127.0.0.1", port=0)
+    port = server.sockets[0].getsockname()[1]
+    responses = []
+    try:
+        for raw_request in raw_requests:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw_request)
+            await writer.drain()
+            responses.append(await reader.read())
+            writer.close()
+    finally:
+        server.close()
+    return responses
+
+
+def test_invalid_content_length_is_a_bad_request():
+    service = inference_server.InferenceService(_TaskRunner(), neg_label_id=0)
+    bad, ok = asyncio.run(_raw_requests(service, [
+        b"POST /predict/note HTTP/1.1\r\nContent-Length: ten\r\n\r\n{}",
+        b"GET /health HTTP/1.1\r\nConnection: close\r\n\r\n"]))
+
+    assert bad.startswith(b"HTTP/1.1 400 Bad Request")
+    assert b"invalid Content-Length ten" in bad
+    # the server keeps serving other connections
+    assert ok.startswith(b"HTTP/1.1 200 OK")
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from utils import confusion_matrix, prf, acc_and_f1, acc_and_f1_from_confusion, class_prf_from_confusion, measure_prf
+
+LABEL2IDX = {"NonRel": 0, "A": 1, "B": 2, "C": 3}
+GOLD = [0, 0, 1, 1, 1, 2, 2, 0]
+PREDS = [0, 1, 1, 1, 2, 2, 0, 0]
+# rows are gold labels, columns predicted labels; C (3) is never gold nor predicted
+CM = np.array([[2, 1, 0, 0],
+               [0, 2, 1, 0],
+               [1, 0, 1, 0],
+               [0, 0, 0, 0]])
+
+
+def test_confusion_matrix():
+    assert np.array_equal(confusion_matrix(GOLD, PREDS, num_labels=4), CM)
+    # without num_labels, the matrix ends at the largest label id seen
+    assert np.array_equal(confusion_matrix(GOLD, PREDS), CM[:3, :3])
+    assert confusion_matrix([], [], num_labels=2).tolist() == [[0, 0], [0, 0]]
+    with pytest.raises(AssertionError):
+        confusion_matrix([0, 1], [0])
+
+
+def test_prf():
+    assert prf(2, 1, 1) == pytest.approx((2 / 3, 2 / 3, 2 / 3))
+    assert prf(1, 0, 3) == pytest.approx((1., 0.25, 0.4))
+    # undefined scores are 0
+    assert prf(0, 0, 0) == (0., 0., 0.)
+    assert prf(0, 2, 0) == (0., 0., 0.)
+
+    p, r, f1 = prf([2, 1, 0], [1, 1, 0], [1, 1, 0])
+    assert p.tolist() == pytest.approx([2 / 3, 0.5, 0.])
+    assert r.tolist() == pytest.approx([2 / 3, 0.5, 0.])
+    assert f1.tolist() == pytest.approx([2 / 3, 0.5, 0.])
+
+
+def test_acc_and_f1():
+    # micro counts of A and B: tp 3, fp 2, fn 2
+    acc, pr, f1 = acc_and_f1(GOLD, PREDS, LABEL2IDX, "NonRel")
+    assert acc == pytest.approx(5 / 8)
+    assert f1 == pytest.approx(0.6)
+    assert pr == "precision: {}; recall: {}".format(*prf(3, 2, 2)[:2])
+
+    # the same scores from the confusion matrix, with or without the rows of labels that never appear
+    assert acc_and_f1_from_confusion(CM, LABEL2IDX, "NonRel") == (acc, pr, f1)
+    assert acc_and_f1_from_confusion(CM[:3, :3], LABEL2IDX, "NonRel") == (acc, pr, f1)
+    assert acc_and_f1_from_confusion(np.zeros((4, 4), dtype=np.int64), LABEL2IDX, "NonRel")[::2] == (0., 0.)
+
+
+def test_class_prf_from_confusion():
+    per_class, macro = class_prf_from_confusion(CM, LABEL2IDX, "NonRel")
+
+    assert list(per_class) == ["A", "B", "C"]
+    assert per_class["A"] == pytest.approx((2 / 3, 2 / 3, 2 / 3))
+    assert per_class["B"] == pytest.approx((0.5, 0.5, 0.5))
+    # a label that never appears scores 0 and is not averaged
+    assert per_class["C"] == (0., 0., 0.)
+    assert macro == pytest.approx((7 / 12, 7 / 12, 7 / 12))
+    assert class_prf_from_confusion(CM[:3, :3], LABEL2IDX, "NonRel") == (per_class, macro)
+
+
+def test_class_prf_from_confusion_averages_predicted_only_labels():
+    # C is predicted once for a gold A: a false positive with no gold, so it scores 0 and lowers the average
+    cm = CM.copy()
+    cm[1, 3] = 1
+    per_class, macro = class_prf_from_confusion(cm, LABEL2IDX, "NonRel")
+    assert per_class["A"] == pytest.approx((2 / 3, 0.5, 4 / 7))
+    assert per_class["C"] == (0., 0., 0.)
+    assert macro == pytest.approx(((2 / 3 + 0.5) / 3, (0.5 + 0.5) / 3, (4 / 7 + 0.5) / 3))
+
+
+def test_class_prf_without_relations():
+    per_class, macro = class_prf_from_confusion(np.array([[3]]), LABEL2IDX, "NonRel")
+    assert per_class == {"A": (0., 0., 0.), "B": (0., 0., 0.), "C": (0., 0., 0.)}
+    assert macro == (0., 0., 0.)
+
+
+def test_measure_prf():
+    labels = ["NonRel", "A", "B", "C"]
+    res, f1 = measure_prf([labels[i] for i in PREDS], [labels[i] for i in GOLD], "NonRel")
+
+    assert res["A"] == (0.6667, 0.6667, 0.6667)
+    assert res["B"] == (0.5, 0.5, 0.5)
+    # only gold labels are measured
+    assert "C" not in res and "NonRel" not in res
+    assert res["micro_average_pre_rec_f1"] == (0.6, 0.6, 0.6)
+    assert res["macro_average_pre_rec_f1"] == (0.5833, 0.5833, 0.5833)
+    assert f1 == 0.6
+
+    res, f1 = measure_prf(["NonRel"], ["NonRel"], "NonRel")
+    assert res == {"micro_average_pre_rec_f1": (0, 0, 0), "macro_average_pre_rec_f1": (0, 0, 0)} and f1 == 0
@@ -0,0 +1,107 @@
+import torch
+from torch.utils.data import RandomSampler, SequentialSampler
+from data_utils import TokenBudgetBatchSampler, NegativeDownsampleSampler
+
+
+def _lengths(num_examples=200, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(5, 120, (num_examples,), generator=generator).tolist()
+
+
+def test_token_budget_batches_are_bounded_and_keep_order():
+    lengths = _lengths() + [500]
+    batch_sampler = TokenBudgetBatchSampler(SequentialSampler(lengths), lengths, max_tokens=512)
+    batches = list(batch_sampler)
+
+    assert [idx for batch in batches for idx in batch] == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[idx] for idx in batch) <= 512
+    # greedy packing: the next example would not fit into the batch
+    for batch, next_batch in zip(batches, batches[1:]):
+        assert (len(batch) + 1) * max(lengths[idx] for idx in batch + next_batch[:1]) > 512
+
+
+def test_token_budget_example_longer_than_budget_is_alone():
+    lengths = [10, 10, 1000, 10]
+    batches = list(TokenBudgetBatchSampler(SequentialSampler(lengths), lengths, max_tokens=100))
+    assert batches == [[0, 1], [2], [3]]
+
+
+def test_token_budget_random_batches_are_deterministic_with_a_seed():
+    lengths = _lengths()
+
+    def epoch_batches(seed):
+        sampler = RandomSampler(lengths, generator=torch.Generator().manual_seed(seed))
+        return list(TokenBudgetBatchSampler(sampler, lengths, max_tokens=1024))
+
+    assert epoch_batches(13) == epoch_batches(13)
+    assert epoch_batches(13) != epoch_batches(14)
+    assert sorted(idx for batch in epoch_batches(13) for idx in batch) == list(range(len(lengths)))
+
+
+def test_token_budget_planned_epochs_and_len():
+    lengths = _lengths()
+    sampler = RandomSampler(lengths, generator=torch.Generator().manual_seed(0))
+    batch_sampler = TokenBudgetBatchSampler(sampler, lengths, max_tokens=1024)
+    num_batches = batch_sampler.plan_epochs(3)
+
+    for epoch in range(3):
+        assert len(batch_sampler) == num_batches[epoch]
+        batch_iter = iter(batch_sampler)
+        batches = [next(batch_iter)]
+        # the running epoch, not the next planned one
+        assert len(batch_sampler) == num_batches[epoch]
+        batches.extend(batch_iter)
+        assert len(batches) == num_batches[epoch]
+
+
+def test_token_budget_reset_drops_planned_epochs():
+    lengths = _lengths()
+    sampler = RandomSampler(lengths, generator=torch.Generator().manual_seed(0))
+    batch_sampler = TokenBudgetBatchSampler(sampler, lengths, max_tokens=1024)
+    batch_sampler.plan_epochs(5)
+    # stop within the first epoch
+    batch_iter = iter(batch_sampler)
+    next(batch_iter)
+    batch_sampler.reset()
+
+    num_batches = batch_sampler.plan_epochs(2)
+    assert len(batch_sampler._planned_epochs) == 2
+    assert len(batch_sampler) == num_batches[0]
+    assert len(list(batch_sampler)) == num_batches[0]
+
+
+def _label_ids(num_pos=30, num_neg=170, neg_label_id=0):
+    return [1 + idx % 3 for idx in range(num_pos)] + [neg_label_id] * num_neg
+
+
+def test_negative_downsample_keeps_all_positives_and_a_ratio_of_negatives():
+    label_ids = _label_ids()
+    sampler = NegativeDownsampleSampler(label_ids, neg_label_id=0, neg_sample_ratio=0.25,
+                                        generator=torch.Generator().manual_seed(0))
+    for _ in range(3):
+        epoch_idx = list(sampler)
+        assert len(epoch_idx) == len(sampler) == 30 + round(170 * 0.25)
+        assert len(set(epoch_idx)) == len(epoch_idx)
+        assert set(range(30)) <= set(epoch_idx)
+        assert sum(label_ids[idx] == 0 for idx in epoch_idx) == round(170 * 0.25)
+
+
+def test_negative_downsample_fresh_negatives_each_epoch_and_deterministic_with_a_seed():
+    label_ids = _label_ids()
+
+    def epochs(seed, num_epochs=3):
+        sampler = NegativeDownsampleSampler(label_ids, neg_label_id=0, neg_sample_ratio=0.25,
+                                            generator=torch.Generator().manual_seed(seed))
+        return [list(sampler) for _ in range(num_epochs)]
+
+    first, second = epochs(13), epochs(13)
+    assert first == second
+    assert epochs(14) != first
+    assert {idx for idx in first[0] if idx >= 30} != {idx for idx in first[1] if idx >= 30}
+
+
+def test_negative_downsample_ratio_one_keeps_everything():
+    label_ids = _label_ids()
+    sampler = NegativeDownsampleSampler(label_ids, neg_label_id=0, neg_sample_ratio=1.0)
+    assert sorted(sampler) == list(range(len(label_ids)))